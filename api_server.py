@@ -0,0 +1,190 @@
+import asyncio
+import re
+from http import HTTPStatus
+import orjson as json
+from automata.automata_engine import AdmissionException, AutomataEngine, AutomataRun
+from config import Config
+
+class HttpException(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class ApiServer:
+    """A small asyncio HTTP/1.1 server exposing an AutomataEngine:
+
+        GET  /health                 engine queue and worker stats
+        POST /runs                   submit a run, body {"input": "...", "priority": "interactive"|"batch"}
+        GET  /runs                   list retained runs
+        GET  /runs/{id}              run status and per-step summary
+        GET  /runs/{id}/results      full step data of the run
+        GET  /runs/{id}/events       progress as newline-delimited JSON, streamed until the run ends
+        POST /runs/{id}/input        input for a waiting interactive step, body {"input": "..."}
+
+    Requests are served from a single event loop, so idle and streaming clients
+    don't hold threads; each connection handles one request"""
+    MAX_HEADER_BYTES = 16 * 1024
+    MAX_BODY_BYTES = 1024 * 1024
+    RUN_PATH = re.compile(r'^/runs/([0-9a-fA-F-]+)(/results|/events|/input)?$')
+
+    def __init__(self, engine: AutomataEngine, host: str = None, port: int = None):
+        conf = Config.get_instance().get_conf()
+        self.engine = engine
+        self.host = host if host is not None else conf.host
+        self.port = port if port is not None else conf.port
+        self.server: asyncio.Server = None
+        self.logger = Config.get_instance().logger
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port,
+                                                 limit=ApiServer.MAX_HEADER_BYTES)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        self.logger.info('API server listening on {}:{}'.format(self.host, self.port))
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, body = await self._read_request(reader)
+            await self._dispatch(method, path, body, writer)
+        except HttpException as e:
+            await self._send_json(writer, e.status, {'error': e.message})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            self.logger.error(e)
+            try:
+                await self._send_json(writer, HTTPStatus.INTERNAL_SERVER_ERROR, {'error': 'Internal server error'})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise HttpException(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'Request headers too large')
+        lines = head.decode('latin-1').split('\r\n')
+        request_line = lines[0].split(' ')
+        if len(request_line) != 3:
+            raise HttpException(HTTPStatus.BAD_REQUEST, 'Malformed request line')
+        method, path = request_line[0].upper(), request_line[1].split('?', 1)[0]
+        headers: dict[str, str] = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', '0') or 0)
+        if length > ApiServer.MAX_BODY_BYTES:
+            raise HttpException(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'Request body too large')
+        body = await reader.readexactly(length) if length > 0 else b''
+        return method, path, body
+
+    async def _dispatch(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter) -> None:
+        if path == '/health' and method == 'GET':
+            return await self._send_json(writer, HTTPStatus.OK, self.engine.get_stats())
+        if path == '/runs':
+            if method == 'POST':
+                return await self._submit_run(body, writer)
+            if method == 'GET':
+                return await self._send_json(writer, HTTPStatus.OK,
+                                             {'runs': [run.to_dict() for run in self.engine.list_runs()]})
+            raise HttpException(HTTPStatus.METHOD_NOT_ALLOWED, 'Method not allowed')
+        match = ApiServer.RUN_PATH.match(path)
+        if match is None:
+            raise HttpException(HTTPStatus.NOT_FOUND, 'Not found')
+        run = self.engine.get_run(match.group(1))
+        if run is None:
+            raise HttpException(HTTPStatus.NOT_FOUND, 'No run found with ID {}'.format(match.group(1)))
+        action = match.group(2)
+        if action is None and method == 'GET':
+            return await self._send_json(writer, HTTPStatus.OK, run.to_dict())
+        if action == '/results' and method == 'GET':
+            return await self._send_json(writer, HTTPStatus.OK,
+                                         {'run_id': run.run_id, 'state': run.state, 'steps': [step.to_dict() for step in run.get_steps()]})
+        if action == '/events' and method == 'GET':
+            return await self._stream_events(run, writer)
+        if action == '/input' and method == 'POST':
+            return await self._send_input(run, body, writer)
+        raise HttpException(HTTPStatus.METHOD_NOT_ALLOWED, 'Method not allowed')
+
+    def _parse_body(self, body: bytes) -> dict:
+        try:
+            payload = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            raise HttpException(HTTPStatus.BAD_REQUEST, 'Request body must be JSON')
+        if not isinstance(payload, dict) or not isinstance(payload.get('input', ''), str):
+            raise HttpException(HTTPStatus.BAD_REQUEST, 'Expected a JSON object with a string "input" field')
+        return payload
+
+    def _parse_input(self, body: bytes) -> str:
+        return self._parse_body(body).get('input', '')
+
+    async def _submit_run(self, body: bytes, writer: asyncio.StreamWriter) -> None:
+        payload = self._parse_body(body)
+        priority_class = payload.get('priority', AutomataEngine.DEFAULT_PRIORITY_CLASS)
+        if priority_class not in AutomataEngine.PRIORITY_CLASSES:
+            raise HttpException(HTTPStatus.BAD_REQUEST, 'Unknown priority class, expected one of: {}'.format(
+                ', '.join(AutomataEngine.PRIORITY_CLASSES.keys())))
+        try:
+            run = self.engine.submit(payload.get('input', ''), priority_class)
+        except AdmissionException as e:
+            raise HttpException(HTTPStatus.TOO_MANY_REQUESTS, str(e))
+        await self._send_json(writer, HTTPStatus.ACCEPTED, run.to_dict(),
+                              {'Location': '/runs/{}'.format(run.run_id)})
+
+    async def _send_input(self, run: AutomataRun, body: bytes, writer: asyncio.StreamWriter) -> None:
+        if run.socket is None:
+            raise HttpException(HTTPStatus.CONFLICT, 'This graph has no interactive steps')
+        if run.is_finished():
+            raise HttpException(HTTPStatus.CONFLICT, 'Run has already finished')
+        run.socket.put_input(self._parse_input(body))
+        await self._send_json(writer, HTTPStatus.ACCEPTED, {'run_id': run.run_id})
+
+    # Replay the run's events so far, then forward new ones as they are
+    # published, until the run ends or the client goes away
+    async def _stream_events(self, run: AutomataRun, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[dict] = asyncio.Queue()
+        def listener(event: dict):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+        events = run.subscribe(listener)
+        try:
+            writer.write(self._format_head(HTTPStatus.OK, {'Content-Type': 'application/x-ndjson',
+                                                           'Transfer-Encoding': 'chunked',
+                                                           'Cache-Control': 'no-cache'}))
+            for event in events:
+                self._write_chunk(writer, event)
+            await writer.drain()
+            ended = any(event['type'] == 'end' for event in events)
+            while not ended:
+                event = await queue.get()
+                self._write_chunk(writer, event)
+                await writer.drain()
+                ended = event['type'] == 'end'
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        finally:
+            run.unsubscribe(listener)
+
+    def _write_chunk(self, writer: asyncio.StreamWriter, event: dict) -> None:
+        data = json.dumps(event) + b'\n'
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+    def _format_head(self, status: HTTPStatus, headers: dict[str, str]) -> bytes:
+        head = 'HTTP/1.1 {} {}\r\n'.format(status.value, status.phrase)
+        for name, value in {**headers, 'Connection': 'close'}.items():
+            head += '{}: {}\r\n'.format(name, value)
+        return (head + '\r\n').encode('latin-1')
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: HTTPStatus, payload,
+                         headers: dict[str, str] = None) -> None:
+        data = json.dumps(payload)
+        writer.write(self._format_head(status, {**(headers or {}), 'Content-Type': 'application/json',
+                                                'Content-Length': str(len(data))}) + data)
+        await writer.drain()
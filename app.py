@@ -1,12 +1,13 @@
 import os
+import sys
 import orjson as json
-from automata.automata_config import AutomataConfig, AutomataConfigFactory
+from automata.automata_artifact import AutomataArtifacts, CompiledAutomata
+from automata.step_dispatcher import StepDispatcher
 from config import Config
 from automata.automata import Automata, AutomataDependencies, AutomataGraph
-from docker_executor import DockerExecutor
-from files_util import FileTree
 from in_memory_graph_data import InMemoryGraphData
-from sapient_langchain_openai import SapientLangchainOpanAI
+from memory_accounting import MemoryAccount
+from native_handler import NativeHandler
 
 evaluation = """
 I need to make a website that uses a flexible layout that works on
@@ -24,30 +25,66 @@ Respond in pure JSON, no Markdown formatting please.
 """
 if __name__ == "__main__":
     config = Config.get_instance()
-    sapient = SapientLangchainOpanAI(config)
-    automata_config_dict = config.load_config_file(
-            config.normalize_and_resolve_path(config.conf.automata_location))
-    
-    automata_global_config = automata_config_dict['config']
-    automata_dag_list: list[dict] = automata_config_dict["automata"]
-    in_memory_graph_data: InMemoryGraphData = InMemoryGraphData()
-    automata_configs: list[AutomataConfig] = []
-    for dag_node in automata_dag_list:
-        automata_config = AutomataConfigFactory(dag_node).get_config()
-        automata_configs.append(automata_config)
-        
-    # Import handlers to register them:
-    from js_handler import JSHandler
-    from py_handler import PyHandler
-    from native_handler import NativeHandler
+    # Step workers take their graph from the coordinator's tasks
+    if config.conf.worker:
+        from automata.step_dispatcher import DistributedStepDispatcher, StepWorker
+        StepWorker(DistributedStepDispatcher.parse_address(config.conf.dispatcher_address),
+                   config.conf.dispatcher_authkey.encode('utf-8')).run()
+        sys.exit(0)
+    # Load the validated graph from the artifact cache, compiling it if the
+    # config or handler sources changed since the artifact was written
+    automata_location = config.normalize_and_resolve_path(config.conf.automata_location)
+    compiled: CompiledAutomata = AutomataArtifacts(config).load(automata_location)
+    # Only load a model provider if the graph has generative steps; handler
+    # backends are loaded by AutomataDependencies for the prefixes in use
+    sapient = None
+    if any(automata_config.uses_model() for automata_config in compiled.automata_configs):
+        from sapient import Sapient
+        sapient = Sapient.from_config(config)
+    dispatcher: StepDispatcher = StepDispatcher.from_config(config)
+    # With a port configured, serve runs over HTTP from this process instead
+    # of executing a single session
+    if config.conf.port > 0:
+        import asyncio
+        from api_server import ApiServer
+        from automata.automata_engine import AutomataEngine
+        engine = AutomataEngine(config, compiled, sapient, dispatcher=dispatcher)
+        engine.start()
+        # Changes to the config are picked up without a restart, if enabled
+        from automata.automata_reloader import AutomataReloader
+        reloader = AutomataReloader(config, automata_location, compiled, engine.set_compiled)
+        reloader.start()
+        try:
+            asyncio.run(ApiServer(engine).serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reloader.stop()
+            engine.stop()
+            dispatcher.close()
+        sys.exit(0)
+
+    in_memory_graph_data: InMemoryGraphData = InMemoryGraphData(
+        MemoryAccount('cli', config.get_conf().max_session_bytes))
     NativeHandler.set_graph_data(in_memory_graph_data)
  
     dependencies: AutomataDependencies = AutomataDependencies(
-        config, automata_configs, sapient, 
-        in_memory_graph_data, automata_global_config=automata_global_config)
-    graph: AutomataGraph = AutomataGraph(dependencies)
+        config, compiled.automata_configs, sapient, 
+        in_memory_graph_data, automata_global_config=compiled.automata_global_config,
+        dispatcher=dispatcher)
+    graph: AutomataGraph = AutomataGraph(dependencies, compiled)
     
     automatons: list[Automata] = graph.run_graph(initial_input=evaluation)
-    config.logger.info("Automaton results: ")
-    for automata in automatons:
-        config.logger.info(json.dumps(automata.step_data, option=json.OPT_INDENT_2).decode("utf-8"))
+    config.logger.info("Step data memory: %s", json.dumps(in_memory_graph_data.memory_account.to_dict()).decode("utf-8"))
+    # Large sessions are exported record by record, rather than logged
+    if config.conf.export_path:
+        from graph_data_export import GraphDataExport
+        export_path = config.conf.export_path
+        if not export_path.startswith('tcp://'):
+            export_path = config.normalize_and_resolve_path(export_path)
+        count = GraphDataExport.export_to(in_memory_graph_data, export_path)
+        config.logger.info("Exported %d steps to %s", count, export_path)
+    else:
+        config.logger.info("Automaton results: ")
+        for automata in automatons:
+            config.logger.info(json.dumps(automata.step_data.to_dict(), option=json.OPT_INDENT_2).decode("utf-8"))
@@ -0,0 +1,127 @@
+import asyncio
+from collections import deque
+from typing import Callable
+import orjson as json
+from event_loop import BackgroundEventLoop
+from generic_socket import AsyncGenericSocket
+
+def _to_text(message: str | bytes | bytearray | memoryview) -> str:
+    if isinstance(message, str):
+        return message
+    return bytes(message).decode('utf-8', errors='replace')
+
+class QueueSocket(AsyncGenericSocket):
+    """In-process socket: input is pushed from any thread with `put_input`, and
+    sent messages are handed to `on_message` (and kept in a bounded outbox)"""
+    def __init__(self, on_message: Callable[[str], None] = None, max_outbox: int = 1000):
+        self.loop = BackgroundEventLoop.get_instance().loop
+        self.inbox: asyncio.Queue[str] = asyncio.Queue()
+        self.outbox: deque[str] = deque(maxlen=max_outbox)
+        self.on_message = on_message
+
+    def put_input(self, message: str) -> None:
+        self.loop.call_soon_threadsafe(self.inbox.put_nowait, _to_text(message))
+
+    async def asend(self, message: str | bytes | bytearray | memoryview) -> None:
+        message = _to_text(message)
+        self.outbox.append(message)
+        if self.on_message is not None:
+            self.on_message(message)
+
+    async def arecv(self) -> str:
+        return await self.inbox.get()
+
+class StreamSocket(AsyncGenericSocket):
+    """One session's end of a StreamSocketServer connection. Frames are JSON
+    values, one per line; incoming lines that aren't JSON strings are passed
+    through as raw text. Messages sent before a client connects are buffered"""
+    def __init__(self, session_id: str, max_pending: int = 1000):
+        self.session_id = session_id
+        self.inbox: asyncio.Queue[str] = asyncio.Queue()
+        self.pending: deque[bytes] = deque(maxlen=max_pending)
+        self.writer: asyncio.StreamWriter = None
+
+    async def asend(self, message: str | bytes | bytearray | memoryview) -> None:
+        frame = json.dumps(_to_text(message)) + b'\n'
+        if self.writer is None or self.writer.is_closing():
+            self.pending.append(frame)
+            return
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def arecv(self) -> str:
+        return await self.inbox.get()
+
+    async def attach(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        while len(self.pending) > 0:
+            writer.write(self.pending.popleft())
+        await writer.drain()
+        while not reader.at_eof():
+            line = await reader.readline()
+            if not line:
+                break
+            await self.inbox.put(StreamSocket.decode_frame(line))
+        if self.writer is writer:
+            self.writer = None
+
+    @staticmethod
+    def decode_frame(line: bytes) -> str:
+        try:
+            value = json.loads(line)
+            if isinstance(value, str):
+                return value
+        except json.JSONDecodeError:
+            pass
+        return line.decode('utf-8', errors='replace').rstrip('\r\n')
+
+class StreamSocketServer:
+    """Reference TCP transport for interactive steps, standing in for a
+    WebSocket endpoint. A client connects, sends its session ID as the first
+    line, and then exchanges line-delimited frames with that session's steps.
+    All connections are served from the background event loop, so waiting
+    sessions cost no threads"""
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.sockets: dict[str, StreamSocket] = {}
+        self.server: asyncio.Server = None
+        self.event_loop = BackgroundEventLoop.get_instance()
+
+    def start(self) -> tuple[str, int]:
+        return self.event_loop.run_sync(self._start())
+
+    async def _start(self) -> tuple[str, int]:
+        self.server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        return self.host, self.port
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+            self.event_loop.run_sync(self.server.wait_closed())
+
+    def get_socket(self, session_id: str) -> StreamSocket:
+        session_id = str(session_id)
+        socket = self.sockets.get(session_id, None)
+        if socket is None:
+            socket = StreamSocket(session_id)
+            self.sockets[session_id] = socket
+        return socket
+
+    def release_socket(self, session_id: str) -> None:
+        socket = self.sockets.pop(str(session_id), None)
+        if socket is not None and socket.writer is not None:
+            socket.writer.close()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            first_line = await reader.readline()
+            if not first_line:
+                return
+            socket = self.get_socket(StreamSocket.decode_frame(first_line))
+            await socket.attach(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
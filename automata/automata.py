@@ -1,21 +1,37 @@
-
-from datetime import datetime
+from __future__ import annotations
+import asyncio
 from enum import Enum
+import threading
+import time
 import traceback
-from typing import Callable
+from typing import TYPE_CHECKING, Callable, Iterable
 import uuid
-from networkx import DiGraph, ancestors, descendants, topological_generations
-from automata.automata_config import AutomataConfig, AutomataDataProcessorConfig, AutomataGeneratorConfig, AutomataType, Ops
+from automata.automata_config import AutomataConfig, AutomataDataProcessorConfig, AutomataGeneratorConfig, \
+    AutomataMapConfig, AutomataReduceConfig, AutomataType, InputSelector, Ops
+from automata.fair_share_executor import FairShareExecutor, WorkGroup
+from automata.input_projection import InputProjection
+from automata.latency_stats import LatencyStats
+from automata.partial_output_bus import PartialOutputBus
+from automata.step_dispatcher import LocalStepDispatcher, StepDispatcher
 from config import Config
 import orjson as json
-from generic_socket import GenericSocket
+from event_loop import BackgroundEventLoop
+from generic_socket import AsyncGenericSocket, GenericSocket
 from graph_data import GraphData, StepData
 from handler import Handler
+from json_extraction import IncrementalJsonParser, JsonSchemaValidator
+from memory_accounting import MemoryAccounting, MemoryBudgetException
 from native_handler import NativeHandler
 from sapient import Sapient
-import networkx
+from collections import Counter
 import concurrent.futures
 import copy
+import dataclasses
+
+# networkx is only needed once a graph is built, keep it off the import path
+if TYPE_CHECKING:
+    from networkx import DiGraph
+    from automata.automata_artifact import CompiledAutomata
 
 
 #TROUBLESHOOT CORE DUMPS
@@ -34,27 +50,42 @@ class AutomataDependencies:
                  automata_configs: list[AutomataConfig],
                  sapient: Sapient,
                  graph_data: GraphData,
-                 socket: GenericSocket = GenericSocket(),
-                 automata_global_config: dict = {},
-                 callbacks: dict[str, Callable[[str, list[StepData], list[StepData], StepData, dict, str], None]] = {},
-                 session_id: str| int | uuid.UUID = uuid.uuid4()):
+                 socket: GenericSocket = None,
+                 automata_global_config: dict = None,
+                 callbacks: dict[str, Callable[[str, list[StepData], list[StepData], StepData, dict, str], None]] = None,
+                 session_id: str| int | uuid.UUID = None,
+                 step_listeners: list[Callable[[StepData], None]] = None,
+                 dispatcher: StepDispatcher = None,
+                 latency_stats: LatencyStats = None,
+                 priority: int = 0,
+                 partial_outputs: PartialOutputBus = None):
         self.config = config
         self.automata_configs = automata_configs
         self.sapient = sapient
         self.graph_data = graph_data
-        self.socket = socket
-        self.automata_global_config = automata_global_config
-        self.session_id = session_id
+        # Defaults are created per instance, so concurrent runs never share a session
+        self.socket = socket if socket is not None else GenericSocket()
+        self.automata_global_config = automata_global_config if automata_global_config is not None else {}
+        self.session_id = session_id if session_id is not None else uuid.uuid4()
+        # Called with each step's data as it is stored, e.g. to report progress
+        self.step_listeners = step_listeners if step_listeners is not None else []
+        self.dispatcher = dispatcher if dispatcher is not None else LocalStepDispatcher()
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats.get_instance()
+        # Lower values are dispatched first, when steps from several runs compete
+        self.priority = priority
+        self.partial_outputs = partial_outputs if partial_outputs is not None else PartialOutputBus()
         self.input_step_datas: list[StepData] = []
-        self.register_handlers(callbacks)
+        self.register_handlers(callbacks if callbacks is not None else {})
         
     def register_handlers(self, callbacks: dict[str, Callable[[str, list[StepData], list[StepData], StepData, dict, str], None]]) -> None:
+        # Only import the scripting and native handler backends this graph references
+        Handler.load_handlers(Handler.get_handler_refs(self.automata_configs))
         for cls in Handler.__subclasses__():
             prefix = cls.get_handler_prefix()
             if not prefix in AutomataDependencies.handlers.keys():
                 AutomataDependencies.handlers[prefix] = cls()
         # Register callbacks from dictionary
-        for key, callback in callbacks:
+        for key, callback in callbacks.items():
             NativeHandler.register_callback(key, callback)
             
 class AutomataState(Enum):
@@ -79,6 +110,18 @@ class Automata:
         self.step_data: StepData = None
         self.input_step_datas: list[StepData] = None
         self.handlers = dependencies.handlers
+        # Enablement can be toggled by upstream steps while a graph runs; it is
+        # kept here rather than on the (shared) config
+        self.enabled: bool = automata_config.enabled
+        # Socket input received ahead of invoke(), see AutomataGraph._invoke_after_socket_input
+        self.socket_input: str = None
+        self.socket_error: Exception = None
+        # Seconds spent in the last invoke(), excluding any wait on the socket
+        self.duration: float = None
+        # Estimated seconds from this step's start to the end of its graph
+        self.critical_path: float = 0.0
+        # Whether model output is streamed to the partial outputs, set by the graph
+        self.streams_output: bool = False
     def _get_user_prompt(self):
         if isinstance(self.automata_config, AutomataGeneratorConfig):
             return self.automata_config.user_prompt
@@ -122,60 +165,122 @@ class Automata:
     # Data processor handler, attempts to use handler in registry; an inline handler; or raises exception
     def _process_data(self, handler: str, input_data: StepData, input: str = "") -> StepData:
         step_data: StepData = input_data
-        for handler_prefix, handler_instance in self.handlers.items():
-            if handler.startswith(handler_prefix):
-                handler_instance.invoke_handler(handler, self.input_step_datas,
-                                 step_data, self.automata_global_config, input)
+        Handler.bind_context(socket=self.socket if self.automata_config.socket else None,
+                            graph_data=self.dependencies.graph_data,
+                            automata_config=self.automata_config,
+                            partial_outputs=self.dependencies.partial_outputs)
+        try:
+            for handler_prefix, handler_instance in self.handlers.items():
+                if handler.startswith(handler_prefix):
+                    handler_instance.invoke_handler(handler, self.input_step_datas,
+                                     step_data, self.automata_global_config, input)
+                    return step_data
+            # If the callback wasn't registered with a 'native::' prefix, still allow it to be invoked if it is registered
+            if handler in NativeHandler.CALLBACKS.keys():
+                NativeHandler.CALLBACKS[handler](
+                input_step_datas=self.input_step_datas, 
+                step_data=step_data, 
+                config=self.automata_global_config, 
+                input=input)
                 return step_data
-        # If the callback wasn't registered with a 'native::' prefix, still allow it to be invoked if it is registered
-        if handler in NativeHandler.CALLBACKS.keys():
-            NativeHandler.CALLBACKS[handler](
-            input_step_datas=self.input_step_datas, 
-            step_data=step_data, 
-            config=self.automata_global_config, 
-            input=input)
-            return step_data
+        finally:
+            # Pooled threads outlive the run, so don't keep its graph data bound
+            Handler.bind_context()
         raise Exception("No registered handler found named {}, returning step_data unchanged. " +
                         "The following native handlers are registered: {} - please check your configuration".format(
             handler, ", ".join(NativeHandler.CALLBACKS.keys())))
             
     def set_input_datas(self, input_step_datas: list[StepData], initial_input: str) -> None:
         self.input_step_datas = input_step_datas
-        step_data: StepData = StepData(start=datetime.now(), 
+        self.socket_input = None
+        self.socket_error = None
+        self.duration = None
+        step_data: StepData = StepData(start_ns=StepData.now_ns(), 
                                   automata_id=self.automata_config.get_id(),
                                   parent_id=self.automata_config.parent_id,
                                   session_id=str(self.dependencies.session_id),
                                   text=initial_input)
         
         self.step_data = self._process_data(self._get_input_handler(), step_data, initial_input)
+        # Steps with declarative inputs only see their projected slices
+        if self.automata_config.inputs and isinstance(self.step_data.input_data, dict):
+            self.step_data.input_data.pop(NativeHandler.GRAPH_DATA_KEY, None)
         
+    def _get_socket_announce_message(self) -> str:
+        return self.config.socket_announce_message.format(session_id=self.dependencies.session_id)
+    
+    # Whether invoke() would do any work, rather than pass its input through
+    def awaits_execution(self) -> bool:
+        return self.enabled != False and self.automata_config.op != Ops.PASSTHROUGH
+    
+    # Whether invoke() would wait on the socket, and the socket lets that wait
+    # happen on the event loop instead of a worker thread
+    def awaits_socket_input(self) -> bool:
+        return self.automata_config.socket and isinstance(self.socket, AsyncGenericSocket) and \
+            self.awaits_execution()
+    
+    # Announce the step and wait for its input without blocking a thread; any
+    # failure is raised again by invoke() so it goes through the usual error handling
+    async def areceive_socket_input(self) -> None:
+        timeout = self.get_socket_timeout()
+        try:
+            await self.socket.asend(self._get_socket_announce_message())
+            self.socket_input = await asyncio.wait_for(self.socket.arecv(), timeout)
+        except asyncio.TimeoutError:
+            self.socket_error = Exception('Step {} received no socket input within {}s'.format(
+                self.automata_config.get_id(), timeout))
+        except Exception as e:
+            self.socket_error = e
+
+    # Seconds to wait for socket input, None to wait indefinitely
+    def get_socket_timeout(self) -> float | None:
+        timeout = self.automata_config.socket_timeout
+        timeout = timeout if timeout is not None else self.conf.socket_input_timeout
+        return timeout if timeout > 0 else None
+    
     def invoke(self) -> dict:
         self.state = AutomataState.IN_PROGRESS
-        if self.automata_config.enabled == False or self.automata_config.op == Ops.PASSTHROUGH:
+        if not self.awaits_execution():
             # TODO - don't allow nodes with multiple upstream dependencies to be disabled, otherwise this breaks
             self.step_data.output_data = self.step_data.input_data
             self.state = AutomataState.COMPLETED
             return
         try:
             # TODO think through this design more
-            if self.automata_config.socket:
-                self.socket.send(self.config.socket_announce_message.format(session_id=self.dependencies.session_id))
+            if self.socket_error is not None:
+                raise self.socket_error
+            if self.socket_input is not None:
+                self.step_data.text = self.socket_input
+            elif self.automata_config.socket:
+                self.socket.send(self._get_socket_announce_message())
                 # TODO - we may need to make this configurable, to optionally wait on a socket
                 self.step_data.text = self.socket.recv()
                 # TODO input processor for socket
+            started = time.perf_counter()
             if self.automata_config.op == Ops.GENERATE:
-                self._generate()
+                self.step_data = self._generate(self.step_data)
             elif self.automata_config.op == Ops.DATA_PROCCESS:
                 self.step_data = self._process_data(self._get_output_handler(), self.step_data)
+            elif self.automata_config.op == Ops.MAP:
+                self._map()
+            elif self.automata_config.op == Ops.REDUCE:
+                self._reduce()
             else:
                 self.config.logger.error("No valid ops found")
                 raise Exception("Cannot continue, no valid logger found")
+            if self.get_max_output_bytes() > 0:
+                self._check_output_budget(MemoryAccounting.estimate_value_size(self.step_data.output_data) + 
+                                          MemoryAccounting.estimate_value_size(self.step_data.text))
 
             self.state = AutomataState.COMPLETED
-            self.step_data.end = datetime.now()
+            self.duration = time.perf_counter() - started
+            self.step_data.end_ns = StepData.now_ns()
             if self.automata_config.socket:
                 # TODO - this should announce the step and iteration that was just run
                 self.socket.send(self._process_data(self._get_output_handler(), self.step_data).text)
+        except MemoryBudgetException as e:
+            self.config.logger.error(e)
+            self.fail_over_budget(e)
         except Exception as e:
             self.config.logger.error(e)
             self.config.logger.error(traceback.format_exc())
@@ -184,46 +289,293 @@ class Automata:
             else:
                 self.state = AutomataState.ERROR
     
+    # Output budget of this step in bytes, 0 for none
+    def get_max_output_bytes(self) -> int:
+        max_bytes = self.automata_config.max_output_bytes
+        return max_bytes if max_bytes is not None else self.conf.max_node_bytes
+    
+    def _check_output_budget(self, size: int) -> None:
+        max_bytes = self.get_max_output_bytes()
+        if max_bytes > 0 and size > max_bytes:
+            raise MemoryBudgetException('Step {} produced over {} bytes of output, its budget is {} bytes'.format(
+                self.automata_config.get_id(), size, max_bytes))
+    
+    # Fail the step over a memory budget, dropping the data that broke it
+    def fail_over_budget(self, e: MemoryBudgetException) -> None:
+        self.step_data.output_data = {}
+        self.step_data.text = ''
+        self.step_data.failure_data = {'stage': 'memory', 'errors': [str(e)]}
+        self.step_data.success = False
+        self.state = AutomataState.ERROR_IGNORED if self.automata_config.allow_failure == True else AutomataState.ERROR
+    
+    # Copy step data for prompt rendering, sharing (rather than copying) the live
+    # graph data reference handed to templates by the input handler. Shallow
+    # copies only copy the top level of the input data
+    def _copy_step_data(self, step_data: StepData, deep: bool = True) -> StepData:
+        if not deep:
+            return dataclasses.replace(step_data, input_data=dict(step_data.input_data) 
+                                       if isinstance(step_data.input_data, dict) else step_data.input_data)
+        memo = {}
+        if isinstance(step_data.input_data, dict) and \
+            NativeHandler.GRAPH_DATA_KEY in step_data.input_data:
+            graph_data = step_data.input_data[NativeHandler.GRAPH_DATA_KEY]
+            memo[id(graph_data)] = graph_data
+        return copy.deepcopy(step_data, memo)
+    
     # Invoke an LLM or other model. TODO switch on data type to drive method and model selection in Sapient,
     # right now just text. Image generation would be slick 
-    def _generate(self) -> tuple[dict|list, str]:
-        system_prompt_data: StepData = self._process_data(self._get_system_prompt_handler(), copy.deepcopy(self.step_data), self._get_system_prompt())
-        user_prompt_data: StepData = self._process_data(self._get_user_prompt_handler(), copy.deepcopy(self.step_data), self._get_user_prompt())
+    def _generate(self, step_data: StepData, deep_copy: bool = True) -> StepData:
+        system_prompt_data: StepData = self._process_data(self._get_system_prompt_handler(), 
+                                                          self._copy_step_data(step_data, deep_copy), self._get_system_prompt())
+        user_prompt_data: StepData = self._process_data(self._get_user_prompt_handler(), 
+                                                        self._copy_step_data(step_data, deep_copy), self._get_user_prompt())
       
         self.config.logger.debug("System prompt: %s", system_prompt_data.text)
         self.config.logger.debug("User prompt: %s", user_prompt_data.text)
         
-        content = self.sapient.invoke_llm(system_prompt_data.text, user_prompt_data.text, self._get_model())
+        if self.streams_output:
+            content = self._stream(system_prompt_data.text, user_prompt_data)
+        else:
+            content = self.sapient.invoke_llm(system_prompt_data.text, user_prompt_data.text, self._get_model())
+            # Checked before the response is parsed into (larger) output data
+            self._check_output_budget(len(content.encode('utf-8')))
         user_prompt_data.text = content
-        self.step_data = self._process_data(self._get_output_handler(), user_prompt_data, content)
+        return self._process_data(self._get_output_handler(), user_prompt_data, content)
+
+    # Stream the model's response, publishing JSON values as they complete to
+    # the output handler's partial callback and the run's partial outputs
+    def _stream(self, system_prompt: str, step_data: StepData) -> str:
+        id = self.automata_config.get_id()
+        partial_outputs = self.dependencies.partial_outputs
+        partial_callback = NativeHandler.get_partial_callback(self._get_output_handler())
+        def on_value(path: tuple, value) -> None:
+            if partial_callback is not None:
+                try:
+                    partial_callback(input_step_datas=self.input_step_datas, step_data=step_data,
+                                     config=self.automata_global_config, path=path, value=value)
+                except Exception as e:
+                    # The output handler still sees the whole response
+                    self.config.logger.warning('Partial output handler failed on {}: {}'.format(id, e))
+            partial_outputs.publish(id, path, value)
+        parser = IncrementalJsonParser(on_value)
+        chunks: list[str] = []
+        size = 0
+        completed = False
+        try:
+            for chunk in self.sapient.stream_llm(system_prompt, step_data.text, self._get_model()):
+                chunks.append(chunk)
+                # Stop a runaway response as soon as it crosses the budget
+                size += len(chunk.encode('utf-8'))
+                self._check_output_budget(size)
+                parser.feed(chunk)
+            parser.finish()
+            completed = True
+        finally:
+            partial_outputs.complete(id)
+            if not completed and partial_callback is not None:
+                self._abort_partial(step_data)
+        return ''.join(chunks)
+
+    # The output handler never sees a stream that failed or was cut short, so
+    # let its partial callback undo what it did with the part it saw
+    def _abort_partial(self, step_data: StepData) -> None:
+        partial_abort = NativeHandler.get_partial_abort(self._get_output_handler())
+        if partial_abort is None:
+            return
+        try:
+            partial_abort(input_step_datas=self.input_step_datas, step_data=step_data,
+                          config=self.automata_global_config)
+        except Exception as e:
+            self.config.logger.warning('Partial output clean up failed on {}: {}'.format(self.automata_config.get_id(), e))
+
+    # Work group for a map or reduce step's calls, within the quota of the
+    # group the step runs in; steps run by a remote worker get their own
+    def _get_fan_out_group(self, kind: str, max_parallelism: int) -> WorkGroup:
+        executor = FairShareExecutor.get_instance(self.config)
+        parent = executor.get_current_group() or executor.root
+        return parent.group('{} {}'.format(kind, self.automata_config.get_id()), max_parallelism)
+    
+    # Run the map op on each element of the upstream collection, at most
+    # max_parallelism at a time, and gather the element outputs in order: a
+    # list on `data` for list collections, an object keyed like the input for
+    # object collections
+    def _map(self) -> None:
+        config: AutomataMapConfig = self.automata_config
+        collection = self._get_collection(config.map_input, 'map_input')
+        items = list(collection.items()) if isinstance(collection, dict) else list(enumerate(collection))
+        input_data = self.step_data.input_data if isinstance(self.step_data.input_data, dict) else \
+            {NativeHandler.DATA_KEY: self.step_data.input_data}
+        def map_item(key, item) -> StepData:
+            # Elements share the step's input data rather than copying it
+            step_data = dataclasses.replace(self.step_data, input_data=input_data | {
+                NativeHandler.ITEM_KEY: item, NativeHandler.ITEM_KEY_KEY: key})
+            if config.map_op == Ops.GENERATE:
+                return self._generate(step_data, deep_copy=False)
+            return self._process_data(self._get_output_handler(), step_data)
+        results: list[StepData] = [None] * len(items)
+        if len(items) > 0:
+            executor = self._get_fan_out_group('map', config.max_parallelism)
+            futures = {executor.submit(map_item, key, item): index for index, (key, item) in enumerate(items)}
+            try:
+                for future in executor.as_completed(futures):
+                    results[futures[future]] = future.result()
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                executor.wait(futures)
+                raise
+        outputs = [result.output_data for result in results]
+        self.step_data.output_data = {NativeHandler.DATA_KEY: dict(zip(collection.keys(), outputs)) 
+                                      if isinstance(collection, dict) else outputs}
+        self.step_data.text = '\n'.join(result.text for result in results if result.text)
+        failures = {str(key): result.failure_data for (key, _), result in zip(items, results) 
+                    if result.failure_data is not None}
+        if len(failures) > 0:
+            self.step_data.failure_data = {'stage': 'map', 'items': failures}
+        self.step_data.success = all(result.success != False for result in results)
+    
+    # Merge the inputs in groups of fan_in, level by level with up to
+    # max_parallelism merges at once, until a single output is left
+    def _reduce(self) -> None:
+        config: AutomataReduceConfig = self.automata_config
+        if config.reduce_input is not None:
+            collection = self._get_collection(config.reduce_input, 'reduce_input')
+            values = list(collection.values()) if isinstance(collection, dict) else list(collection)
+        else:
+            values = [step_data.output_data for step_data in self.input_step_datas or [] 
+                      if step_data.output_data is not None]
+        input_data = self.step_data.input_data if isinstance(self.step_data.input_data, dict) else \
+            {NativeHandler.DATA_KEY: self.step_data.input_data}
+        handler = config.output_handler if config.output_handler else \
+            NativeHandler.get_handler_prefix() + NativeHandler.DEFAULT_REDUCE_HANDLER
+        def merge(group: list) -> StepData:
+            step_data = dataclasses.replace(self.step_data, input_data=input_data | {NativeHandler.ITEMS_KEY: group})
+            if config.reduce_op == Ops.GENERATE:
+                return self._generate(step_data, deep_copy=False)
+            return self._process_data(handler, step_data)
+        levels = 0
+        executor = self._get_fan_out_group('reduce', config.max_parallelism)
+        while True:
+            groups = [values[i:i + config.fan_in] for i in range(0, len(values), config.fan_in)] or [[]]
+            results: list[StepData] = list(executor.map(merge, groups))
+            levels += 1
+            failed = next((result for result in results if result.success == False), None)
+            if failed is not None:
+                self.step_data.output_data = failed.output_data
+                self.step_data.failure_data = {'stage': 'reduce', 'level': levels, 'merge': failed.failure_data}
+                self.step_data.success = False
+                return
+            values = [result.output_data for result in results]
+            if len(values) == 1:
+                break
+        self.config.logger.debug('Reduced {} in {} levels'.format(self.automata_config.get_id(), levels))
+        self.step_data.output_data = results[0].output_data
+        self.step_data.text = results[0].text
+    
+    # The list or object a map or reduce step's selector resolves to, among
+    # the step's input step datas
+    def _get_collection(self, selector: InputSelector, field: str) -> dict | list:
+        input_step_datas = self.input_step_datas or []
+        id = self.automata_config.get_id()
+        if selector is None:
+            if len(input_step_datas) != 1:
+                raise Exception('Step {} has {} upstream steps, set {} to select the one to use'.format(
+                    id, len(input_step_datas), field))
+            source = input_step_datas[0]
+        else:
+            source = next((step_data for step_data in input_step_datas 
+                           if step_data.automata_id in (selector.id, selector.get_key())), None)
+            if source is None:
+                raise Exception('The {} {} of step {} has no output data'.format(field, selector.id, id))
+        collection = InputProjection.resolve(source.output_data, InputProjection.parse_path(selector.path if selector else None)) \
+            if source.output_data is not None else None
+        if not isinstance(collection, (dict, list)):
+            raise Exception('The {} of step {} is {}, not a list or object'.format(field, id, type(collection).__name__))
+        return collection
         
 class AutomataGraph:
-    def __init__(self, dependencies: AutomataDependencies):
+    # If a compiled artifact is provided, validation and DAG construction are
+    # skipped and the precomputed structure is restored instead
+    def __init__(self, dependencies: AutomataDependencies, compiled: CompiledAutomata = None):
         self.dependencies = dependencies
         self.config = dependencies.config
         self.automata_configs = dependencies.automata_configs
         self.sapient = dependencies.sapient
         self.graph_data = dependencies.graph_data
-        
+        self.latency_stats = dependencies.latency_stats
+        # Latencies are kept per graph version
+        self.source_hash: str = compiled.source_hash if compiled is not None else ''
+
         self.max_workers: int = self.config.conf.max_workers
+        # Steps run on the process-wide executor, at most max_workers of the
+        # run's at once, and subgraphs within their own caps
+        self.work_groups: dict[str, WorkGroup] = {RESERVED_ROOT_ID: FairShareExecutor.get_instance(self.config).session(
+            str(dependencies.session_id), self.max_workers, dependencies.priority)}
         self.subgroups: dict[str, list[Automata]] = {}
         self.root_group: list[Automata] = []
         self.automatons: list[Automata] = []
         self.graphs: dict[str, DiGraph] = {}
+        # Topologically sorted generations per graph, in reverse execution order
+        self.generations: dict[str, list[list[str]]] = {}
+        # Per graph, the generation executed immediately before each node's
+        self.previous_generations: dict[str, dict[str, list[str]]] = {}
+        # The nodes that need each node
+        self.downstream: dict[str, list[str]] = {}
+        # Per node, the nodes of its own graph it needs directly or not; only
+        # built to validate input selectors
+        self.ancestors: dict[str, frozenset[str]] = None
         for automata_config in self.automata_configs:
             self.automatons.append(Automata(automata_config, dependencies))
         self.automatons_dict: dict[str, Automata] = {a.automata_config.get_id(): a for a in self.automatons}
         self.abort: bool = False
-        self._validate_and_build()
+        # Socket steps of the run waiting on their input, cancelled if it aborts
+        self.socket_waits: set[concurrent.futures.Future] = set()
+        self.socket_waits_lock = threading.Lock()
+        if compiled is not None:
+            self._restore(compiled)
+        else:
+            self._validate_and_build()
+        # Created up front, as subgraphs can start concurrently
+        for graph_id in self.generations.keys():
+            self._get_work_group(graph_id)
+    
+    def _restore(self, compiled: CompiledAutomata) -> None:
+        self.root_group = [self.automatons_dict[id] for id in compiled.root_group]
+        self.subgroups = {graph_id: [self.automatons_dict[id] for id in ids] 
+                          for graph_id, ids in compiled.subgroups.items()}
+        self.generations = compiled.generations
+        self._index_generations()
+    
+    def _index_generations(self) -> None:
+        self.downstream = {automata.automata_config.get_id(): [] for automata in self.automatons}
+        for automata in self.automatons:
+            for upstream_id in automata.automata_config.needs:
+                if upstream_id in self.downstream:
+                    self.downstream[upstream_id].append(automata.automata_config.get_id())
+        for automata in self.automatons:
+            config = automata.automata_config
+            automata.streams_output = config.op == Ops.GENERATE and (config.stream_output == True or \
+                any(self.automatons_dict[id].automata_config.stream_inputs for id in self.downstream[config.get_id()]))
+        for graph_id, generations in self.generations.items():
+            previous: dict[str, list[str]] = {}
+            last_generation: list[str] = []
+            for id_list in reversed(generations):
+                for id in id_list:
+                    previous[id] = last_generation
+                last_generation = id_list
+            self.previous_generations[graph_id] = previous
 
-    def _evaluate_automatons_state(self)-> None:
+    # Only the automatons that just ran can have changed state; failures in
+    # other groups are surfaced through the abort flag
+    def _evaluate_automatons_state(self, automatons: list[Automata])-> None:
         failed_automata: list = []
         if self.abort == False:
-            for automata in self.automatons:
+            for automata in automatons:
                 if automata.state == AutomataState.ERROR:
                     self.abort = True
                     failed_automata.append(automata.automata_config.get_id())
         if self.abort == True:
+            self._cancel_socket_waits()
             if len(failed_automata) > 0:
                 error_message = "Error state detected in automata {}, aborting graph execution".format(
                     ", ".join(failed_automata))
@@ -232,44 +584,93 @@ class AutomataGraph:
             self.config.logger.error(error_message)
             raise Exception(error_message)
     
-    def _get_iteration_tree(self, iteration_tree: list[int], iteration: int) -> list[int]:
-        tree = copy.deepcopy(iteration_tree)
-        tree.append(iteration)
-        return tree
+    # Estimate each node's remaining critical path, its own expected latency
+    # plus that of the slowest chain downstream of it, from the latency stats.
+    # Generations are stored downstream first, so each node's successors are
+    # already estimated when it is reached
+    def _estimate_critical_paths(self, graph_id: str) -> None:
+        critical_paths: dict[str, float] = {}
+        for id_list in self.generations[graph_id]:
+            for id in id_list:
+                automata = self.automatons_dict[id]
+                downstream = [critical_paths[d] for d in self.downstream.get(id, []) if d in critical_paths]
+                automata.critical_path = self.latency_stats.estimate(id, automata.automata_config.op.value, self.source_hash) + \
+                    (max(downstream) if len(downstream) > 0 else 0.0)
+                critical_paths[id] = automata.critical_path
     
-    def _get_previous_generation(self, graph: DiGraph, id: str) -> list[str]:
-        generations: list = [sorted(generation) for generation in 
-                             topological_generations(graph)]
-        last_generation: set[str] = []
-        while len(generations) > 0:
-            id_list = generations.pop()
-            if id in id_list:
-                return last_generation
-            last_generation = id_list
-        return []
+    def _get_iteration_tree(self, iteration_tree: tuple[int, ...], iteration: int) -> tuple[int, ...]:
+        return tuple(iteration_tree) + (iteration,)
+    
+    def _get_previous_generation(self, graph_id: str, id: str) -> list[str]:
+        return self.previous_generations[graph_id].get(id, [])
             
-    def _set_input_for_iteration(self, initial_input: str, graph: DiGraph, 
-                                 automata: Automata, iteration_tree: list[int], 
+    def _set_input_for_iteration(self, initial_input: str, graph_id: str, 
+                                 automata: Automata, iteration_tree: tuple[int, ...], 
                                  iteration: int) -> None:
         # if automata.automata_config.automata_type == AutomataType.GRAPH:
         #     last_data = self.graph_data
-        parents = self._get_previous_generation(graph, automata.automata_config.get_id())
+        if automata.automata_config.inputs:
+            # Selected nodes are in this graph or one enclosing it, and ran in
+            # the current iteration of the graph they're in
+            tree = self._get_iteration_tree(iteration_tree, iteration)
+            automata_step_data = InputProjection.project(
+                self.graph_data, automata.automata_config.inputs,
+                [tree[:length] for length in range(len(tree), 0, -1)],
+                str(self.dependencies.session_id))
+            automata.set_input_datas(automata_step_data, initial_input)
+            return
+        parents = self._get_previous_generation(graph_id, automata.automata_config.get_id())
         lookup_dict = {}
         
         for parent in parents:
             lookup_dict[parent] = self._get_iteration_tree(iteration_tree, iteration)
-        automata_step_data = self.graph_data.fetch_datas(lookup_dict)
+        if not automata.awaits_execution() and \
+            automata._get_input_handler() == NativeHandler.get_handler_prefix() + NativeHandler.DEFAULT_INPUT_HANDLER:
+            # Nodes that pass their input through only reference the upstream
+            # data, which is copied once as the node's own output is stored
+            automata_step_data = [step_data for step_data in (self.graph_data.fetch_data_view(id, tree)
+                                                              for id, tree in lookup_dict.items()) if step_data is not None]
+        else:
+            automata_step_data = self.graph_data.fetch_datas(lookup_dict)
         # For subgraph steps with no input, use the data from the parent graph's node
         if not automata_step_data and automata.automata_config.parent_id is not None:
             automata_step_data = [self.graph_data.fetch_data(automata.automata_config.parent_id, iteration_tree)]
         automata.set_input_datas(automata_step_data, initial_input)
 
+    # Runs the graph's generations, retrying a subgraph from its first
+    # generation, up to its max_iterations, when a step in it fails. Retries
+    # loop here rather than recurse, and only the generation that ran last is
+    # held on to, so long retry loops run in constant stack and memory
     def run_graph(self, iteration: int = 0, 
-                  iteration_tree: list[int] = [], graph_id: str = RESERVED_ROOT_ID, 
+                  iteration_tree: tuple[int, ...] = (), graph_id: str = RESERVED_ROOT_ID, 
                   initial_input: str = None) -> list[Automata]:
-        graph: DiGraph = self.graphs[graph_id]
-        generations: list = [sorted(generation) for generation in 
-                             topological_generations(graph)]
+        max_iterations = self.automatons_dict[graph_id].automata_config.max_iterations \
+            if graph_id != RESERVED_ROOT_ID else 0
+        # Workers reach the run's graph data for as long as it runs
+        if graph_id == RESERVED_ROOT_ID:
+            self.dependencies.dispatcher.register_session(str(self.dependencies.session_id), self.graph_data)
+        try:
+            while True:
+                can_retry = max_iterations > 0 and iteration + 1 <= max_iterations
+                automatons, retry, initial_input = self._run_generations(
+                    iteration, iteration_tree, graph_id, initial_input, can_retry)
+                if not retry:
+                    break
+                iteration += 1
+        finally:
+            if graph_id == RESERVED_ROOT_ID:
+                self.dependencies.dispatcher.unregister_session(str(self.dependencies.session_id))
+        if graph_id == RESERVED_ROOT_ID:
+            self.latency_stats.save()
+        return automatons
+    
+    # One pass over the graph's generations. Returns the last generation run,
+    # whether the pass failed and should be retried, and the initial input for
+    # the retry, which is only still set if the first generation failed
+    def _run_generations(self, iteration: int, iteration_tree: tuple[int, ...], graph_id: str,
+                         initial_input: str, can_retry: bool) -> tuple[list[Automata], bool, str]:
+        generations: list = list(self.generations[graph_id])
+        self._estimate_critical_paths(graph_id)
         automatons: list[Automata] = []
         # TODO - reset enabled/disabled status for au
         stop = False
@@ -279,125 +680,263 @@ class AutomataGraph:
             for id in id_list:
                 automata: Automata = self.automatons_dict[id]
                 self._set_input_for_iteration(
-                        initial_input, graph, automata,
+                        initial_input, graph_id, automata,
                         iteration_tree, iteration
                     )
                 automatons.append(automata)
+            for automata in self._pull_streaming_steps(generations, id_list):
+                self._set_input_for_iteration(
+                        initial_input, graph_id, automata,
+                        iteration_tree, iteration
+                    )
+                automatons.append(automata)
+            for automata in automatons:
+                self.dependencies.partial_outputs.open(automata.automata_config.get_id())
             self._execute_generation(automatons, iteration, iteration_tree, id, graph_id)
             for automaton in automatons:
                 if automaton.step_data.success == False:
                     stop = True
-            if stop == True and graph_id != RESERVED_ROOT_ID:
-                iteration += 1
-                graph_automaton_config = self.automatons_dict[graph_id].automata_config
-                if graph_automaton_config.max_iterations > 0 and \
-                    iteration <= graph_automaton_config.max_iterations:
-                    return self.run_graph(iteration, iteration_tree, graph_id, initial_input)
+            if stop == True and graph_id != RESERVED_ROOT_ID and can_retry:
+                return automatons, True, initial_input
             for automaton in automatons:
                 if automaton.automata_config.automata_type == AutomataType.GRAPH:
                     self._reset_graph_enablement(graph_id)
                     
                     pass
             initial_input = None
-        return automatons
+        return automatons, False, None
+    
+    def _record_memory_breach(self) -> None:
+        memory_account = self.graph_data.get_memory_account()
+        if memory_account is not None:
+            memory_account.record_breach()
+    
+    # Steps of the next generation that stream their inputs start with the
+    # generation they need, unless one of those is a subgraph, which only has
+    # output once it has run, or a socket step, which could leave them holding
+    # every worker while it waits for input
+    def _pull_streaming_steps(self, generations: list[list[str]], id_list: list[str]) -> list[Automata]:
+        if len(generations) == 0:
+            return []
+        pulled = []
+        for id in generations[-1]:
+            automata = self.automatons_dict[id]
+            upstream_configs = [self.automatons_dict[upstream_id].automata_config 
+                                for upstream_id in automata.automata_config.needs if upstream_id in id_list]
+            if automata.automata_config.stream_inputs and not any(
+                config.socket or config.automata_type == AutomataType.GRAPH for config in upstream_configs):
+                pulled.append(automata)
+        if len(pulled) > 0:
+            # The generation lists are shared with self.generations, so replace rather than modify
+            remaining = [id for id in generations[-1] if not self.automatons_dict[id] in pulled]
+            if len(remaining) > 0:
+                generations[-1] = remaining
+            else:
+                generations.pop()
+        return pulled
     
     def _execute_generation(self, automatons: list[Automata], iteration: int, 
-                            iteration_tree: list[int], id: str, graph_id: str):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            subgraph_futures = []
-            tree = self._get_iteration_tree(iteration_tree, iteration)
-            self._evaluate_automatons_state()
-            futures = []
-            for automata in automatons:
-                futures.append(executor.submit(automata.invoke))
-            for future in concurrent.futures.as_completed(futures):
+                            iteration_tree: tuple[int, ...], id: str, graph_id: str):
+        executor = self._get_work_group(graph_id)
+        subgraph_futures = []
+        tree = self._get_iteration_tree(iteration_tree, iteration)
+        self._evaluate_automatons_state(automatons)
+        futures: dict[concurrent.futures.Future, Automata] = {}
+        # When there are more ready steps than workers, start the ones with
+        # the longest estimated chain ahead of them first
+        for automata in sorted(automatons, key=lambda automata: automata.critical_path, reverse=True):
+            if not automata.awaits_execution():
+                # Disabled and pass-through nodes only hand their input on,
+                # which is done here rather than as a task
+                automata.invoke()
+                self.dependencies.partial_outputs.complete(automata.automata_config.get_id())
+            elif automata.awaits_socket_input():
+                futures[self._invoke_after_socket_input(executor, automata)] = automata
+            else:
+                futures[self.dependencies.dispatcher.dispatch(automata, executor)] = automata
+        try:
+            for future in executor.as_completed(futures):
+                # Releases steps reading this one's partial output, whether or not it streamed
+                self.dependencies.partial_outputs.complete(futures[future].automata_config.get_id())
                 future.result()
-            for automata in automatons:
-                automata.step_data.iteration_tree = tree
-                if isinstance(automata.step_data.input_data, dict) and \
-                    NativeHandler.GRAPH_DATA_KEY in automata.step_data.input_data:
-                    automata.step_data.input_data.pop(NativeHandler.GRAPH_DATA_KEY)
-                if isinstance(automata.step_data.output_data, dict) and \
-                 NativeHandler.STEP_ENABLEMENT_GRAPH_KEY in automata.step_data.output_data:
-                    self._set_graph_enablement(automata.step_data.output_data[NativeHandler.STEP_ENABLEMENT_GRAPH_KEY],
-                                              graph_id)
-                self.graph_data.put_data(copy.deepcopy(automata.step_data))
-            self._evaluate_automatons_state()
-            for automata in automatons:
-                if automata.automata_config.automata_type == AutomataType.GRAPH:
-                    def execute_subgraph():
-                        iteration_tree_copy = copy.deepcopy(iteration_tree)
-                        iteration_tree_copy.append(iteration)
-                        iteration_copy = iteration + 1
-                        return self.run_graph(iteration_copy, iteration_tree_copy, automata.automata_config.get_id())
-                    subgraph_futures.append(executor.submit(execute_subgraph))
-            for future in concurrent.futures.as_completed(subgraph_futures):
-                    future.result()
+                # The generation fails with it, so siblings don't wait on input for nothing
+                if futures[future].state == AutomataState.ERROR:
+                    self._cancel_socket_waits()
+        except Exception:
+            # The rest of the generation still finishes before the graph aborts
+            self._cancel_socket_waits()
+            executor.wait(futures)
+            raise
+        for automata in automatons:
+            # Subgraph nodes are timed with their subgraph, below
+            if automata.duration is not None and automata.automata_config.automata_type != AutomataType.GRAPH:
+                self.latency_stats.record(automata.automata_config.get_id(), automata.duration, self.source_hash)
+            automata.step_data.iteration_tree = tree
+            if isinstance(automata.step_data.input_data, dict) and \
+                NativeHandler.GRAPH_DATA_KEY in automata.step_data.input_data:
+                automata.step_data.input_data.pop(NativeHandler.GRAPH_DATA_KEY)
+            if isinstance(automata.step_data.output_data, dict) and \
+             NativeHandler.STEP_ENABLEMENT_GRAPH_KEY in automata.step_data.output_data:
+                self._set_graph_enablement(automata.step_data.output_data[NativeHandler.STEP_ENABLEMENT_GRAPH_KEY],
+                                          graph_id)
+            if automata.step_data.failure_data is not None and \
+                automata.step_data.failure_data.get('stage', None) == 'memory':
+                self._record_memory_breach()
+            step_data = copy.deepcopy(automata.step_data)
+            try:
+                self.graph_data.put_data(step_data)
+            except MemoryBudgetException as e:
+                # Over the session budget: the step fails, and isn't stored
+                self.config.logger.error(e)
+                automata.fail_over_budget(e)
+                step_data = copy.deepcopy(automata.step_data)
+            for step_listener in self.dependencies.step_listeners:
+                step_listener(step_data)
+        self._evaluate_automatons_state(automatons)
+        def execute_subgraph(automata: Automata):
+            started = time.perf_counter()
+            iteration_copy = iteration + 1
+            result = self.run_graph(iteration_copy, tree, automata.automata_config.get_id())
+            self.latency_stats.record(automata.automata_config.get_id(),
+                                      (automata.duration or 0.0) + time.perf_counter() - started, self.source_hash)
+            return result
+        for automata in sorted(automatons, key=lambda automata: automata.critical_path, reverse=True):
+            if automata.automata_config.automata_type != AutomataType.GRAPH:
+                continue
+            # A disabled subgraph node is bypassed along with everything in its
+            # subgraph, none of which is scheduled
+            if automata.enabled == False:
+                self.config.logger.debug('Skipping disabled subgraph {}'.format(automata.automata_config.get_id()))
+                continue
+            subgraph_futures.append(executor.submit(execute_subgraph, automata))
+        try:
+            for future in executor.as_completed(subgraph_futures):
+                future.result()
+        except Exception:
+            executor.wait(subgraph_futures)
+            raise
+    
+    # The work group of a graph's steps and subgraphs, a subgroup of the
+    # group of the graph the subgraph node is in
+    def _get_work_group(self, graph_id: str) -> WorkGroup:
+        work_group = self.work_groups.get(graph_id, None)
+        if work_group is None:
+            config = self.automatons_dict[graph_id].automata_config
+            parent_id = config.parent_id if config.parent_id is not None else RESERVED_ROOT_ID
+            work_group = self._get_work_group(parent_id).group(graph_id, config.max_workers or 0)
+            self.work_groups[graph_id] = work_group
+        return work_group
+    
+    # Park a step on the event loop until its socket input arrives, and only
+    # then hand it to the pool, so steps waiting on a human don't pin workers
+    def _invoke_after_socket_input(self, executor: concurrent.futures.Executor,
+                                   automata: Automata) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        def on_invoked(invoke_future: concurrent.futures.Future):
+            if invoke_future.exception() is not None:
+                future.set_exception(invoke_future.exception())
+            else:
+                future.set_result(invoke_future.result())
+        def on_input(input_future: concurrent.futures.Future):
+            with self.socket_waits_lock:
+                self.socket_waits.discard(input_future)
+            if input_future.cancelled():
+                automata.socket_error = Exception('Waiting on socket input was cancelled')
+            elif input_future.exception() is not None:
+                automata.socket_error = input_future.exception()
+            executor.submit(automata.invoke).add_done_callback(on_invoked)
+        input_future = BackgroundEventLoop.get_instance().run(automata.areceive_socket_input())
+        with self.socket_waits_lock:
+            self.socket_waits.add(input_future)
+        # The run may have aborted since this generation started
+        if self.abort:
+            input_future.cancel()
+        input_future.add_done_callback(on_input)
+        return future
+
+    # Stop waiting on socket input once the run fails; the steps then fail too
+    def _cancel_socket_waits(self) -> None:
+        with self.socket_waits_lock:
+            waits = list(self.socket_waits)
+        for input_future in waits:
+            input_future.cancel()
     
     def _reset_graph_enablement(self, graph_id: str):
         graph_automatons = self.subgroups[graph_id] if graph_id != RESERVED_ROOT_ID else self.root_group
         for automaton in graph_automatons:
-            automaton.automata_config.enabled = automaton.automata_config.initial_enabled_state
+            automaton.enabled = automaton.automata_config.initial_enabled_state
         pass
     def _set_graph_enablement(self, graph_enablement: dict[str, bool], graph_id: str):
-        graph_automatons = self.subgroups[graph_id] if graph_id == RESERVED_ROOT_ID else self.root_group
+        # Steps can only toggle nodes in the graph they belong to
+        parent_id = graph_id if graph_id != RESERVED_ROOT_ID else None
         for step_id, enabled in graph_enablement.items():
-            for automaton in graph_automatons:
-                if automaton.automata_config.get_id() == step_id:
-                    if len(automaton.automata_config.needs) > 1:
-                        raise Exception('Cannot change the enablement status of a graph node with multiple upstream tasks')
-                    automaton.automata_config.enabled = enabled
-        pass
+            automaton = self.automatons_dict.get(step_id, None)
+            if automaton is None or automaton.automata_config.parent_id != parent_id:
+                continue
+            if len(automaton.automata_config.needs) > 1:
+                raise Exception('Cannot change the enablement status of a graph node with multiple upstream tasks')
+            automaton.enabled = enabled
     
-    def _check_if_handler_exists(self, handler_type: str, handler: str, errors: list) -> bool:
+    def _check_if_handler_exists(self, handler_type: str, handler: str, errors: list, 
+                                 prefixes: tuple[str] = None) -> bool:
         if handler:
-            exists = False
-            for cls in Handler.__subclasses__():
-                prefix = cls.get_handler_prefix()
-                if handler.startswith(prefix):
-                    exists = True
-                    break
-            if NativeHandler.format_handler('', handler) in NativeHandler.CALLBACKS.keys():
+            if prefixes is None:
+                prefixes = tuple(cls.get_handler_prefix() for cls in Handler.__subclasses__())
+            exists = handler.startswith(prefixes)
+            if NativeHandler.format_handler('', handler) in NativeHandler.CALLBACKS:
                 exists = True
             if exists == False: 
                 errors.append('The {} was not found registered with the runtime, or as a scripting handler prefix: {}'.format(handler_type, handler))
             
+    def _check_collection_step(self, kind: str, op: Ops, selector: InputSelector, 
+                               config: AutomataMapConfig | AutomataReduceConfig, errors: list[str]) -> None:
+        if op not in (Ops.GENERATE, Ops.DATA_PROCCESS):
+            errors.append('{} step "{}" can only run GENERATE or DATA_PROCCESS ops'.format(kind, config.get_id()))
+        if config.max_parallelism < 1:
+            errors.append('{} step "{}" needs a max_parallelism of at least 1'.format(kind, config.get_id()))
+        if selector is not None:
+            if not selector.id in config.needs and not any(
+                selector.id in (input.id, input.get_key()) for input in config.inputs or []):
+                errors.append('{} input "{}" of "{}" is not one of its inputs'.format(kind, selector.id, config.get_id()))
+            try:
+                InputProjection.parse_path(selector.path)
+            except Exception as e:
+                errors.append(str(e))
+    
+    # All lookups below are against sets and dicts, so validation and 
+    # construction stay linear in the number of nodes and edges
     def _validate_and_build(self):
         ids: list[str] = [a.automata_config.get_id() for a in self.automatons]
-        dups = set([x for x in ids if ids.count(x) > 1])
+        id_set: set[str] = set(ids)
+        dups = set()
+        if len(id_set) != len(ids):
+            dups = {id for id, count in Counter(ids).items() if count > 1}
+        prefixes = tuple(cls.get_handler_prefix() for cls in Handler.__subclasses__())
         
         errors = []
         if len(dups) > 0:
            errors.append('One or more duplicate IDs were found in the graph; this may mask additional errors until duplicates are eliminated: {}'.format(dups))
-        if RESERVED_ROOT_ID in ids:
+        if RESERVED_ROOT_ID in id_set:
             errors.append('{} is a reserved ID for the root of the graph, please choose another name/id'.format(RESERVED_ROOT_ID))
         for automata in self.automatons:
-            config = automata.automata_config 
-            if config.enabled == False and len(config.needs) > 1:
-                errors.append('Graph steps with multiple inputs cannot be disabled')
-            if isinstance(config, AutomataGeneratorConfig):
-                self._check_if_handler_exists('system prompt handler', config.system_prompt_handler, errors)
-                self._check_if_handler_exists('user prompt handler', config.user_prompt_handler, errors)
-            if isinstance(config, AutomataDataProcessorConfig):
-                self._check_if_handler_exists('input handler', config.input_handler, errors)
-                self._check_if_handler_exists('output handler', config.output_handler, errors)
+            errors += self._validate_node(automata, id_set, prefixes)
             parent_id = automata.automata_config.parent_id
             if parent_id != None:
-                if not parent_id in ids:
-                    errors.append('Automata subgraph reference "{}" not found in ids {}'.format(parent_id, ids))
+                if not parent_id in id_set:
+                    errors.append('Automata subgraph reference "{}" not found in graph'.format(parent_id))
                 else:
                     if parent_id == automata.automata_config.get_id():
                         errors.append('Circular reference found in subgraph node: "{}"'.format(parent_id))
                     # Populate subgroups if they pass basic validation
-                    if not parent_id in self.subgroups.keys():
+                    if not parent_id in self.subgroups:
                         self.subgroups[parent_id] = []
                     self.subgroups[parent_id].append(automata)
             # If this is part of the root graph, append it here
             else:
                 self.root_group.append(automata)
             for id in automata.automata_config.needs:
-                if not id in ids:
-                    errors.append('Automata upstream reference "{}" not found in ids {}'.format(id, ids))
+                if not id in id_set:
+                    errors.append('Automata upstream reference "{}" not found in graph'.format(id))
                 if id == automata.automata_config.get_id():
                     errors.append('Circular reference found in node: "{}"'.format(id))
 
@@ -407,9 +946,10 @@ class AutomataGraph:
                 errors.append('Subgraph {} was not defined as a graph. Set the automata_type to "GRAPH"'.format(key))
         
         errors = errors + self._build_graphs()
+        self._index_generations()
+        errors += self._check_selectors_upstream(self.automatons)
         # TODO - need to figure out how to detect circular references between subgraphs
-        if len(errors) > 0:
-            raise Exception("The following errors were found in the graph configuration: \n\t - " + "\n\t - ".join(errors))
+        self._raise_errors(errors)
         # for k, v in self.graphs.items():
         #     print('graph: ' + k)
         #     print('dag: {}'.format(v))
@@ -418,23 +958,116 @@ class AutomataGraph:
         #     print('trans red: {}' .format(antichains(v)))
         #     print('lex sort: {}' .format(lexicographical_topological_sort(v)))
 
+    # Validate the nodes with these IDs on their own, for nodes that changed
+    # without changing the graph's structure, which was validated before
+    def validate_nodes(self, ids: Iterable[str]) -> None:
+        id_set: set[str] = set(self.automatons_dict.keys())
+        prefixes = tuple(cls.get_handler_prefix() for cls in Handler.__subclasses__())
+        errors = []
+        for id in ids:
+            errors += self._validate_node(self.automatons_dict[id], id_set, prefixes)
+        errors += self._check_selectors_upstream([self.automatons_dict[id] for id in ids])
+        self._raise_errors(errors)
+
+    # The checks that only depend on the node itself and the IDs in the graph
+    def _validate_node(self, automata: Automata, id_set: set[str], prefixes: tuple[str]) -> list[str]:
+        errors = []
+        config = automata.automata_config 
+        if config.enabled == False and len(config.needs) > 1:
+            errors.append('Graph steps with multiple inputs cannot be disabled')
+        if config.stream_inputs and (config.socket or config.automata_type == AutomataType.GRAPH):
+            errors.append('Socket steps and subgraphs cannot stream their inputs: "{}"'.format(config.get_id()))
+        if isinstance(config, AutomataGeneratorConfig):
+            self._check_if_handler_exists('system prompt handler', config.system_prompt_handler, errors, prefixes)
+            self._check_if_handler_exists('user prompt handler', config.user_prompt_handler, errors, prefixes)
+        if isinstance(config, AutomataDataProcessorConfig):
+            self._check_if_handler_exists('input handler', config.input_handler, errors, prefixes)
+            self._check_if_handler_exists('output handler', config.output_handler, errors, prefixes)
+            if config.output_schema is not None:
+                errors += ['Output schema of "{}" is invalid: {}'.format(config.get_id(), error)
+                           for error in JsonSchemaValidator.check_schema(config.output_schema)]
+        if isinstance(config, AutomataMapConfig):
+            self._check_collection_step('Map', config.map_op, config.map_input, config, errors)
+        if isinstance(config, AutomataReduceConfig):
+            self._check_collection_step('Reduce', config.reduce_op, config.reduce_input, config, errors)
+            if config.fan_in < 2:
+                errors.append('Reduce step "{}" needs a fan_in of at least 2'.format(config.get_id()))
+        for selector in automata.automata_config.inputs or []:
+            if not selector.id in id_set:
+                errors.append('Automata input selector reference "{}" not found in graph'.format(selector.id))
+            try:
+                InputProjection.parse_path(selector.path)
+            except Exception as e:
+                errors.append(str(e))
+        return errors
+
+    # Checked once the graphs are built, against ancestor sets built once
+    def _check_selectors_upstream(self, automatons: list[Automata]) -> list[str]:
+        errors = []
+        ancestors = self._get_ancestors()
+        for automata in automatons:
+            config = automata.automata_config
+            # Nodes in graphs with cycles have no ancestors, and the cycle is reported
+            if config.get_id() not in ancestors:
+                continue
+            for selector in config.inputs or []:
+                if selector.id in self.automatons_dict and not self._is_upstream(selector.id, automata):
+                    errors.append('Automata input selector reference "{}" of "{}" is not upstream of it'.format(
+                        selector.id, config.get_id()))
+        return errors
+
+    # Generations are stored downstream first, so walking them in reverse
+    # reaches each node's upstream nodes before it
+    def _get_ancestors(self) -> dict[str, frozenset[str]]:
+        if self.ancestors is None:
+            self.ancestors = {}
+            for generations in self.generations.values():
+                for id_list in reversed(generations):
+                    for id in id_list:
+                        ancestors: set[str] = set()
+                        for upstream_id in self.automatons_dict[id].automata_config.needs:
+                            ancestors.add(upstream_id)
+                            ancestors |= self.ancestors.get(upstream_id, frozenset())
+                        self.ancestors[id] = frozenset(ancestors)
+        return self.ancestors
+
+    # Whether the node `id` has run by the time `automata` starts: it's needed,
+    # directly or not, by `automata` or by any subgraph node enclosing it
+    def _is_upstream(self, id: str, automata: Automata) -> bool:
+        ancestors = self._get_ancestors()
+        current = automata.automata_config.get_id()
+        seen: set[str] = set()
+        while current in self.automatons_dict and current not in seen:
+            if id in ancestors.get(current, ()):
+                return True
+            seen.add(current)
+            current = self.automatons_dict[current].automata_config.parent_id
+        return False
+
+    def _raise_errors(self, errors: list[str]) -> None:
+        if len(errors) > 0:
+            raise Exception("The following errors were found in the graph configuration: \n\t - " + "\n\t - ".join(errors))
+
     def _build_graph(self, name: str, automatons: list[Automata]) -> DiGraph:
+        import networkx
         graph = networkx.DiGraph(name=name)
-        for automata in automatons:
-            automata_config = automata.automata_config
-            id = automata_config.get_id()
-            graph.add_node(id)
-            for upstream_node in automata_config.needs:
-                graph.add_edge(id, upstream_node)
+        graph.add_nodes_from(automata.automata_config.get_id() for automata in automatons)
+        graph.add_edges_from((automata.automata_config.get_id(), upstream_node) 
+                             for automata in automatons 
+                             for upstream_node in automata.automata_config.needs)
         return graph
     
     def _build_graphs(self) -> list[str]:
+        import networkx
         errors = []
         self.graphs[RESERVED_ROOT_ID] = self._build_graph(RESERVED_ROOT_ID, self.root_group)
         for id, automatons in self.subgroups.items():
             self.graphs[id] = self._build_graph(RESERVED_ROOT_ID, automatons)
         for id, graph in self.graphs.items():
             if not networkx.is_directed_acyclic_graph(graph):
-                errors.append('Graph {} is not a DAG, please correct these cycle(s): '.format(id, 
+                errors.append('Graph {} is not a DAG, please correct these cycle(s): {}'.format(id, 
                     networkx.find_cycle(graph)))
+            else:
+                self.generations[id] = [sorted(generation) for generation in 
+                                        networkx.topological_generations(graph)]
         return errors
\ No newline at end of file
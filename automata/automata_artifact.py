@@ -0,0 +1,262 @@
+import hashlib
+import importlib.metadata
+import importlib.util
+import marshal
+import os
+import pickle
+import stat
+import sys
+import zlib
+from dataclasses import dataclass, field
+import orjson as json
+from automata.automata_config import AutomataConfig, AutomataConfigFactory, AutomataGeneratorConfig
+from config import Config
+from handler import Handler
+from native_handler import NativeHandler
+
+ARTIFACT_FORMAT_VERSION = 2
+
+@dataclass
+class CompiledAutomata:
+    """A validated, compiled graph that can be persisted and restored without
+    re-parsing the config file or re-running validation"""
+    source_hash: str
+    automata_global_config: dict
+    automata_configs: list[AutomataConfig]
+    # Graph structure, by automata ID
+    root_group: list[str]
+    subgroups: dict[str, list[str]]
+    generations: dict[str, list[list[str]]]
+    # Handler references used by the graph, to load only the backends needed
+    handler_refs: set[str] = field(default_factory=set)
+    # Prompt template source -> marshaled jinja2 code object
+    templates: dict[str, bytes] = field(default_factory=dict)
+    # Inline `py::` handler source -> marshaled restricted byte code
+    scripts: dict[str, bytes] = field(default_factory=dict)
+    # Hash of each node's config, in the order of automata_configs, to find
+    # the nodes a changed config file left as they were
+    node_hashes: list[str] = field(default_factory=list)
+
+    # Load the handler backends this graph needs, and seed their caches with
+    # the precompiled templates and scripts
+    def install(self) -> None:
+        Handler.load_handlers(self.handler_refs)
+        for source, code in self.templates.items():
+            if source not in NativeHandler.TEMPLATES:
+                NativeHandler.load_compiled_template(source, marshal.loads(code))
+        if len(self.scripts) > 0:
+            from py_handler import PyHandler
+            for source, code in self.scripts.items():
+                PyHandler.COMPILED.setdefault(source, marshal.loads(code))
+
+class AutomataArtifacts:
+    ARTIFACT_SUFFIX = '.automata'
+    # Under the user's cache home, e.g. ~/.cache/cras-sapien
+    DEFAULT_CACHE_FOLDER = 'cras-sapien'
+    DISABLED = 'off'
+    # Artifacts are unpickled, so they are only kept in a folder no other user
+    # can write to
+    FOLDER_MODE = 0o700
+    FILE_MODE = 0o600
+    # Engine modules whose source determines how a config is compiled
+    ENGINE_MODULES: list[str] = ['automata.automata', 'automata.automata_config', 'automata.automata_artifact',
+                                 'automata.input_projection', 'graph_data', 'handler']
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.logger = config.logger
+
+    def get_cache_folder(self) -> str | None:
+        folder = self.config.conf.artifact_cache_folder
+        if folder == self.DISABLED:
+            return None
+        if not folder:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            return os.path.join(cache_home, self.DEFAULT_CACHE_FOLDER)
+        return self.config.normalize_and_resolve_path(folder)
+
+    # The cache folder, created private to this user if it doesn't exist, or
+    # None if it can't be trusted: only a directory owned by this user that
+    # no one else can write to is used
+    def get_private_cache_folder(self) -> str | None:
+        folder = self.get_cache_folder()
+        if folder is None:
+            return None
+        try:
+            os.makedirs(folder, mode=self.FOLDER_MODE, exist_ok=True)
+            folder_stat = os.lstat(folder)
+        except OSError as e:
+            self.logger.warning('Could not create the graph artifact cache {}: {}'.format(folder, e))
+            return None
+        if not stat.S_ISDIR(folder_stat.st_mode) or not self.is_private(folder_stat):
+            self.logger.warning('Not using the graph artifact cache {}, it must be a directory owned by this user '
+                                'and not writable by others'.format(folder))
+            return None
+        return folder
+
+    @staticmethod
+    def is_private(file_stat: os.stat_result) -> bool:
+        owned = not hasattr(os, 'getuid') or file_stat.st_uid == os.getuid()
+        return owned and file_stat.st_mode & (stat.S_IWGRP | stat.S_IWOTH) == 0
+
+    # Hash the config file together with the sources of the engine and every
+    # handler backend that may be loaded for it, plus the interpreter and
+    # template engine versions that the marshaled code depends on
+    def compute_hash(self, config_source: bytes) -> str:
+        digest = hashlib.sha256()
+        digest.update(str(ARTIFACT_FORMAT_VERSION).encode())
+        digest.update(sys.implementation.cache_tag.encode())
+        try:
+            digest.update(importlib.metadata.version('jinja2').encode())
+        except importlib.metadata.PackageNotFoundError:
+            pass
+        digest.update(config_source)
+        modules = self.ENGINE_MODULES + sorted(set(Handler.HANDLER_MODULES.values()) |
+                                               set(NativeHandler.CALLBACK_MODULES.values()))
+        for module in modules:
+            spec = importlib.util.find_spec(module)
+            if spec is not None and spec.origin and os.path.isfile(spec.origin):
+                with open(spec.origin, 'rb') as f:
+                    digest.update(module.encode())
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    @staticmethod
+    def compute_node_hash(node: dict) -> str:
+        return hashlib.sha256(json.dumps(node, default=str, option=json.OPT_SORT_KEYS | json.OPT_NON_STR_KEYS)).hexdigest()
+
+    # What validation and DAG construction depend on beyond each node on its
+    # own: the nodes, in order, and how they connect
+    @staticmethod
+    def get_structure(automata_configs: list[AutomataConfig]) -> list[tuple]:
+        return [(automata_config.get_id(), automata_config.parent_id, tuple(automata_config.needs),
+                 automata_config.automata_type) for automata_config in automata_configs]
+
+    # Load a compiled graph for the config file at `path`, from the artifact
+    # cache if an artifact for the current source hash exists. Given the
+    # `previous` version of the graph, only the nodes changed since are compiled
+    def load(self, path: str, previous: CompiledAutomata = None) -> CompiledAutomata:
+        with open(path, 'rb') as f:
+            source_hash = self.compute_hash(f.read())
+        if previous is not None and previous.source_hash == source_hash:
+            return previous
+        compiled = self._read(source_hash)
+        if compiled is None:
+            compiled = self.compile(self.config.load_config_file(path), source_hash, previous)
+            self._write(compiled)
+        compiled.install()
+        return compiled
+
+    def compile(self, automata_config_dict: dict, source_hash: str = '', previous: CompiledAutomata = None) -> CompiledAutomata:
+        # Imported here, the engine module imports this one for type hints
+        from automata.automata import AutomataDependencies, AutomataGraph
+        nodes: list[dict] = automata_config_dict['automata']
+        node_hashes = [self.compute_node_hash(node) for node in nodes]
+        # Configs are immutable once parsed, so unchanged nodes share them with
+        # the previous version
+        reusable: dict[str, AutomataConfig] = dict(zip(previous.node_hashes, previous.automata_configs)) \
+            if previous is not None else {}
+        automata_configs: list[AutomataConfig] = [reusable[node_hash] if node_hash in reusable
+                                                  else AutomataConfigFactory(node).get_config()
+                                                  for node, node_hash in zip(nodes, node_hashes)]
+        automata_global_config = automata_config_dict.get('config', {})
+        dependencies = AutomataDependencies(self.config, automata_configs, None, None,
+                                            automata_global_config=automata_global_config)
+        if previous is not None and self.get_structure(automata_configs) == self.get_structure(previous.automata_configs):
+            # The structure is unchanged, so it's restored from the previous
+            # version and only the changed nodes are validated
+            graph = AutomataGraph(dependencies, previous)
+            graph.validate_nodes(automata_config.get_id() for automata_config, node_hash
+                                 in zip(automata_configs, node_hashes) if node_hash not in reusable)
+        else:
+            # Constructing the graph validates it and builds the DAGs
+            graph = AutomataGraph(dependencies)
+        compiled = CompiledAutomata(
+            source_hash=source_hash,
+            automata_global_config=automata_global_config,
+            automata_configs=automata_configs,
+            root_group=[a.automata_config.get_id() for a in graph.root_group],
+            subgroups={graph_id: [a.automata_config.get_id() for a in automatons]
+                       for graph_id, automatons in graph.subgroups.items()},
+            generations=graph.generations,
+            handler_refs=Handler.get_handler_refs(automata_configs),
+            node_hashes=node_hashes)
+        # Templates and scripts the previous version compiled are reused as they are
+        previous_templates = previous.templates if previous is not None else {}
+        previous_scripts = previous.scripts if previous is not None else {}
+        default_prompt_handlers = {
+            NativeHandler.get_handler_prefix() + NativeHandler.DEFAULT_SYSTEM_PROMPT_HANDLER,
+            NativeHandler.get_handler_prefix() + NativeHandler.DEFAULT_USER_PROMPT_HANDLER,
+        }
+        for automata in graph.automatons:
+            if not isinstance(automata.automata_config, AutomataGeneratorConfig):
+                continue
+            for handler, source in ((automata._get_system_prompt_handler(), automata._get_system_prompt()),
+                                    (automata._get_user_prompt_handler(), automata._get_user_prompt())):
+                if handler in default_prompt_handlers and source is not None:
+                    template = NativeHandler.normalize_prompt_template(source)
+                    if template not in compiled.templates:
+                        compiled.templates[template] = previous_templates[template] if template in previous_templates \
+                            else marshal.dumps(NativeHandler.compile_template(template))
+        for handler_ref in compiled.handler_refs:
+            if handler_ref.startswith('py::'):
+                from py_handler import PyHandler
+                script = Handler.format_handler(PyHandler.HANDLER_PREFIX, handler_ref)
+                compiled.scripts[script] = previous_scripts[script] if script in previous_scripts \
+                    else marshal.dumps(PyHandler.get_byte_code(script))
+        if previous is not None:
+            changed = sum(1 for node_hash in node_hashes if node_hash not in reusable)
+            self.logger.info('Recompiled {} of {} graph nodes, {} removed'.format(
+                changed, len(node_hashes), len(set(previous.node_hashes) - set(node_hashes))))
+        return compiled
+
+    def _get_artifact_path(self, source_hash: str) -> str | None:
+        folder = self.get_private_cache_folder()
+        if folder is None:
+            return None
+        return folder + '/' + source_hash + self.ARTIFACT_SUFFIX
+
+    def _read(self, source_hash: str) -> CompiledAutomata | None:
+        path = self._get_artifact_path(source_hash)
+        if path is None:
+            return None
+        try:
+            fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.warning('Could not open graph artifact {}: {}'.format(path, e))
+            return None
+        with os.fdopen(fd, 'rb') as f:
+            file_stat = os.fstat(f.fileno())
+            if not stat.S_ISREG(file_stat.st_mode) or not self.is_private(file_stat):
+                self.logger.warning('Ignoring graph artifact {}, it must be a file owned by this user '
+                                    'and not writable by others'.format(path))
+                return None
+            data = f.read()
+        try:
+            compiled: CompiledAutomata = pickle.loads(zlib.decompress(data))
+            if compiled.source_hash != source_hash:
+                return None
+            self.logger.debug('Loaded compiled graph artifact %s', path)
+            return compiled
+        except Exception as e:
+            # A corrupt or incompatible artifact is simply rebuilt
+            self.logger.warning('Discarding unreadable graph artifact {}: {}'.format(path, e))
+            return None
+
+    def _write(self, compiled: CompiledAutomata) -> None:
+        path = self._get_artifact_path(compiled.source_hash)
+        if path is None or not compiled.source_hash:
+            return
+        try:
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            if os.path.lexists(temp_path):
+                os.unlink(temp_path)
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_NOFOLLOW', 0), self.FILE_MODE)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(zlib.compress(pickle.dumps(compiled, protocol=pickle.HIGHEST_PROTOCOL)))
+            os.replace(temp_path, path)
+            self.logger.debug('Wrote compiled graph artifact %s', path)
+        except OSError as e:
+            self.logger.warning('Could not write graph artifact {}: {}'.format(path, e))
@@ -33,6 +33,10 @@ class Ops(Enum):
     GENERATE = "GENERATE"
     DATA_PROCCESS = "DATA_PROCCESS"
     PASSTHROUGH = "PASSTHROUGH"
+    # Runs a GENERATE or DATA_PROCCESS op once per element of an upstream collection
+    MAP = "MAP"
+    # Merges many upstream outputs in a tree of merge steps
+    REDUCE = "REDUCE"
     # TODO - rank, retrieve, other ops
 
 class AutomataType(Enum):
@@ -42,6 +46,23 @@ class AutomataType(Enum):
     # in the loopback handler and it returns true
     GRAPH = "GRAPH"
 
+@dataclass(kw_only=True)
+class InputSelector:
+    # Upstream automata ID to project output data from
+    id: str
+    # Optional JSON path into the upstream output data, e.g. `$.requirements[0]`
+    # or `$['.']['README.md']` for keys containing dots; the whole output data
+    # is projected if omitted
+    path: Optional[str] = None
+    # Key to publish the projected slice on in `datas`, defaults to the upstream ID
+    key: Optional[str] = None
+    # Optional cap on the serialized size of the slice in bytes; larger slices
+    # are truncated to a string of at most this size
+    max_bytes: Optional[int] = None
+    
+    def get_key(self) -> str:
+        return self.key if self.key else self.id
+
 @dataclass(kw_only=True)
 class AutomataConfig:
     
@@ -51,7 +72,8 @@ class AutomataConfig:
         output_str_list = []
         # TODO sort or anything?
         for step_data in step_datas:
-            output_dict = output_dict | step_data.output_data
+            if isinstance(step_data.output_data, dict):
+                output_dict = output_dict | step_data.output_data
             output_str_list.append(step_data.text)
         output_str = initial_input if initial_input != None else "\n".join(output_str_list)
         return output_dict, output_str
@@ -72,6 +94,9 @@ class AutomataConfig:
     initial_enabled_state: bool = True
     # If enabled, assume a socket is present and announce; wait for input; and return output
     socket: Optional[bool] = False
+    # Seconds a socket step waits for its input before failing, overriding
+    # --socket-input-timeout; 0 to wait indefinitely
+    socket_timeout: Optional[float] = None
     # If allow failure is true, downstream jobs will execute and ignore
     # output from this step
     allow_failure: Optional[bool] = False
@@ -90,17 +115,53 @@ class AutomataConfig:
     # processing/handler steps
     global_config: Optional[dict] = field(default_factory=dict)
     max_iterations: Optional[int] = 0
+    # For subgraph nodes, the most of the subgraph's steps that run at once,
+    # within the run's --max-workers; 0 or None for no cap of its own
+    max_workers: Optional[int] = None
+    # Optional declarative projection of upstream data; if provided, only the
+    # selected slices of upstream output data are fetched and handed to this
+    # step, and the live graph data reference is withheld from its input data.
+    # Plain strings are shorthand for selecting an upstream ID's whole output
+    inputs: Optional[list[InputSelector]] = None
+    # Start this step alongside the upstream steps it needs rather than after
+    # them, so its handlers can consume their output as it streams in, through
+    # the partial outputs bound to the handler context. Upstream output data
+    # is only available that way, not as input step data
+    stream_inputs: Optional[bool] = False
+    # Budget for this step's output and text, in bytes of serialized JSON,
+    # overriding --max-node-bytes; 0 for no budget
+    max_output_bytes: Optional[int] = None
     
     def get_id(self) -> str:
         if self.id == '':
             return self.name
         return self.id
+    
+    # Whether running this node calls a model
+    def uses_model(self) -> bool:
+        return self.op == Ops.GENERATE
         
+    @classmethod
+    def get_parameter_names(cls) -> frozenset[str]:
+        # Cached per class, inspecting the signature is expensive for large graphs
+        names = cls.__dict__.get('_parameter_names', None)
+        if names is None:
+            names = frozenset(inspect.signature(cls).parameters)
+            cls._parameter_names = names
+        return names
+    
     @classmethod
     def from_dict(cls, args):
+        if isinstance(args.get('inputs'), list):
+            args = args | {'inputs': [{'id': i} if isinstance(i, str) else i 
+                                      for i in args['inputs']]}
+        for selector_field in ('map_input', 'reduce_input'):
+            if isinstance(args.get(selector_field), str):
+                args = args | {selector_field: {'id': args[selector_field]}}
+        parameter_names = cls.get_parameter_names()
         inst = cls(**{
             k: v for k, v in args.items() 
-            if k in inspect.signature(cls).parameters
+            if k in parameter_names
         })
         inst.initial_enabled_state = inst.enabled
         return inst
@@ -141,6 +202,14 @@ class AutomataDataProcessorConfig(AutomataConfig):
     # step, modify the data stream
     # Invoked for DATA_PROCESS, RANK, RETRIEVE and GENERATE ops
     output_handler: Optional[str] = DEFAULT_OUTPUT_HANDLER
+    # Optional JSON schema the default output handler validates output against;
+    # output that doesn't conform fails the step, so a looping subgraph retries
+    # at once rather than after downstream steps fail on it. Supports type,
+    # properties, required, additionalProperties, items, enum and size bounds
+    output_schema: Optional[dict] = None
+    # Let the default output handler repair near-JSON output, such as trailing
+    # commas or a response cut off mid-object
+    repair_json: Optional[bool] = True
     # A list of media types that we want to handle for an automata, defaults to STRING
 
 
@@ -163,20 +232,67 @@ class AutomataGeneratorConfig(AutomataDataProcessorConfig):
     # any placeholders in the input text (or user_prompt) will be attempted
     # to be filled with data from previous steps step_data.output_data
     user_prompt_handler: Optional[str] = DEFAULT_SYSTEM_PROMPT_HANDLER
+    # Stream the model's response, publishing each JSON value as soon as it is
+    # complete (e.g. each file of a file tree) to the output handler's partial
+    # callback and to downstream steps with stream_inputs. Always on for steps
+    # with such downstream steps
+    stream_output: Optional[bool] = False
+
+
+@dataclass(kw_only=True)
+class AutomataMapConfig(AutomataGeneratorConfig):
+    # The upstream collection to map over, a list or an object whose values are
+    # mapped in order; by default the whole output data of the single upstream
+    # step. A plain string is shorthand for an upstream ID
+    map_input: Optional[InputSelector] = None
+    # The op run for each element, GENERATE or DATA_PROCCESS, with the prompts
+    # and handlers of this node. Each element's input data has the element on
+    # `item` and its index or key on `item_key`; the rest of the input data is
+    # shared between elements, so handlers must not modify it
+    map_op: Optional[Ops] = Ops.GENERATE
+    # The most elements processed at once
+    max_parallelism: Optional[int] = 4
+    
+    def uses_model(self) -> bool:
+        return self.map_op == Ops.GENERATE
+
+
+@dataclass(kw_only=True)
+class AutomataReduceConfig(AutomataGeneratorConfig):
+    # A collection to reduce the elements of, e.g. the output of a map step;
+    # by default, the output data of every upstream step is reduced
+    reduce_input: Optional[InputSelector] = None
+    # The op that merges each group, GENERATE or DATA_PROCCESS, with the
+    # prompts and handlers of this node. Each merge's input data has the group
+    # on `items`; DATA_PROCCESS merges without an output handler deep merge
+    # objects and concatenate lists
+    reduce_op: Optional[Ops] = Ops.DATA_PROCCESS
+    # Inputs merged per merge step; merges run level by level until one
+    # output is left, so n inputs take about log(n)/log(fan_in) levels
+    fan_in: Optional[int] = 4
+    # The most merges run at once
+    max_parallelism: Optional[int] = 4
+    
+    def uses_model(self) -> bool:
+        return self.reduce_op == Ops.GENERATE
 
 
 class AutomataConfigFactory:
     def __init__(self, config_dict):
-        self.automata_config: AutomataConfig = AutomataConfig.from_dict(config_dict)
         self.config = config_dict
     
+    # The op is read straight from the dictionary so each node is only
+    # validated once, as the config class it resolves to
     def get_config(self) -> AutomataConfig:
-        op: Ops = self.automata_config.op
-        automata_type: AutomataType = self.automata_config.automata_type
+        op: Ops = Ops(self.config.get('op', Ops.GENERATE))
         if op == Ops.DATA_PROCCESS:
             return AutomataDataProcessorConfig.from_dict(self.config)
         elif op == Ops.GENERATE:
             return AutomataGeneratorConfig.from_dict(self.config)
+        elif op == Ops.MAP:
+            return AutomataMapConfig.from_dict(self.config)
+        elif op == Ops.REDUCE:
+            return AutomataReduceConfig.from_dict(self.config)
         else:
             return AutomataConfig.from_dict(self.config)
             
@@ -0,0 +1,264 @@
+from __future__ import annotations
+from collections import OrderedDict
+from datetime import datetime
+from enum import Enum
+import copy
+import heapq
+import itertools
+import threading
+import traceback
+from typing import Callable
+import uuid
+from automata.automata import AutomataDependencies, AutomataGraph
+from automata.automata_artifact import CompiledAutomata
+from automata.fair_share_executor import FairShareExecutor
+from automata.step_dispatcher import StepDispatcher
+from config import Config
+from generic_socket import GenericSocket
+from graph_data import StepData
+from in_memory_graph_data import InMemoryGraphData
+from json_extraction import JsonExtractor
+from memory_accounting import MemoryAccount, MemoryAccounting
+from sapient import Sapient
+
+class RunState(str, Enum):
+    QUEUED = 'QUEUED'
+    RUNNING = 'RUNNING'
+    COMPLETED = 'COMPLETED'
+    FAILED = 'FAILED'
+
+class AdmissionException(Exception):
+    pass
+
+class AutomataRun:
+    """A single submitted execution of the graph. Each run owns its graph data
+    and socket, and publishes progress events (steps stored, socket messages,
+    the end of the run) to subscribers. A run executes the version of the
+    graph that was current when it was submitted"""
+    def __init__(self, initial_input: str, compiled: CompiledAutomata, socket: GenericSocket = None,
+                 priority_class: str = 'interactive', max_session_bytes: int = 0):
+        self.run_id = str(uuid.uuid4())
+        self.initial_input = initial_input
+        # Released once the run ends, so retained runs don't hold on to old versions
+        self.compiled = compiled
+        self.version = compiled.source_hash
+        self.priority_class = priority_class
+        self.state = RunState.QUEUED
+        self.submitted = datetime.now()
+        self.started: datetime = None
+        self.ended: datetime = None
+        self.error: str = None
+        self.memory_account = MemoryAccount(self.run_id, max_session_bytes)
+        self.graph_data = InMemoryGraphData(self.memory_account)
+        self.socket = socket
+        self.events: list[dict] = []
+        self.listeners: list[Callable[[dict], None]] = []
+        self.lock = threading.Lock()
+
+    def is_finished(self) -> bool:
+        return self.state in (RunState.COMPLETED, RunState.FAILED)
+
+    def publish(self, event: dict) -> None:
+        with self.lock:
+            event['seq'] = len(self.events)
+            self.events.append(event)
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(event)
+
+    # Returns the events published so far; the listener receives every event
+    # published after that, with nothing missed or repeated in between
+    def subscribe(self, listener: Callable[[dict], None]) -> list[dict]:
+        with self.lock:
+            self.listeners.append(listener)
+            return list(self.events)
+
+    def unsubscribe(self, listener: Callable[[dict], None]) -> None:
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def on_step(self, step_data: StepData) -> None:
+        self.publish({'type': 'step', 'automata_id': step_data.automata_id,
+                      'iteration_tree': step_data.iteration_tree, 'success': step_data.success,
+                      'start': step_data.start, 'end': step_data.end})
+
+    def on_message(self, message: str) -> None:
+        self.publish({'type': 'message', 'message': message})
+
+    def start(self) -> None:
+        self.state = RunState.RUNNING
+        self.started = datetime.now()
+        self.publish({'type': 'state', 'state': self.state})
+
+    def finish(self, state: RunState, error: str = None) -> None:
+        self.error = error
+        self.ended = datetime.now()
+        self.state = state
+        self.compiled = None
+        self.publish({'type': 'end', 'state': self.state, 'error': error})
+
+    def get_steps(self) -> list[StepData]:
+        return self.graph_data.fetch_all_data()
+
+    def to_dict(self) -> dict:
+        with self.graph_data.lock:
+            steps = [{'automata_id': step_data.automata_id, 'iteration_tree': step_data.iteration_tree,
+                      'success': step_data.success, 'start': step_data.start, 'end': step_data.end}
+                     for step_data in self.graph_data.data_store]
+        return {
+            'run_id': self.run_id,
+            'state': self.state,
+            'priority_class': self.priority_class,
+            'version': self.version,
+            'submitted': self.submitted,
+            'started': self.started,
+            'ended': self.ended,
+            'error': self.error,
+            'memory': self.memory_account.to_dict(),
+            'steps': steps,
+        }
+
+class AutomataEngine:
+    """Executes graph runs for many clients from one warm process. Runs are
+    queued by priority class, FIFO within a class, and executed by a fixed
+    number of run workers against the same compiled graph; submissions beyond
+    `max_queued_runs` waiting runs are rejected with an AdmissionException.
+    The graph can be replaced while serving, see set_compiled"""
+    # Lower ranks are taken from the queue first, and their steps are
+    # dispatched first when runs share a step dispatcher
+    PRIORITY_CLASSES: dict[str, int] = {'interactive': 0, 'batch': 1}
+    DEFAULT_PRIORITY_CLASS = 'interactive'
+    def __init__(self, config: Config, compiled: CompiledAutomata, sapient: Sapient,
+                 max_concurrent_runs: int = None, max_queued_runs: int = None,
+                 max_retained_runs: int = None, dispatcher: StepDispatcher = None):
+        conf = config.get_conf()
+        self.config = config
+        self.compiled = compiled
+        self.sapient = sapient
+        # Shared by all runs; None runs steps on each run's own worker threads
+        self.dispatcher = dispatcher
+        self.max_concurrent_runs = max_concurrent_runs if max_concurrent_runs is not None else conf.max_concurrent_runs
+        self.max_queued_runs = max_queued_runs if max_queued_runs is not None else conf.max_queued_runs
+        self.max_retained_runs = max_retained_runs if max_retained_runs is not None else conf.max_retained_runs
+        self.interactive = any(automata_config.socket for automata_config in compiled.automata_configs)
+        self.queue: list[tuple[int, int, AutomataRun]] = []
+        self.sequence = itertools.count()
+        self.runs: OrderedDict[str, AutomataRun] = OrderedDict()
+        self.running = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.workers: list[threading.Thread] = []
+
+    def start(self) -> None:
+        for i in range(self.max_concurrent_runs):
+            worker = threading.Thread(target=self._work, name='automata-run-{}'.format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    # Stop taking queued runs; runs already executing are left to finish
+    def stop(self) -> None:
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def submit(self, initial_input: str, priority_class: str = None) -> AutomataRun:
+        priority_class = priority_class if priority_class is not None else self.DEFAULT_PRIORITY_CLASS
+        if priority_class not in self.PRIORITY_CLASSES:
+            raise Exception('Unknown priority class {}, expected one of: {}'.format(
+                priority_class, ', '.join(self.PRIORITY_CLASSES.keys())))
+        with self.condition:
+            if self.stopped:
+                raise AdmissionException('The engine is shutting down')
+            if len(self.queue) >= self.max_queued_runs:
+                raise AdmissionException('Too many queued runs ({}), try again later'.format(len(self.queue)))
+            socket = None
+            if self.interactive:
+                from async_sockets import QueueSocket
+                socket = QueueSocket()
+            run = AutomataRun(initial_input, self.compiled, socket, priority_class, self.config.get_conf().max_session_bytes)
+            if socket is not None:
+                socket.on_message = run.on_message
+            self.runs[run.run_id] = run
+            heapq.heappush(self.queue, (self.PRIORITY_CLASSES[priority_class], next(self.sequence), run))
+            self._evict_finished_runs()
+            self.condition.notify()
+        return run
+
+    # Runs submitted from now on use `compiled`, e.g. a reloaded config; runs
+    # already submitted finish on the version they were submitted with
+    def set_compiled(self, compiled: CompiledAutomata) -> None:
+        if self.sapient is None and any(automata_config.uses_model() for automata_config in compiled.automata_configs):
+            from sapient import Sapient
+            self.sapient = Sapient.from_config(self.config)
+        with self.condition:
+            self.compiled = compiled
+            self.interactive = any(automata_config.socket for automata_config in compiled.automata_configs)
+
+    def get_run(self, run_id: str) -> AutomataRun | None:
+        with self.condition:
+            return self.runs.get(run_id, None)
+
+    def list_runs(self) -> list[AutomataRun]:
+        with self.condition:
+            return list(self.runs.values())
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            stats = {
+                'queued': len(self.queue),
+                'running': self.running,
+                'retained': len(self.runs),
+                'max_concurrent_runs': self.max_concurrent_runs,
+                'max_queued_runs': self.max_queued_runs,
+                'version': self.compiled.source_hash,
+            }
+        stats['json_extraction'] = JsonExtractor.get_metrics()
+        stats['memory'] = MemoryAccounting.get_stats()
+        stats['executor'] = FairShareExecutor.get_instance(self.config).get_stats()
+        # Model routing health, if the provider tracks it
+        if hasattr(self.sapient, 'get_stats'):
+            stats['model'] = self.sapient.get_stats()
+        return stats
+
+    def _evict_finished_runs(self) -> None:
+        if len(self.runs) <= self.max_retained_runs:
+            return
+        for run_id in [run_id for run_id, run in self.runs.items() if run.is_finished()]:
+            self.runs.pop(run_id).memory_account.close()
+            if len(self.runs) <= self.max_retained_runs:
+                break
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                _, _, run = heapq.heappop(self.queue)
+                self.running += 1
+            try:
+                self._execute(run)
+            finally:
+                with self.condition:
+                    self.running -= 1
+
+    def _execute(self, run: AutomataRun) -> None:
+        compiled = run.compiled
+        run.start()
+        try:
+            dependencies = AutomataDependencies(
+                self.config, compiled.automata_configs, self.sapient, run.graph_data,
+                socket=run.socket,
+                automata_global_config=copy.deepcopy(compiled.automata_global_config),
+                session_id=run.run_id,
+                step_listeners=[run.on_step],
+                priority=self.PRIORITY_CLASSES[run.priority_class],
+                dispatcher=self.dispatcher)
+            graph = AutomataGraph(dependencies, compiled)
+            graph.run_graph(initial_input=run.initial_input)
+            run.finish(RunState.COMPLETED)
+        except Exception as e:
+            self.config.logger.error(traceback.format_exc())
+            run.finish(RunState.FAILED, str(e))
@@ -0,0 +1,86 @@
+from __future__ import annotations
+import os
+import threading
+import traceback
+from typing import Callable
+from automata.automata_artifact import AutomataArtifacts, CompiledAutomata
+from config import Config
+
+class AutomataReloader:
+    """Watches the automata config file while the process serves runs, and
+    hands each new version of the graph to `on_reload`. The file is polled
+    every `interval` seconds (--reload-interval); when it changes, only the
+    nodes that differ from the current version are parsed, validated and
+    compiled. A config that fails to load is logged, and the current version
+    kept until the file changes again"""
+    # A changed file is only read once it has stopped changing for this long,
+    # so saves in progress aren't read half written
+    SETTLE_SECONDS = 0.2
+
+    def __init__(self, config: Config, path: str, compiled: CompiledAutomata,
+                 on_reload: Callable[[CompiledAutomata], None], interval: float = None):
+        self.config = config
+        self.logger = config.logger
+        self.path = path
+        self.compiled = compiled
+        self.on_reload = on_reload
+        self.interval = interval if interval is not None else config.get_conf().reload_interval
+        self.artifacts = AutomataArtifacts(config)
+        self.signature = self._stat()
+        self.reloads = 0
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self) -> None:
+        if self.interval <= 0:
+            return
+        self.thread = threading.Thread(target=self._watch, name='automata-reloader', daemon=True)
+        self.thread.start()
+        self.logger.info('Watching {} for changes every {}s'.format(self.path, self.interval))
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    # Load the config file if it changed since it was last loaded, returning
+    # whether a new version of the graph was handed on
+    def check(self) -> bool:
+        signature = self._stat()
+        if signature == self.signature:
+            return False
+        while not self.stopped.wait(self.SETTLE_SECONDS):
+            settled = self._stat()
+            if settled == signature:
+                break
+            signature = settled
+        self.signature = signature
+        # Removed, e.g. while an editor replaces it; picked up once it's back
+        if signature is None:
+            return False
+        try:
+            compiled = self.artifacts.load(self.path, self.compiled)
+        except Exception:
+            self.logger.error('Keeping the current graph, the changed config {} could not be loaded: {}'.format(
+                self.path, traceback.format_exc()))
+            return False
+        # Touched or saved without changes
+        if compiled is self.compiled:
+            return False
+        self.on_reload(compiled)
+        self.compiled = compiled
+        self.reloads += 1
+        self.logger.info('Reloaded {}, new runs use graph version {}'.format(self.path, compiled.source_hash[:12]))
+        return True
+
+    def _stat(self) -> tuple[int, int, int] | None:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _watch(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                self.logger.error(traceback.format_exc())
@@ -0,0 +1,256 @@
+from __future__ import annotations
+from collections import deque
+import concurrent.futures
+import itertools
+import threading
+from typing import Callable, Iterable, Iterator
+import weakref
+from config import Config
+
+class WorkGroup(concurrent.futures.Executor):
+    """Tasks of one session, subgraph or fan-out, run on the shared
+    FairShareExecutor. At most `max_workers` of the group's tasks, its
+    subgroups' included, run at once (0 for no quota), so a group never
+    takes more than its share of its parent's quota. Groups are executors
+    themselves, and are dropped once nothing refers to them"""
+    def __init__(self, executor: FairShareExecutor, parent: WorkGroup, name: str, max_workers: int, priority: int = 0):
+        self.executor = executor
+        self.parent = parent
+        self.name = name
+        self.max_workers = max_workers
+        # Lower values are scheduled first among sibling groups
+        self.priority = priority
+        self.tasks: deque[tuple[concurrent.futures.Future, Callable, tuple, dict]] = deque()
+        self.children: weakref.WeakSet[WorkGroup] = weakref.WeakSet()
+        # Tasks running and queued in this group and its subgroups
+        self.running = 0
+        self.pending = 0
+        # Tasks from this group's own queue running, and when it or the group
+        # was last scheduled, to share between its queue and subgroups
+        self.own_running = 0
+        self.own_served = 0
+        self.served = 0
+        if parent is not None:
+            parent.children.add(self)
+            # Tasks still queued when the group is dropped, e.g. cancelled
+            # ones, no longer count against its parents
+            weakref.finalize(self, executor._drop_tasks, parent, self.tasks)
+
+    # A subgroup sharing this group's quota; `max_workers` of 0 or less caps
+    # it at this group's quota only
+    def group(self, name: str, max_workers: int = 0, priority: int = None) -> WorkGroup:
+        return WorkGroup(self.executor, self, name, max_workers, priority if priority is not None else self.priority)
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> concurrent.futures.Future:
+        return self.executor._submit(self, fn, args, kwargs)
+
+    # Like concurrent.futures.as_completed, but when called from one of the
+    # executor's threads, runs the group's queued tasks while it waits
+    def as_completed(self, futures: Iterable[concurrent.futures.Future]) -> Iterator[concurrent.futures.Future]:
+        return self.executor._as_completed(self, futures)
+
+    def wait(self, futures: Iterable[concurrent.futures.Future]) -> None:
+        for _ in self.as_completed(futures):
+            pass
+
+    # Waits for every call, helping as in as_completed, before returning the results
+    def map(self, fn: Callable, *iterables, timeout: float = None, chunksize: int = 1) -> Iterator:
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        self.wait(futures)
+        return (future.result() for future in futures)
+
+    # The threads are shared, so there's nothing to shut down; queued tasks
+    # still run
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        pass
+
+    def has_capacity(self) -> bool:
+        return self.max_workers <= 0 or self.running < self.max_workers
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'max_workers': self.max_workers, 'running': self.running, 'pending': self.pending,
+                'groups': [child.to_dict() for child in list(self.children) if child.running + child.pending > 0]}
+
+class FairShareExecutor:
+    """One pool of threads for every run in the process. Sessions, and the
+    subgraphs and fan-outs within them, submit to their own WorkGroup. Each
+    group runs at most its quota of tasks at once. A free thread takes the
+    next task by walking down the group tree, at each level picking the
+    highest priority group with capacity, then the one running the fewest
+    tasks, then the one served least recently.
+
+    A task that waits on tasks it submitted gives up its quota while it
+    waits, and runs the ones still queued itself, so nested subgraphs can
+    neither deadlock the pool nor add threads to it"""
+    INSTANCE: FairShareExecutor = None
+    INSTANCE_LOCK = threading.Lock()
+
+    def __init__(self, max_threads: int):
+        self.max_threads = max_threads
+        self.condition = threading.Condition()
+        self.root = WorkGroup(self, None, 'root', 0)
+        self.threads: list[threading.Thread] = []
+        self.idle = 0
+        self.sequence = itertools.count(1)
+        # The group of the task each executor thread is running
+        self.local = threading.local()
+
+    # Sized by --executor-threads, by default enough for every concurrent run
+    # to use all of its --max-workers
+    @staticmethod
+    def get_instance(config: Config = None) -> FairShareExecutor:
+        with FairShareExecutor.INSTANCE_LOCK:
+            if FairShareExecutor.INSTANCE is None:
+                conf = (config or Config.get_instance()).get_conf()
+                max_threads = conf.executor_threads if conf.executor_threads > 0 else \
+                    conf.max_workers * max(conf.max_concurrent_runs, 1)
+                FairShareExecutor.INSTANCE = FairShareExecutor(max_threads)
+            return FairShareExecutor.INSTANCE
+
+    def session(self, name: str, max_workers: int, priority: int = 0) -> WorkGroup:
+        return self.root.group(name, max_workers, priority)
+
+    # The group of the task running on this thread, None off the executor's threads
+    def get_current_group(self) -> WorkGroup | None:
+        groups = getattr(self.local, 'groups', None)
+        return groups[-1] if groups else None
+
+    def get_stats(self) -> dict:
+        with self.condition:
+            return {'threads': len(self.threads), 'max_threads': self.max_threads, 'idle': self.idle,
+                    'running': self.root.running, 'pending': self.root.pending,
+                    'sessions': [group.to_dict() for group in list(self.root.children) if group.running + group.pending > 0]}
+
+    def _submit(self, group: WorkGroup, fn: Callable, args: tuple, kwargs: dict) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self.condition:
+            group.tasks.append((future, fn, args, kwargs))
+            ancestor = group
+            while ancestor is not None:
+                ancestor.pending += 1
+                ancestor = ancestor.parent
+            # An idle thread takes one queued task, so there must be one for each
+            if self.root.pending > self.idle and len(self.threads) < self.max_threads:
+                thread = threading.Thread(target=self._work, name='automata-worker-{}'.format(len(self.threads)), daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            # Waiters as well as idle threads may take it
+            self.condition.notify_all()
+        return future
+
+    def _drop_tasks(self, parent: WorkGroup, tasks: deque) -> None:
+        with self.condition:
+            while parent is not None:
+                parent.pending -= len(tasks)
+                parent = parent.parent
+
+    def _path_has_capacity(self, group: WorkGroup) -> bool:
+        while group is not None:
+            if not group.has_capacity():
+                return False
+            group = group.parent
+        return True
+
+    # Take the next task under `group`, marking it running; call holding the condition
+    def _take(self, group: WorkGroup) -> tuple[WorkGroup, tuple] | None:
+        if group.pending == 0 or not group.has_capacity():
+            return None
+        group.served = next(self.sequence)
+        candidates = [child for child in list(group.children) if child.pending > 0 and child.has_capacity()]
+        candidates.sort(key=lambda child: (child.priority, child.running, child.served))
+        if len(group.tasks) > 0:
+            # The group's own queue competes with its subgroups as one more of them
+            own = (group.priority, group.own_running, group.own_served)
+            index = next((i for i, child in enumerate(candidates)
+                          if own <= (child.priority, child.running, child.served)), len(candidates))
+            candidates.insert(index, None)
+        for candidate in candidates:
+            if candidate is None:
+                group.own_served = next(self.sequence)
+                return group, self._pop(group)
+            taken = self._take(candidate)
+            if taken is not None:
+                return taken
+        return None
+
+    def _pop(self, group: WorkGroup) -> tuple:
+        task = group.tasks.popleft()
+        group.own_running += 1
+        ancestor = group
+        while ancestor is not None:
+            ancestor.pending -= 1
+            ancestor.running += 1
+            ancestor = ancestor.parent
+        return task
+
+    # Count a running task in or out of its group's quotas
+    def _adjust_running(self, group: WorkGroup, delta: int) -> None:
+        group.own_running += delta
+        while group is not None:
+            group.running += delta
+            group = group.parent
+
+    def _run(self, group: WorkGroup, task: tuple) -> None:
+        future, fn, args, kwargs = task
+        groups = getattr(self.local, 'groups', None)
+        if groups is None:
+            groups = self.local.groups = []
+        groups.append(group)
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            groups.pop()
+            with self.condition:
+                self._adjust_running(group, -1)
+                self.condition.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                self.idle += 1
+                taken = self._take(self.root)
+                while taken is None:
+                    self.condition.wait()
+                    taken = self._take(self.root)
+                self.idle -= 1
+            self._run(*taken)
+
+    def _as_completed(self, group: WorkGroup, futures: Iterable[concurrent.futures.Future]) -> Iterator[concurrent.futures.Future]:
+        futures = list(futures)
+        finished: deque[concurrent.futures.Future] = deque()
+        def on_done(future: concurrent.futures.Future) -> None:
+            with self.condition:
+                finished.append(future)
+                self.condition.notify_all()
+        for future in futures:
+            future.add_done_callback(on_done)
+        current = self.get_current_group()
+        # Give up this task's quota while it waits, so the tasks it waits on can run
+        if current is not None:
+            with self.condition:
+                self._adjust_running(current, -1)
+                self.condition.notify_all()
+        try:
+            for _ in range(len(futures)):
+                while True:
+                    with self.condition:
+                        if len(finished) > 0:
+                            future = finished.popleft()
+                            break
+                        task = None
+                        # Only executor threads help, so the pool never runs more than its threads
+                        if current is not None and len(group.tasks) > 0 and self._path_has_capacity(group):
+                            task = self._pop(group)
+                        if task is None:
+                            self.condition.wait()
+                            continue
+                    self._run(group, task)
+                yield future
+        finally:
+            if current is not None:
+                with self.condition:
+                    self._adjust_running(current, 1)
@@ -0,0 +1,98 @@
+import copy
+import re
+from functools import lru_cache
+import orjson as json
+from automata.automata_config import InputSelector
+from graph_data import GraphData, StepData
+
+TRUNCATION_MARKER = '...[truncated]'
+
+# Tokens for a small JSONPath subset: `.key`, `[0]`, `['key']` and `["key"]`
+_PATH_TOKEN = re.compile(r"""\.([^.\[\]]+)|\[(-?\d+)\]|\['([^']*)'\]|\["([^"]*)"\]""")
+
+class InputProjection:
+    """Resolves declarative `inputs` selectors against graph data, so steps only
+    receive (and copy) the slices of upstream output data they asked for"""
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def parse_path(path: str) -> tuple[str | int, ...]:
+        if path is None:
+            return ()
+        path = path.strip()
+        if path.startswith('$'):
+            path = path[1:]
+        elif path and not path.startswith('.') and not path.startswith('['):
+            path = '.' + path
+        tokens: list[str | int] = []
+        position = 0
+        for match in _PATH_TOKEN.finditer(path):
+            if match.start() != position:
+                break
+            key, index, single_quoted, double_quoted = match.groups()
+            if index is not None:
+                tokens.append(int(index))
+            else:
+                tokens.append(key if key is not None else
+                              single_quoted if single_quoted is not None else double_quoted)
+            position = match.end()
+        if position != len(path):
+            raise Exception('Invalid input selector path "{}" at position {}'.format(path, position))
+        return tuple(tokens)
+
+    # Walk a parsed path through nested dicts and lists, returning None if any
+    # segment is missing. The returned value is a reference, not a copy
+    @staticmethod
+    def resolve(data: dict | list, tokens: tuple[str | int, ...]):
+        value = data
+        for token in tokens:
+            if isinstance(value, dict):
+                value = value.get(token if not isinstance(token, int) else str(token), None)
+            elif isinstance(value, list) and isinstance(token, int) and -len(value) <= token < len(value):
+                value = value[token]
+            else:
+                return None
+        return value
+
+    @staticmethod
+    def cap(value, max_bytes: int | None):
+        if max_bytes is None or max_bytes <= 0 or value is None:
+            return value
+        if isinstance(value, str):
+            encoded = value.encode('utf-8')
+        else:
+            encoded = json.dumps(value)
+        if len(encoded) <= max_bytes:
+            return value
+        keep = max(max_bytes - len(TRUNCATION_MARKER), 0)
+        return encoded[:keep].decode('utf-8', errors='ignore') + TRUNCATION_MARKER
+
+    # Project each selector from the first of `iteration_trees` its node has a
+    # record at; selectors of nodes without one, e.g. failed or disabled steps,
+    # project nothing rather than output from another iteration
+    @staticmethod
+    def project(graph_data: GraphData, selectors: list[InputSelector],
+                iteration_trees: list[tuple[int, ...]], session_id: str = None) -> list[StepData]:
+        projected: list[StepData] = []
+        for selector in selectors:
+            tokens = InputProjection.parse_path(selector.path)
+            step_data: StepData = None
+            for iteration_tree in iteration_trees:
+                step_data = graph_data.fetch_data_view(selector.id, iteration_tree)
+                if step_data is not None:
+                    break
+            if step_data is None:
+                continue
+            value = InputProjection.resolve(step_data.output_data, tokens) \
+                if step_data.output_data is not None else None
+            value = InputProjection.cap(value, selector.max_bytes)
+            projected.append(StepData(automata_id=selector.get_key(),
+                                      parent_id=step_data.parent_id,
+                                      session_id=session_id if session_id else step_data.session_id,
+                                      iteration_tree=step_data.iteration_tree,
+                                      start_ns=step_data.start_ns,
+                                      end_ns=step_data.end_ns,
+                                      success=step_data.success,
+                                      # Only the projected slice is copied
+                                      output_data=copy.deepcopy(value)))
+        return projected
@@ -0,0 +1,96 @@
+from __future__ import annotations
+import os
+import threading
+import orjson as json
+from config import Config
+
+class LatencyStats:
+    """Per-node execution latency, as an exponentially weighted moving average
+    in seconds, kept across runs (and across restarts if a file is configured)
+    so the scheduler can estimate how long each part of a graph will take.
+    Nodes are told apart by the source hash of the graph version they belong
+    to, so nodes sharing an ID in other configs, or in other versions of the
+    same config, don't skew each other's estimates"""
+    instance = None
+    lock = threading.Lock()
+    # Weight of the newest sample in the moving average
+    ALPHA = 0.3
+    # Estimate for nodes that have never run, by op, until they have samples
+    DEFAULT_LATENCIES: dict[str, float] = {'GENERATE': 5.0, 'MAP': 5.0}
+    DEFAULT_LATENCY = 0.1
+    FILE_NAME = 'latency-stats.json'
+    # Nodes kept, the least recently run are dropped beyond this, e.g. those
+    # of graph versions replaced long ago
+    MAX_NODES = 10000
+
+    @classmethod
+    def get_instance(cls) -> LatencyStats:
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls(cls.get_default_path(Config.get_instance()))
+            return cls.instance
+
+    # Stats are kept next to the compiled graph artifacts, or only in memory if
+    # the artifact cache is disabled
+    @staticmethod
+    def get_default_path(config: Config) -> str | None:
+        from automata.automata_artifact import AutomataArtifacts
+        folder = AutomataArtifacts(config).get_private_cache_folder()
+        return folder + '/' + LatencyStats.FILE_NAME if folder else None
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.latencies: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+        self.dirty = False
+        self.stats_lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def get_key(id: str, source_hash: str = '') -> str:
+        return source_hash + '/' + id if source_hash else id
+
+    def record(self, id: str, seconds: float, source_hash: str = '') -> None:
+        key = self.get_key(id, source_hash)
+        with self.stats_lock:
+            # Re-inserted, so the stats stay ordered by when nodes last ran
+            latency = self.latencies.pop(key, None)
+            self.latencies[key] = seconds if latency is None else latency + self.ALPHA * (seconds - latency)
+            self.counts[key] = self.counts.pop(key, 0) + 1
+            while len(self.latencies) > self.MAX_NODES:
+                oldest = next(iter(self.latencies))
+                del self.latencies[oldest]
+                self.counts.pop(oldest, None)
+            self.dirty = True
+
+    def estimate(self, id: str, op: str = None, source_hash: str = '') -> float:
+        latency = self.latencies.get(self.get_key(id, source_hash), None)
+        if latency is not None:
+            return latency
+        return self.DEFAULT_LATENCIES.get(op, self.DEFAULT_LATENCY)
+
+    def save(self) -> None:
+        if self.path is None or not self.dirty:
+            return
+        with self.stats_lock:
+            data = json.dumps({'latencies': self.latencies, 'counts': self.counts})
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(self.path, threading.get_ident())
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            Config.get_instance().logger.warning('Could not save latency stats to {}: {}'.format(self.path, e))
+
+    def _load(self) -> None:
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read())
+            self.latencies = {id: float(latency) for id, latency in data.get('latencies', {}).items()}
+            self.counts = {id: int(count) for id, count in data.get('counts', {}).items()}
+        except (OSError, json.JSONDecodeError, AttributeError, TypeError, ValueError):
+            pass
@@ -0,0 +1,71 @@
+from __future__ import annotations
+import threading
+import time
+from typing import Callable, Iterator
+
+class PartialOutputBus:
+    """Completed subtrees of a run's step outputs, published while the steps
+    are still streaming them. Each step's stream is reset when the step is
+    scheduled, and completed when it finishes; readers see every value
+    published since the reset, however late they subscribe"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Per automata ID, the (path, value) pairs published so far
+        self.values: dict[str, list[tuple[tuple, object]]] = {}
+        self.completed: set[str] = set()
+        self.listeners: dict[str, list[Callable[[tuple, object], None]]] = {}
+
+    def open(self, automata_id: str) -> None:
+        with self.condition:
+            self.values[automata_id] = []
+            self.completed.discard(automata_id)
+
+    def publish(self, automata_id: str, path: tuple, value) -> None:
+        with self.condition:
+            self.values.setdefault(automata_id, []).append((path, value))
+            listeners = list(self.listeners.get(automata_id, []))
+            self.condition.notify_all()
+        for listener in listeners:
+            listener(path, value)
+
+    def complete(self, automata_id: str) -> None:
+        with self.condition:
+            self.completed.add(automata_id)
+            self.condition.notify_all()
+
+    def is_complete(self, automata_id: str) -> bool:
+        with self.condition:
+            return automata_id in self.completed
+
+    # Call `listener` for each value published for the step from now on,
+    # returning those published before
+    def subscribe(self, automata_id: str, listener: Callable[[tuple, object], None]) -> list[tuple[tuple, object]]:
+        with self.condition:
+            self.listeners.setdefault(automata_id, []).append(listener)
+            return list(self.values.get(automata_id, []))
+
+    def unsubscribe(self, automata_id: str, listener: Callable[[tuple, object], None]) -> None:
+        with self.condition:
+            listeners = self.listeners.get(automata_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+
+    # Yield the step's (path, value) pairs as they are published, until the
+    # step completes; raises if `timeout` seconds pass without it completing
+    def iterate(self, automata_id: str, timeout: float = None) -> Iterator[tuple[tuple, object]]:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.values.get(automata_id, [])) and automata_id not in self.completed:
+                    remaining = deadline - time.monotonic() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise Exception('Timed out waiting on partial output of {}'.format(automata_id))
+                    self.condition.wait(remaining)
+                values = self.values.get(automata_id, [])
+                pending = values[index:]
+                index = len(values)
+                done = automata_id in self.completed
+            yield from pending
+            if done and len(pending) == 0:
+                return
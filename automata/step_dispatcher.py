@@ -0,0 +1,384 @@
+from __future__ import annotations
+from abc import abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+from typing import TYPE_CHECKING
+import uuid
+import weakref
+from multiprocessing.managers import BaseManager
+from config import Config
+from graph_data import GraphData, StepData
+
+if TYPE_CHECKING:
+    from automata.automata import Automata
+    from automata.automata_config import AutomataConfig
+    from sapient import Sapient
+
+class StepDispatcher:
+    """Decides where a ready step's invoke() runs. The graph prepares each
+    step's input and stores its output; the dispatcher only executes it"""
+    LOCAL = 'local'
+    PROCESS = 'process'
+    DISTRIBUTED = 'distributed'
+
+    @abstractmethod
+    def dispatch(self, automata: Automata, executor: concurrent.futures.Executor) -> concurrent.futures.Future:
+        pass
+
+    # Make a run's graph data reachable by the steps it dispatches
+    def register_session(self, session_id: str, graph_data: GraphData) -> None:
+        pass
+
+    # Called when the run ends, so its graph data isn't held on its behalf
+    def unregister_session(self, session_id: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def from_config(config: Config) -> StepDispatcher:
+        conf = config.get_conf()
+        if conf.dispatcher == StepDispatcher.LOCAL:
+            return LocalStepDispatcher()
+        authkey = conf.dispatcher_authkey.encode('utf-8')
+        if len(authkey) == 0:
+            if conf.dispatcher != StepDispatcher.PROCESS:
+                raise Exception('A dispatcher auth key (--dispatcher-authkey) is required for distributed dispatch')
+            # Local worker processes are handed the key directly
+            authkey = os.urandom(32)
+        dispatcher = DistributedStepDispatcher(DistributedStepDispatcher.parse_address(conf.dispatcher_address), authkey)
+        dispatcher.start()
+        if conf.dispatcher == StepDispatcher.PROCESS:
+            dispatcher.start_local_workers(conf.local_workers)
+        return dispatcher
+
+# Runs steps on the graph's own worker threads, as before dispatching existed
+class LocalStepDispatcher(StepDispatcher):
+    def dispatch(self, automata: Automata, executor: concurrent.futures.Executor) -> concurrent.futures.Future:
+        return executor.submit(automata.invoke)
+
+# A copy of a step whose timestamps are in wall clock time, to send to another
+# process, and back
+def to_wall_clock(step_data: StepData) -> StepData:
+    return replace(step_data, start_ns=StepData.to_wall_ns(step_data.start_ns),
+                   end_ns=StepData.to_wall_ns(step_data.end_ns))
+
+def from_wall_clock(step_data: StepData) -> StepData:
+    return replace(step_data, start_ns=StepData.from_wall_ns(step_data.start_ns),
+                   end_ns=StepData.from_wall_ns(step_data.end_ns))
+
+# Step datas in tasks and results carry wall clock timestamps
+@dataclass
+class StepTask:
+    task_id: int
+    session_id: str
+    automata_config: AutomataConfig
+    enabled: bool
+    step_data: StepData
+    input_step_datas: list[StepData]
+    automata_global_config: dict
+    # Whether the step's input data carried the live graph data, which can't be
+    # sent over the wire and is swapped for a proxy on the worker
+    graph_data_input: bool = False
+
+@dataclass
+class StepResult:
+    task_id: int
+    state: int
+    step_data: StepData = None
+    error: str = None
+    duration: float = None
+
+class StepQueueManager(BaseManager):
+    pass
+
+# Client side of StepQueueManager, registered separately so a worker in the
+# coordinator's process doesn't clobber the coordinator's registrations
+class StepQueueClient(BaseManager):
+    pass
+StepQueueClient.register('get_coordinator')
+StepQueueClient.register('get_graph_data')
+
+class DistributedStepDispatcher(StepDispatcher):
+    """Coordinator side of distributed execution. Ready steps are put on a task
+    queue served over a multiprocessing manager; worker processes, on this host
+    or others, take tasks, run them and put the resulting step data on a result
+    queue. Workers reach each run's graph data through the same manager.
+
+    Socket-enabled and pass-through steps always run on the coordinator, which owns the sockets.
+    Output handlers with side effects (e.g. writing file trees) act on the
+    worker's host.
+
+    Each task is leased to the worker that takes it. Workers heartbeat while
+    connected; a worker not heard from for `lease_seconds` is taken for lost,
+    and its tasks are queued again for another worker, or failed once they
+    have been tried `MAX_ATTEMPTS` times. Heartbeats also tell workers which
+    of the runs they hold graph data proxies for have ended, so they release
+    them and the manager lets go of the graph data"""
+    LEASE_SECONDS = 30.0
+    MAX_ATTEMPTS = 2
+    def __init__(self, address: tuple[str, int], authkey: bytes, lease_seconds: float = None):
+        self.address = address
+        self.authkey = authkey
+        self.lease_seconds = lease_seconds if lease_seconds is not None else self.LEASE_SECONDS
+        # Tasks are taken by run priority, then longest estimated critical path
+        self.task_queue: queue.PriorityQueue[tuple[int, float, int, StepTask]] = queue.PriorityQueue()
+        self.sessions: weakref.WeakValueDictionary[str, GraphData] = weakref.WeakValueDictionary()
+        self.futures: dict[int, tuple[Automata, concurrent.futures.Future]] = {}
+        # Queue entries of unfinished tasks, to queue them again, and the
+        # worker holding each leased task and how many times each was leased
+        self.entries: dict[int, tuple[int, float, int, StepTask]] = {}
+        self.leases: dict[int, str] = {}
+        self.attempts: dict[int, int] = {}
+        # When each worker was last heard from
+        self.workers: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.task_ids = itertools.count()
+        self.local_workers: list[multiprocessing.Process] = []
+        self.server = None
+
+    @staticmethod
+    def parse_address(address: str) -> tuple[str, int]:
+        host, _, port = address.rpartition(':')
+        return host or '127.0.0.1', int(port)
+
+    # Serve the queues from a thread in this process, so the graph data handed
+    # to workers is the coordinator's live graph data
+    def start(self) -> None:
+        StepQueueManager.register('get_coordinator', callable=lambda: self,
+                                  exposed=('lease_task', 'heartbeat', 'put_result'))
+        StepQueueManager.register('get_graph_data', callable=lambda session_id: self.sessions[session_id])
+        self.server = StepQueueManager(address=self.address, authkey=self.authkey).get_server()
+        self.address = self.server.address
+        threading.Thread(target=self.server.serve_forever, name='step-dispatcher-server', daemon=True).start()
+        threading.Thread(target=self._expire_leases, name='step-dispatcher-leases', daemon=True).start()
+
+    def start_local_workers(self, count: int) -> None:
+        context = multiprocessing.get_context('spawn')
+        for i in range(count):
+            process = context.Process(target=StepWorker.run_worker, args=(self.address, self.authkey),
+                                      name='step-worker-{}'.format(i), daemon=True)
+            process.start()
+            self.local_workers.append(process)
+
+    def close(self) -> None:
+        for process in self.local_workers:
+            process.terminate()
+        self.local_workers = []
+
+    def register_session(self, session_id: str, graph_data: GraphData) -> None:
+        self.sessions[str(session_id)] = graph_data
+
+    def unregister_session(self, session_id: str) -> None:
+        self.sessions.pop(str(session_id), None)
+
+    def dispatch(self, automata: Automata, executor: concurrent.futures.Executor) -> concurrent.futures.Future:
+        # Interactive steps, steps streaming to or from the run's partial
+        # outputs, and steps that just pass data through, stay here
+        if automata.automata_config.socket or automata.streams_output or automata.automata_config.stream_inputs \
+            or not automata.awaits_execution():
+            return executor.submit(automata.invoke)
+        from native_handler import NativeHandler
+        step_data = automata.step_data
+        graph_data_input = isinstance(step_data.input_data, dict) and \
+            NativeHandler.GRAPH_DATA_KEY in step_data.input_data
+        if graph_data_input:
+            step_data = replace(step_data, input_data={key: value for key, value in step_data.input_data.items()
+                                                       if key != NativeHandler.GRAPH_DATA_KEY})
+        task = StepTask(next(self.task_ids), str(automata.dependencies.session_id), automata.automata_config,
+                        automata.enabled, to_wall_clock(step_data),
+                        [to_wall_clock(input_step_data) for input_step_data in automata.input_step_datas],
+                        automata.automata_global_config, graph_data_input)
+        future = concurrent.futures.Future()
+        entry = (automata.dependencies.priority, -automata.critical_path, task.task_id, task)
+        with self.lock:
+            self.futures[task.task_id] = (automata, future)
+            self.entries[task.task_id] = entry
+        self.task_queue.put(entry)
+        return future
+
+    # Called by workers: the next task, leased to `worker_id`, or None if
+    # none is queued within `timeout` seconds
+    def lease_task(self, worker_id: str, timeout: float) -> StepTask | None:
+        self.heartbeat(worker_id)
+        try:
+            _, _, task_id, task = self.task_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self.lock:
+            # Finished by a worker thought lost, after being queued again
+            if task_id not in self.futures:
+                return None
+            self.leases[task_id] = worker_id
+            self.attempts[task_id] = self.attempts.get(task_id, 0) + 1
+        return task
+
+    # Called by workers with the sessions they hold graph data for, returning
+    # the ones that have ended
+    def heartbeat(self, worker_id: str, session_ids: list[str] = ()) -> list[str]:
+        with self.lock:
+            self.workers[worker_id] = time.monotonic()
+        return [session_id for session_id in session_ids if session_id not in self.sessions]
+
+    # Called by workers with the result of a task; only the first result of
+    # a task that was run twice counts
+    def put_result(self, worker_id: str, result: StepResult) -> None:
+        from automata.automata import AutomataState
+        self.heartbeat(worker_id)
+        with self.lock:
+            automata, future = self.futures.pop(result.task_id, (None, None))
+            self._forget(result.task_id)
+        if future is None:
+            return
+        if result.step_data is not None:
+            automata.step_data = from_wall_clock(result.step_data)
+        automata.state = AutomataState(result.state)
+        automata.duration = result.duration
+        if result.error is not None:
+            Config.get_instance().logger.error('Step {} failed on a worker: {}'.format(
+                automata.automata_config.get_id(), result.error))
+        future.set_result(None)
+
+    def _forget(self, task_id: int) -> None:
+        self.entries.pop(task_id, None)
+        self.leases.pop(task_id, None)
+        self.attempts.pop(task_id, None)
+
+    # Queue the tasks of lost workers again, or fail them once they've been
+    # tried MAX_ATTEMPTS times
+    def _expire_leases(self) -> None:
+        logger = Config.get_instance().logger
+        while True:
+            time.sleep(self.lease_seconds / 4)
+            deadline = time.monotonic() - self.lease_seconds
+            requeued: list[tuple] = []
+            failed: list[tuple[int, str, concurrent.futures.Future]] = []
+            with self.lock:
+                lost = {worker_id for worker_id, heard in self.workers.items() if heard < deadline}
+                for worker_id in lost:
+                    del self.workers[worker_id]
+                for task_id, worker_id in [(task_id, worker_id) for task_id, worker_id in self.leases.items()
+                                           if worker_id in lost]:
+                    del self.leases[task_id]
+                    if self.attempts.get(task_id, 0) < self.MAX_ATTEMPTS:
+                        requeued.append(self.entries[task_id])
+                    else:
+                        automata, future = self.futures.pop(task_id)
+                        self._forget(task_id)
+                        failed.append((automata.automata_config.get_id(), worker_id, future))
+            for entry in requeued:
+                logger.warning('Step worker lost, queueing step {} again'.format(entry[3].automata_config.get_id()))
+                self.task_queue.put(entry)
+            for id, worker_id, future in failed:
+                future.set_exception(Exception('Step {} was lost with step worker {} after {} attempts'.format(
+                    id, worker_id, self.MAX_ATTEMPTS)))
+
+class StepWorker:
+    """Worker side of distributed execution: connects to a coordinator, and
+    runs the steps it is handed until the coordinator goes away. Heartbeats
+    are sent from a thread of their own, so long steps keep their lease"""
+    HEARTBEAT_SECONDS = 5.0
+    # How long a request for a task waits for one before asking again
+    POLL_SECONDS = 1.0
+    # Graph data proxies held at most, least recently used dropped first,
+    # should heartbeats not keep up with the runs ending
+    MAX_SESSIONS = 64
+    def __init__(self, address: tuple[str, int], authkey: bytes, sapient: Sapient = None):
+        self.manager = StepQueueClient(address=address, authkey=authkey)
+        self.config = Config.get_instance()
+        self.sapient = sapient
+        # Proxies for the graph data of the runs this worker has run steps of
+        self.graph_datas: OrderedDict[str, GraphData] = OrderedDict()
+        self.graph_datas_lock = threading.Lock()
+        self.worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def run_worker(address: tuple[str, int], authkey: bytes) -> None:
+        StepWorker(address, authkey).run()
+
+    def run(self) -> None:
+        self.manager.connect()
+        coordinator = self.manager.get_coordinator()
+        self.config.logger.info('Step worker {} connected to {}:{}'.format(self.worker_id, *self.manager.address))
+        threading.Thread(target=self._heartbeat, args=(coordinator,), name='step-worker-heartbeat', daemon=True).start()
+        try:
+            while True:
+                task = coordinator.lease_task(self.worker_id, self.POLL_SECONDS)
+                if task is not None:
+                    coordinator.put_result(self.worker_id, self.execute(task))
+        except (EOFError, ConnectionError):
+            self.config.logger.info('Coordinator went away, stopping step worker')
+        finally:
+            self.stopped.set()
+
+    def _heartbeat(self, coordinator) -> None:
+        while not self.stopped.wait(self.HEARTBEAT_SECONDS):
+            with self.graph_datas_lock:
+                session_ids = list(self.graph_datas.keys())
+            try:
+                ended = coordinator.heartbeat(self.worker_id, session_ids)
+            except (EOFError, ConnectionError):
+                return
+            with self.graph_datas_lock:
+                for session_id in ended:
+                    self.graph_datas.pop(session_id, None)
+
+    # Model providers are only created once a worker is handed a generative step
+    def _get_sapient(self) -> Sapient:
+        if self.sapient is None:
+            from sapient import Sapient
+            self.sapient = Sapient.from_config(self.config)
+        return self.sapient
+
+    def _get_graph_data(self, session_id: str) -> GraphData:
+        with self.graph_datas_lock:
+            graph_data = self.graph_datas.get(session_id, None)
+            if graph_data is not None:
+                self.graph_datas.move_to_end(session_id)
+                return graph_data
+        graph_data = self.manager.get_graph_data(session_id)
+        with self.graph_datas_lock:
+            self.graph_datas[session_id] = graph_data
+            while len(self.graph_datas) > self.MAX_SESSIONS:
+                self.graph_datas.popitem(last=False)
+        return graph_data
+
+    def execute(self, task: StepTask) -> StepResult:
+        from automata.automata import Automata, AutomataDependencies, AutomataState
+        from handler import Handler
+        from native_handler import NativeHandler
+        try:
+            graph_data = self._get_graph_data(task.session_id)
+            sapient = self._get_sapient() if task.automata_config.uses_model() else None
+            dependencies = AutomataDependencies(self.config, [task.automata_config], sapient, graph_data,
+                                                automata_global_config=task.automata_global_config,
+                                                session_id=task.session_id)
+            automata = Automata(task.automata_config, dependencies)
+            automata.enabled = task.enabled
+            automata.input_step_datas = [from_wall_clock(input_step_data) for input_step_data in task.input_step_datas]
+            automata.step_data = from_wall_clock(task.step_data)
+            if task.graph_data_input:
+                automata.step_data.input_data[NativeHandler.GRAPH_DATA_KEY] = graph_data
+            automata.invoke()
+            step_data = automata.step_data
+            if isinstance(step_data.input_data, dict):
+                step_data.input_data.pop(NativeHandler.GRAPH_DATA_KEY, None)
+            return StepResult(task.task_id, automata.state.value, to_wall_clock(step_data), duration=automata.duration)
+        except Exception as e:
+            self.config.logger.error(traceback.format_exc())
+            return StepResult(task.task_id, AutomataState.ERROR.value, None, str(e))
+        finally:
+            # Handlers find the graph data through this thread's context,
+            # which would otherwise keep the last run's proxy alive
+            Handler.bind_context()
@@ -0,0 +1,64 @@
+"""Replay a recorded cassette against a graph, to time the engine without a
+model endpoint or its latency noise. Record the cassette from a real run first:
+
+    python app.py --cassette-mode record --cassette-path run.cassette
+    python benchmarks/cassette_replay.py --cassette run.cassette [-c automata.yaml] [--runs 3] [--speed 1]
+
+Calls are matched on their prompts, so runs must start from the recorded
+run's input (`--input-file`, by default app.py's). Each run replays every model call from the cassette. At speed 0 calls are
+answered at once, so the wall time is the engine's own overhead; with
+`--speed` the recorded latencies are reproduced as well. Handlers that act on
+the world (e.g. Docker builds) still run.
+"""
+import argparse, os, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cassette replay benchmark')
+    parser.add_argument('--cassette', required=True)
+    parser.add_argument('-c', '--automata-location', default=None)
+    parser.add_argument('--input-file', default=None,
+                        help='Initial input of the recorded run; defaults to the one app.py runs with')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--speed', type=float, default=None,
+                        help='Also time runs reproducing the recorded latencies at this speed')
+    args = parser.parse_args()
+    sys.argv = sys.argv[:1] + ['--cassette-mode', 'replay', '--cassette-path', os.path.abspath(args.cassette)]
+    if args.automata_location:
+        sys.argv += ['--automata-location', os.path.abspath(args.automata_location)]
+    os.environ.setdefault('MODEL_NAME', 'benchmark')
+    os.environ.setdefault('MODEL_BASE_URL', 'http://localhost')
+    os.environ.setdefault('MODEL_API_KEY', 'benchmark')
+    os.chdir(ROOT)
+
+    from config import Config
+    from automata.automata_artifact import AutomataArtifacts
+    from automata.automata import AutomataDependencies, AutomataGraph
+    from in_memory_graph_data import InMemoryGraphData
+    from sapient_cassette import SapientCassette
+    if args.input_file:
+        with open(args.input_file) as f:
+            initial_input = f.read()
+    else:
+        from app import evaluation as initial_input
+    config = Config.get_instance()
+    compiled = AutomataArtifacts(config).load(config.normalize_and_resolve_path(config.conf.automata_location))
+
+    def run(speed: float) -> tuple[float, dict]:
+        sapient = SapientCassette(os.path.abspath(args.cassette), speed=speed)
+        dependencies = AutomataDependencies(config, compiled.automata_configs, sapient, InMemoryGraphData(),
+                                            automata_global_config=compiled.automata_global_config)
+        graph = AutomataGraph(dependencies, compiled)
+        start = time.perf_counter()
+        graph.run_graph(initial_input=initial_input)
+        return time.perf_counter() - start, sapient.get_stats()['cassette']
+
+    for speed in [0.0] + ([args.speed] if args.speed else []):
+        timings = []
+        for _ in range(args.runs):
+            elapsed, stats = run(speed)
+            timings.append(elapsed)
+        print('speed {:<4g} best {:8.3f} s  median {:8.3f} s  ({} calls replayed, {} missing)'.format(
+            speed, min(timings), sorted(timings)[len(timings) // 2], stats['hits'], stats['misses']))
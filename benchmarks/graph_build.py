@@ -0,0 +1,70 @@
+"""Benchmark graph validation and construction for large generated configs.
+
+    python benchmarks/graph_build.py [--nodes 10000] [--budget-s 1.0]
+
+Generates a layered DAG (each node needs up to `--fan-in` nodes from the
+previous layer), with a share of the nodes placed in looping subgraphs, then
+times config parsing and AutomataGraph construction separately.
+"""
+import argparse, os, random, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def generate_config(nodes: int, width: int, fan_in: int, subgraphs: int, seed: int = 7) -> list[dict]:
+    random.seed(seed)
+    dag: list[dict] = []
+    per_subgraph = nodes // (subgraphs + 1)
+    graph_ids = [None] + ['loop {}'.format(i) for i in range(subgraphs)]
+    previous_layer: list[str] = []
+    for group_index, graph_id in enumerate(graph_ids):
+        if graph_id is not None:
+            dag.append({'name': graph_id, 'automata_type': 'GRAPH', 'op': 'PASSTHROUGH',
+                        'max_iterations': 3, 'needs': [dag[0]['name']]})
+        layer: list[str] = []
+        previous_layer = []
+        count = per_subgraph if graph_id is not None else nodes - per_subgraph * subgraphs - subgraphs
+        for i in range(count):
+            name = 'step {}.{}'.format(group_index, i)
+            node = {'name': name, 'op': 'DATA_PROCCESS' if i % 3 else 'GENERATE',
+                    'system_prompt': 'Step {{ data }}', 'enabled': True}
+            if graph_id is not None:
+                node['parent_id'] = graph_id
+            if previous_layer:
+                node['needs'] = random.sample(previous_layer, min(fan_in, len(previous_layer)))
+            dag.append(node)
+            layer.append(name)
+            if len(layer) == width:
+                previous_layer, layer = layer, []
+    return dag
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Graph build benchmark')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--width', type=int, default=50)
+    parser.add_argument('--fan-in', type=int, default=1)
+    parser.add_argument('--subgraphs', type=int, default=10)
+    parser.add_argument('--budget-s', type=float, default=1.0)
+    args = parser.parse_args()
+    sys.argv = sys.argv[:1]
+    os.environ.setdefault('MODEL_NAME', 'benchmark')
+    os.environ.setdefault('MODEL_BASE_URL', 'http://localhost')
+    os.environ.setdefault('MODEL_API_KEY', 'benchmark')
+
+    from config import Config
+    from automata.automata_config import AutomataConfigFactory
+    from automata.automata import AutomataDependencies, AutomataGraph
+    config = Config.get_instance()
+    dag = generate_config(args.nodes, args.width, args.fan_in, args.subgraphs)
+
+    start = time.perf_counter()
+    automata_configs = [AutomataConfigFactory(node).get_config() for node in dag]
+    parsed = time.perf_counter()
+    dependencies = AutomataDependencies(config, automata_configs, None, None)
+    graph = AutomataGraph(dependencies)
+    built = time.perf_counter()
+
+    build_s = built - parsed
+    print('nodes {:6d}  parse {:7.3f} s  validate+build {:7.3f} s  (budget {:.2f} s)'.format(
+        len(dag), parsed - start, build_s, args.budget_s))
+    sys.exit(0 if build_s <= args.budget_s else 1)
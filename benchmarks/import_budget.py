@@ -0,0 +1,45 @@
+"""Measure the import-time cost of the CLI and engine entry points, and fail if it
+exceeds the budget or drags in a backend that should only be loaded on demand.
+
+    python benchmarks/import_budget.py [--budget-ms 250]
+"""
+import argparse, os, re, subprocess, sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ['app', 'automata.automata']
+# Backends that must stay off the import path until a graph needs them
+LAZY_MODULES = ['networkx', 'STPyV8', 'docker', 'RestrictedPython', 'langchain_openai', 'jinja2', 'oyaml']
+IMPORT_TIME = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| (\S+)$')
+
+def measure(module: str) -> tuple[float, set[str]]:
+    script = 'import sys, {m}; print(",".join(sys.modules))'.format(m=module)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    total_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        # Only top-level (unindented) entries, cumulative times include children;
+        # interpreter startup (site, encodings) is not ours to budget
+        if match and match.group(2) not in ('site', 'encodings', 'zipimport', 'io'):
+            total_us += int(match.group(1))
+    return total_us / 1000, set(result.stdout.strip().split(','))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import-time budget check')
+    parser.add_argument('--budget-ms', type=float, default=250)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    failed = False
+    for entry_point in ENTRY_POINTS:
+        timings = []
+        for _ in range(args.runs):
+            elapsed_ms, modules = measure(entry_point)
+            timings.append(elapsed_ms)
+        best = min(timings)
+        eager = [m for m in LAZY_MODULES if m in modules]
+        status = 'OK' if best <= args.budget_ms and not eager else 'FAIL'
+        failed = failed or status == 'FAIL'
+        print('{status:4} import {entry:20} best {best:8.1f} ms (budget {budget:.0f} ms){eager}'.format(
+            status=status, entry=entry_point, best=best, budget=args.budget_ms,
+            eager=' eagerly imports ' + ', '.join(eager) if eager else ''))
+    sys.exit(1 if failed else 0)
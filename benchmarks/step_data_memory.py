@@ -0,0 +1,88 @@
+"""Benchmark the memory taken by stored step records.
+
+    python benchmarks/step_data_memory.py [--records 1000000] [--large 200] [--large-kb 256]
+
+Builds `--records` step records the way a long session stores them, once as
+the plain dataclass StepData used to be (per-instance dict, datetimes, list
+iteration trees, a fresh session ID string per record) and once as the
+current StepData, and reports the bytes allocated per record. Then stores
+`--large` steps with `--large-kb` outputs in InMemoryGraphData, with and
+without payload packing.
+"""
+import argparse, os, sys, time, tracemalloc, uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from graph_data import StepData
+from in_memory_graph_data import InMemoryGraphData
+
+@dataclass(kw_only=True)
+class LegacyStepData:
+    input_data: dict = None
+    failure_data: dict = None
+    output_data: dict = None
+    text: str = ""
+    start: datetime = None
+    end: datetime = None
+    automata_id: str = ""
+    session_id: str = None
+    parent_id: str = None
+    iteration_tree: list[int] = field(default_factory=list)
+    success: bool = True
+
+def build_legacy(count: int, session_id: uuid.UUID, ids: list[str]) -> list:
+    return [LegacyStepData(start=datetime.now(), end=datetime.now(), automata_id=''.join(ids[i % len(ids)]),
+                           session_id=str(session_id), iteration_tree=[0, i % 7, i % 3], output_data=None)
+            for i in range(count)]
+
+def build_compact(count: int, session_id: uuid.UUID, ids: list[str]) -> list:
+    return [StepData(start_ns=StepData.now_ns(), end_ns=StepData.now_ns(), automata_id=''.join(ids[i % len(ids)]),
+                     session_id=str(session_id), iteration_tree=(0, i % 7, i % 3), output_data=None)
+            for i in range(count)]
+
+# Bytes allocated by `build` and still held by what it returns, and the seconds it took
+def measure(build, *args) -> tuple[int, float]:
+    tracemalloc.start()
+    started = time.perf_counter()
+    records = build(*args)
+    elapsed = time.perf_counter() - started
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size, elapsed
+
+def store_large(count: int, kb: int, pack_bytes: int) -> InMemoryGraphData:
+    graph_data = InMemoryGraphData(pack_bytes=pack_bytes)
+    for i in range(count):
+        rows = [{'id': j, 'name': 'row {}'.format(j), 'tags': ['a', 'b'], 'score': j / 3} for j in range(kb * 1024 // 64)]
+        graph_data.put_data(StepData(automata_id='step {}'.format(i % 10), iteration_tree=(0, i),
+                                     start_ns=StepData.now_ns(), output_data={'rows': rows}))
+    return graph_data
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Step record memory benchmark')
+    parser.add_argument('--records', type=int, default=1000000)
+    parser.add_argument('--large', type=int, default=200)
+    parser.add_argument('--large-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    session_id = uuid.uuid4()
+    # Split, so every record gets its own copy of the ID as it would from config
+    ids = [list('generate step {}'.format(i)) for i in range(50)]
+    legacy, legacy_s = measure(build_legacy, args.records, session_id, ids)
+    compact, compact_s = measure(build_compact, args.records, session_id, ids)
+    print('{} records'.format(args.records))
+    print('  legacy  {:8.1f} bytes/record  {:8.1f} MB  built in {:.2f} s'.format(
+        legacy / args.records, legacy / 2**20, legacy_s))
+    print('  compact {:8.1f} bytes/record  {:8.1f} MB  built in {:.2f} s  ({:.0%} less)'.format(
+        compact / args.records, compact / 2**20, compact_s, 1 - compact / legacy))
+
+    unpacked, unpacked_s = measure(store_large, args.large, args.large_kb, 0)
+    packed, packed_s = measure(store_large, args.large, args.large_kb, InMemoryGraphData.PACK_BYTES)
+    print('{} steps with {} KB outputs'.format(args.large, args.large_kb))
+    print('  unpacked {:8.1f} MB  stored in {:.2f} s'.format(unpacked / 2**20, unpacked_s))
+    print('  packed   {:8.1f} MB  stored in {:.2f} s  ({:.0%} less)'.format(
+        packed / 2**20, packed_s, 1 - packed / unpacked))
@@ -1,7 +1,6 @@
-import argparse, os, json, sys, logging, traceback, pathlib
+import argparse, copy, os, json, sys, logging, traceback, pathlib
 from deepmerge import always_merger
 from dotenv import load_dotenv
-import oyaml as yaml
 
 class Config():
     instance = None
@@ -18,14 +17,21 @@ class Config():
         load_dotenv()
         self.override_params: dict = {}
         self.parameter_map: dict = None
-        self.conf: argparse.Namespace = None
-        self.parse_args()
+        self._conf: argparse.Namespace = None
         self.logger = logging.getLogger()
         
         self.socket_announce_message = ""
         
         logging.basicConfig()
-        self.logger.setLevel(self.conf.log_level)
+    
+    """Arguments are parsed on first access rather than on instantiation, so
+    importing modules that hold a reference to the config stays cheap"""
+    @property
+    def conf(self) -> argparse.Namespace:
+        if self._conf is None:
+            self.parse_args()
+            self.logger.setLevel(self._conf.log_level)
+        return self._conf
  
     """Utility to use hints from path prefix to determine if we should consider it 
     an absolute path (starts with '/'); a path relative to the project codebase (starts
@@ -41,7 +47,8 @@ class Config():
         return pathlib.Path().resolve().as_posix() + "/" + path
     
     def merge_override_params_key(self, param_dict_key: str | list[str], override_params: dict = {}) -> dict:
-        param_map = self.get_parameter_map().copy()
+        # Merging mutates its target, so never merge into the shared parameter map
+        param_map = copy.deepcopy(self.get_parameter_map())
         if isinstance(param_dict_key, str) and param_dict_key in param_map.keys():
             return always_merger.merge(param_map[param_dict_key], override_params)
         else:
@@ -72,11 +79,18 @@ class Config():
         else:
             return {'required': req}
 
+    # Default for a store_true flag: true only if the variable is set to a
+    # truthy value, so e.g. FLAG=false or FLAG=0 leaves it off
+    def envar_flag(self, key):
+        value = os.environ.get(key)
+        return {'default': value is not None and value.strip().lower() in ('1', 'true', 'yes', 'on')}
+
     def load_config_file(self, path: str) -> dict|list|str:
         with open(path) as f:
             if path.lower().endswith('.json'):
                 return json.load(f)
             elif path.lower().endswith('.yaml') or path.lower().endswith('.yml'):
+                import oyaml as yaml
                 return yaml.safe_load(f)
             else:
                 raise Exception("A file ending with .yml, .yaml or .json file is required")
@@ -109,13 +123,92 @@ class Config():
                             **self.envar_or_req('MAGIC_PREFIX', False, 'fn:'))
         parser.add_argument('-p', '--port', help='API server port for hosting API. Defaults to zero (disabled), in which case this is only a CLI tool', 
                             type=int, **self.envar_or_req('PORT', False, 0))
-        parser.add_argument('-w', '--max-workers', help='Maximum number of worker threads per graph execution, defaults to 8', 
+        parser.add_argument('-w', '--max-workers', help='Maximum number of steps a graph execution runs at once, defaults to 8', 
                             type=int, **self.envar_or_req('MAX_WORKERS', False, 8))
+        parser.add_argument('--executor-threads', help='Size of the thread pool shared by every graph execution in the process; ' +
+                            'defaults to 0, enough for --max-concurrent-runs executions to each run --max-workers steps', 
+                            type=int, **self.envar_or_req('EXECUTOR_THREADS', False, 0))
         parser.add_argument('-W', '--working-folder', help='Working folder for file operations, defaults to /tmp', 
                             **self.envar_or_req('WORKING_FOLDER', False, '/tmp'))
+        parser.add_argument('-A', '--artifact-cache-folder', help='Folder for compiled graph artifacts, keyed by a hash of the automata config and handler' +
+                            ' sources. Defaults to \'cras-sapien\' in the user\'s cache folder ($XDG_CACHE_HOME or ~/.cache); set to \'off\' to always' +
+                            ' recompile. Artifacts are only read from folders owned by the current user and not writable by others', 
+                            **self.envar_or_req('ARTIFACT_CACHE_FOLDER', False, ''))
+        parser.add_argument('-D', '--docker-build-context', help='How Docker build contexts are provided: \'path\' (default) builds from the files written to' +
+                            ' the working folder, \'stream\' builds from an in-memory tar archive of the file tree output by --build-context-input', 
+                            choices=['path', 'stream'], **self.envar_or_req('DOCKER_BUILD_CONTEXT', False, 'path'))
+        parser.add_argument('--build-context-input', help='ID of the upstream step, or key of the inputs selector, whose output is the file tree' +
+                            ' to build with --docker-build-context stream. Without it, builds use the working folder', 
+                            **self.envar_or_req('BUILD_CONTEXT_INPUT', False, ''))
+        parser.add_argument('--build-log-head-lines', help='Number of lines retained from the start of build output, defaults to 50', 
+                            type=int, **self.envar_or_req('BUILD_LOG_HEAD_LINES', False, 50))
+        parser.add_argument('--build-log-tail-lines', help='Number of lines retained from the end of build output, defaults to 200', 
+                            type=int, **self.envar_or_req('BUILD_LOG_TAIL_LINES', False, 200))
+        parser.add_argument('--stream-build-logs', help='Stream build output live over the step\'s socket, if one is provided', 
+                            action='store_true', **self.envar_flag('STREAM_BUILD_LOGS'))
+        parser.add_argument('-H', '--host', help='Interface the API server binds to, defaults to 127.0.0.1', 
+                            **self.envar_or_req('HOST', False, '127.0.0.1'))
+        parser.add_argument('--max-concurrent-runs', help='Maximum number of graph runs the API server executes at once, defaults to 4', 
+                            type=int, **self.envar_or_req('MAX_CONCURRENT_RUNS', False, 4))
+        parser.add_argument('--max-queued-runs', help='Maximum number of submitted runs waiting to execute before new submissions are ' +
+                            'rejected with HTTP 429, defaults to 64', 
+                            type=int, **self.envar_or_req('MAX_QUEUED_RUNS', False, 64))
+        parser.add_argument('--max-retained-runs', help='Maximum number of finished runs kept in memory for status and result queries, defaults to 1000', 
+                            type=int, **self.envar_or_req('MAX_RETAINED_RUNS', False, 1000))
+        parser.add_argument('--reload-interval', help='Seconds between checks of the automata config for changes while serving the API; ' +
+                            'changed nodes are recompiled and runs submitted after that use the new graph, while runs already submitted ' +
+                            'finish on theirs. Defaults to 0 (disabled)',
+                            type=float, **self.envar_or_req('RELOAD_INTERVAL', False, 0.0))
+        parser.add_argument('--model-endpoints', help='JSON list of OpenAI-compatible endpoints to route model calls across, e.g. ' +
+                            '[{"name": "a", "base_url": "...", "api_key": "...", "model": "..."}]; unset fields default to the ' +
+                            'model name, base URL and API key options', 
+                            **self.envar_or_req('MODEL_ENDPOINTS', False, ''))
+        parser.add_argument('--hedge-percentile', help='Send a duplicate model request to another endpoint once a call has taken longer than ' +
+                            'this percentile of recent call latencies, keeping the first answer; 0 (default) disables hedging', 
+                            type=float, **self.envar_or_req('HEDGE_PERCENTILE', False, 0.0))
+        parser.add_argument('--hedge-min-delay', help='Minimum seconds before a hedged model request is sent, defaults to 1', 
+                            type=float, **self.envar_or_req('HEDGE_MIN_DELAY', False, 1.0))
+        parser.add_argument('--endpoint-cooldown', help='Seconds an unhealthy model endpoint is skipped before it is tried again, defaults to 30', 
+                            type=float, **self.envar_or_req('ENDPOINT_COOLDOWN', False, 30.0))
+        parser.add_argument('--disable-single-flight', help='Send every model call upstream, instead of merging identical calls that are in flight ' +
+                            'at the same time into one', 
+                            action='store_true', **self.envar_flag('DISABLE_SINGLE_FLIGHT'))
+        parser.add_argument('--dispatcher', help='Where ready steps run: \'local\' (default) on the graph\'s worker threads, \'process\' on ' +
+                            'local worker processes, or \'distributed\' on step workers connected to --dispatcher-address', 
+                            choices=['local', 'process', 'distributed'], **self.envar_or_req('DISPATCHER', False, 'local'))
+        parser.add_argument('--dispatcher-address', help='host:port the step dispatcher serves tasks on, and step workers connect to; ' +
+                            'defaults to 127.0.0.1:0 (any free port, local workers only)', 
+                            **self.envar_or_req('DISPATCHER_ADDRESS', False, '127.0.0.1:0'))
+        parser.add_argument('--dispatcher-authkey', help='Shared secret between the step dispatcher and its workers, required for distributed dispatch', 
+                            **self.envar_or_req('DISPATCHER_AUTHKEY', False, ''))
+        parser.add_argument('--local-workers', help='Number of worker processes started by the \'process\' dispatcher, defaults to 2', 
+                            type=int, **self.envar_or_req('LOCAL_WORKERS', False, 2))
+        parser.add_argument('--worker', help='Run as a step worker for the coordinator at --dispatcher-address instead of running a graph', 
+                            action='store_true', **self.envar_flag('WORKER'))
+        parser.add_argument('--socket-input-timeout', help='Seconds a socket step waits for its input before it fails, unless the step ' +
+                            'sets socket_timeout. Defaults to 0, no timeout', 
+                            type=float, **self.envar_or_req('SOCKET_INPUT_TIMEOUT', False, 0))
+        parser.add_argument('--max-session-bytes', help='Budget for the step data a session holds, in bytes of serialized JSON; the step ' +
+                            'that would exceed it fails. Defaults to 0, no budget', 
+                            type=int, **self.envar_or_req('MAX_SESSION_BYTES', False, 0))
+        parser.add_argument('--max-node-bytes', help='Budget for the output of a single step, in bytes of serialized JSON, unless the step ' +
+                            'sets max_output_bytes; steps producing more fail. Defaults to 0, no budget', 
+                            type=int, **self.envar_or_req('MAX_NODE_BYTES', False, 0))
+        parser.add_argument('--cassette-mode', help='\'record\' every model call and its latency to the cassette at --cassette-path, or ' +
+                            '\'replay\' model calls from it offline; defaults to \'off\'', 
+                            choices=['off', 'record', 'replay'], **self.envar_or_req('CASSETTE_MODE', False, 'off'))
+        parser.add_argument('--cassette-path', help='Cassette file model calls are recorded to or replayed from', 
+                            **self.envar_or_req('CASSETTE_PATH', False, ''))
+        parser.add_argument('--cassette-speed', help='Replay speed relative to the recorded latencies, e.g. 2 for twice as fast; ' +
+                            '0 answers at once. Defaults to 1', 
+                            type=float, **self.envar_or_req('CASSETTE_SPEED', False, 1.0))
+        parser.add_argument('--export-path', help='File the session\'s step data is exported to as NDJSON, one step per line, ' +
+                            'gzip compressed if it ends in .gz; or tcp://host:port to stream it to a socket. Defaults to none, ' +
+                            'logging each step instead', 
+                            **self.envar_or_req('EXPORT_PATH', False, ''))
         try:
-            self.conf = parser.parse_args()
-            self.override_params = json.loads(self.conf.extended_parameters)
+            self._conf = parser.parse_args()
+            self.override_params = json.loads(self._conf.extended_parameters)
         except:
             traceback.print_exc()
             parser.print_help()
@@ -1,79 +1,207 @@
+import io
 import os
+import re
+import threading
+from collections import deque
+from typing import Callable
 import orjson as json
 import docker, logging
 
 from config import Config
+from files_util import FileTree
 from graph_data import StepData
+from handler import Handler
 from native_handler import NativeHandler
 
+class BuildLogCollector:
+    """Bounded capture of build output: the first `head_lines` and last
+    `tail_lines` lines are retained, plus up to `max_error_lines` lines that
+    look like errors, so memory and prompt size stay fixed however long the
+    build output is"""
+    ERROR_PATTERN = re.compile(r'\b(error|errors|failed|failure|fatal|exception|panic|cannot|undefined|not found)\b', re.IGNORECASE)
+    OMITTED_MESSAGE = '... {} lines omitted ...'
+
+    def __init__(self, head_lines: int = 50, tail_lines: int = 200, max_error_lines: int = 50,
+                 max_line_length: int = 1000, on_line: Callable[[str], None] = None):
+        self.head_lines = head_lines
+        self.max_line_length = max_line_length
+        self.head: list[str] = []
+        self.tail: deque[str] = deque(maxlen=tail_lines)
+        self.errors: deque[str] = deque(maxlen=max_error_lines)
+        self.total_lines = 0
+        self.total_bytes = 0
+        self.success = True
+        self.summary = ''
+        self.on_line = on_line
+
+    def append(self, message: str) -> None:
+        for line in message.splitlines():
+            line = line.rstrip()
+            if not line:
+                continue
+            self.total_lines += 1
+            self.total_bytes += len(line.encode('utf-8'))
+            if len(line) > self.max_line_length:
+                line = line[:self.max_line_length] + '...'
+            if len(self.head) < self.head_lines:
+                self.head.append(line)
+            else:
+                self.tail.append(line)
+            if self.ERROR_PATTERN.search(line):
+                self.errors.append(line)
+            if self.on_line is not None:
+                try:
+                    self.on_line(line)
+                except Exception:
+                    # A broken stream shouldn't fail the build, stop streaming
+                    self.on_line = None
+
+    def fail(self, summary: str) -> None:
+        self.success = False
+        self.summary = summary
+        self.errors.append(summary)
+
+    def complete(self, summary: str) -> None:
+        self.summary = summary
+
+    def get_omitted_lines(self) -> int:
+        return self.total_lines - len(self.head) - len(self.tail)
+
+    def get_lines(self) -> list[str]:
+        omitted = self.get_omitted_lines()
+        if omitted > 0:
+            return self.head + [self.OMITTED_MESSAGE.format(omitted)] + list(self.tail)
+        return self.head + list(self.tail)
+
+    def to_output_data(self) -> dict:
+        return {
+            'build_output': self.get_lines(),
+            'build_errors': list(self.errors),
+            'build_summary': self.summary,
+            'build_log_stats': {
+                'total_lines': self.total_lines,
+                'total_bytes': self.total_bytes,
+                'omitted_lines': self.get_omitted_lines(),
+            },
+        }
+
+    def to_text(self) -> str:
+        text = self.summary + ' \n\n'
+        if not self.success and len(self.errors) > 0:
+            text += '##Build errors: ```shell\n{}\n```\n\n'.format('\n'.join(self.errors))
+        return text + '##Build output: ```shell\n{}\n```'.format('\n'.join(self.get_lines()))
+
 class DockerExecutor:
     
     app_config = Config.get_instance()
+    BUILD_CONTEXT_PATH = 'path'
+    BUILD_CONTEXT_STREAM = 'stream'
+    # API clients are shared across handler invocations, one per Docker URI
+    CLIENTS: dict[str, docker.APIClient] = {}
+    CLIENTS_LOCK = threading.Lock()
 
     def docker_build_output_handler(input_step_datas: list[StepData], 
                              step_data: StepData, config: dict, input: str):
+        conf = DockerExecutor.app_config.conf
         docker_executor = DockerExecutor()
-        logs: list[dict] = []
+        logs = BuildLogCollector(conf.build_log_head_lines, conf.build_log_tail_lines,
+                                 on_line=DockerExecutor._get_log_streamer(step_data) if conf.stream_build_logs else None)
         try:
             id = step_data.session_id
-            docker_executor.build_image(os.path.abspath(DockerExecutor.app_config.conf.working_folder) + '/' + id, logs)
+            if conf.docker_build_context == DockerExecutor.BUILD_CONTEXT_STREAM and conf.build_context_input:
+                # Build straight from the upstream file tree, skipping the disk round trip
+                file_tree = DockerExecutor._get_file_tree(input_step_datas, conf.build_context_input)
+                docker_executor.build_image(None, logs, FileTree.tar_tree(file_tree))
+            else:
+                docker_executor.build_image(os.path.abspath(conf.working_folder) + '/' + id, logs)
         except Exception as e:
             DockerExecutor.app_config.logger.error(e)
-        build_summary = ''
-        if len(logs) > 0:
-            summary = logs[-1]
-            if isinstance(summary, dict):
-                if 'success' in summary.keys() and summary['success'] == False:
-                    step_data.success = False
-                if 'output' in summary.keys():
-                    build_summary = summary['output']
-        step_data.output_data = {
-            'build_output': logs,
-            'build_summary': build_summary,
-            'success': step_data.success
-        }
-        out_text = []
-        for data in step_data.output_data:
-            if isinstance(data, str):
-                out_text.append(data)
-            else:
-                out_text.append(json.dumps(data, option=json.OPT_INDENT_2))
-        step_data.text = '{summary} \n\n##Build output: ```shell\n{output}\n```'.format(
-            summary=step_data.output_data['build_summary'], 
-            output='\n'.join(out_text))
+            # Failures before or outside the build itself, e.g. a rejected
+            # file tree or an unreachable daemon, fail the step as well
+            if logs.success:
+                logs.fail('Docker build failed - reason: {}'.format(e))
+        if logs.success == False:
+            step_data.success = False
+            step_data.failure_data = {'stage': 'build', 'errors': list(logs.errors)}
+        step_data.output_data = logs.to_output_data()
+        step_data.output_data['success'] = step_data.success
+        step_data.text = logs.to_text()
     NativeHandler.register_callback('docker_build_output_handler', docker_build_output_handler)
+    
+    # Forward build output live over the step's socket, if it has a working one
+    def _get_log_streamer(step_data: StepData) -> Callable[[str], None] | None:
+        socket = Handler.get_socket()
+        if socket is None:
+            return None
+        def stream_line(line: str):
+            socket.send(json.dumps({'type': 'build_log', 'session_id': step_data.session_id,
+                                    'automata_id': step_data.automata_id, 'line': line}).decode('utf-8'))
+        return stream_line
+    
+    # The file tree output by the input named `input_id`: an upstream step's
+    # ID, or an inputs selector's key
+    def _get_file_tree(input_step_datas: list[StepData], input_id: str) -> dict:
+        for input_step_data in input_step_datas or []:
+            if input_step_data.automata_id == input_id:
+                if not isinstance(input_step_data.output_data, dict) or len(input_step_data.output_data) == 0:
+                    raise Exception('Build context input "{}" did not output a file tree'.format(input_id))
+                return input_step_data.output_data
+        raise Exception('Build context input "{}" is not an input of the step'.format(input_id))
+    
+    @staticmethod
+    def get_client(docker_uri: str) -> docker.APIClient:
+        with DockerExecutor.CLIENTS_LOCK:
+            client = DockerExecutor.CLIENTS.get(docker_uri, None)
+            if client is None:
+                client = docker.APIClient(base_url=docker_uri)
+                DockerExecutor.CLIENTS[docker_uri] = client
+            return client
         
     def __init__(self, docker_uri: str = 'unix://var/run/docker.sock'):
-        self.client = docker.APIClient(base_url=docker_uri)
+        self.client = DockerExecutor.get_client(docker_uri)
         self.logger = logging.getLogger()
-                
-    def build_image(self, path: str, messages: list[dict]):
+    
+    # Build from a directory on disk, or from an in-memory tar archive of the
+    # build context if `context` is provided
+    def build_image(self, path: str, logs: BuildLogCollector, context: io.BytesIO = None):
 
         # Build docker image
         self.logger.info('Building docker image ...')
-        generator = self.client.build(
-            decode=True,
-            path=path,
-            rm=True,
-            network_mode='host',
-        )
+        if context is not None:
+            generator = self.client.build(
+                decode=True,
+                fileobj=context,
+                custom_context=True,
+                rm=True,
+                network_mode='host',
+            )
+        else:
+            generator = self.client.build(
+                decode=True,
+                path=path,
+                rm=True,
+                network_mode='host',
+            )
+        output = None
         while True:
             try:
                 output = generator.__next__()
                 if isinstance(output, dict):
-                    messages.append(output)
                     if 'stream' in output:
-                        self.logger.info("Build output: {}".format(output['stream'].strip('\n')))
+                        self.logger.debug("Build output: {}".format(output['stream'].strip('\n')))
+                        logs.append(output['stream'])
+                    elif 'status' in output:
+                        logs.append(output['status'])
                     if 'errorDetail' in output:
                         self.logger.error("Build error: {}".format(output['errorDetail']))
-                        messages.append({'success': False, 'output': 'Docker build failed - reason: {}'.format(output['errorDetail']['message'])})
+                        logs.fail('Docker build failed - reason: {}'.format(output['errorDetail'].get('message', '')))
                         raise Exception("Could not build image")
             except StopIteration:
                 self.logger.info("Complete")
-                messages.append({'success': True, 'output': 'Build complete'})
+                logs.complete('Build complete')
                 break
             except ValueError:
-                messages.append({'success': False, 'output': output})
+                logs.fail('Docker build failed - reason: {}'.format(output))
                 self.logger.info("Error building image: {}".format(output))
                 raise Exception("Could not build image")
 
@@ -0,0 +1,38 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Coroutine
+
+class BackgroundEventLoop:
+    """A process-wide asyncio loop running on a daemon thread, so synchronous
+    engine code can park work on it (e.g. waiting on socket input) without
+    holding a worker thread"""
+    instance = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        with cls.lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name='background-event-loop', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Schedule a coroutine on the loop from any thread
+    def run(self, coroutine: Coroutine) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Run a coroutine on the loop and block the calling thread for its result;
+    # must not be called from the loop thread itself
+    def run_sync(self, coroutine: Coroutine, timeout: float = None):
+        if threading.current_thread() is self.thread:
+            raise Exception('run_sync cannot be called from the background event loop thread')
+        return self.run(coroutine).result(timeout)
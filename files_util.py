@@ -1,32 +1,120 @@
-
-import os, logging
+import concurrent.futures
+import hashlib, io, os, logging, tarfile, threading
+import orjson as json
+from dataclasses import asdict, dataclass, field
 
 from config import Config
 from graph_data import StepData
 from native_handler import NativeHandler
 
+@dataclass
+class FileTreeChangeset:
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    unchanged: list[str] = field(default_factory=list)
+    # Files a repaired, possibly truncated, tree would have modified or
+    # removed, left as they were
+    skipped: list[str] = field(default_factory=list)
+
+    def has_changes(self) -> bool:
+        return len(self.added) > 0 or len(self.modified) > 0 or len(self.removed) > 0
+
+    def to_dict(self) -> dict[str, list[str]]:
+        return asdict(self)
+
 class FileTree:
     app_config = Config.get_instance()
     logger = logging.getLogger()
-    
+    # Written next to the session folder, not inside it, so it never ends up
+    # in a build context
+    MANIFEST_SUFFIX = '.manifest.json'
+    # The changeset of the last write is published on the step's metadata
+    CHANGESET_KEY = 'changeset'
+    WRITE_WORKERS = 8
+    WRITE_BATCH_SIZE = 32
+    # Per session folder and step, the manifest and the hashes of the files
+    # written while a tree streams in, so the final write can skip them
+    STREAMED: dict[tuple[str, str], tuple[dict[str, str], dict[str, str]]] = {}
+    STREAMED_LOCK = threading.Lock()
+
     def file_tree_output_handler(input_step_datas: list[StepData], step_data: StepData, config: dict, input: str):
-        
+
         NativeHandler.CALLBACKS[NativeHandler.DEFAULT_OUTPUT_HANDLER](
-            input_step_datas=input_step_datas, 
-            step_data=step_data, 
-            config=config, 
+            input_step_datas=input_step_datas,
+            step_data=step_data,
+            config=config,
             input=input)
-        if isinstance(step_data.output_data, dict) :
-            FileTree.write_tree(step_data.output_data,  os.path.abspath(FileTree.app_config.conf.working_folder) + '/' + step_data.session_id)
-    
+        base_path = FileTree.get_session_path(step_data)
+        with FileTree.STREAMED_LOCK:
+            _, streamed = FileTree.STREAMED.pop((base_path, step_data.automata_id), ({}, {}))
+        # A failed step, e.g. a reply that couldn't be parsed, leaves the
+        # project as it was rather than deleting it
+        if not step_data.success or not isinstance(step_data.output_data, dict):
+            FileTree._discard_streamed(base_path, streamed)
+            return
+        # A repaired reply may have been cut off, so it can't tell which files
+        # were dropped, and its last file may be cut short
+        partial = (step_data.metadata or {}).get(NativeHandler.REPAIRED_KEY, False)
+        changeset = FileTree.write_tree_incremental(step_data.output_data, base_path, streamed, partial)
+        step_data.metadata = (step_data.metadata or {}) | {FileTree.CHANGESET_KEY: changeset.to_dict()}
+
+    # With a streamed response, write each file as soon as its contents are
+    # complete rather than once the whole tree has arrived
+    def file_tree_partial_handler(input_step_datas: list[StepData], step_data: StepData, config: dict,
+                                  path: tuple, value):
+        if not isinstance(value, str) or len(path) == 0 or not all(isinstance(name, str) for name in path):
+            return
+        for name in path:
+            FileTree.check_name(name)
+        relative_path = '/'.join(name for name in path if name != '.')
+        base_path = FileTree.get_session_path(step_data)
+        target = FileTree.resolve_path(base_path, relative_path)
+        key = (base_path, step_data.automata_id)
+        with FileTree.STREAMED_LOCK:
+            if key not in FileTree.STREAMED:
+                FileTree.STREAMED[key] = (FileTree._read_manifest(base_path + FileTree.MANIFEST_SUFFIX), {})
+            manifest, streamed = FileTree.STREAMED[key]
+        digest = hashlib.sha256(value.encode('utf-8')).hexdigest()
+        if manifest.get(relative_path, None) != digest or not os.path.isfile(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            FileTree._write_batch(base_path, [(relative_path, value)])
+        with FileTree.STREAMED_LOCK:
+            streamed[relative_path] = digest
+
+    # A stream cut short never reaches the output handler: forget it, and
+    # undo the files it wrote
+    def file_tree_partial_abort(input_step_datas: list[StepData], step_data: StepData, config: dict):
+        base_path = FileTree.get_session_path(step_data)
+        with FileTree.STREAMED_LOCK:
+            _, streamed = FileTree.STREAMED.pop((base_path, step_data.automata_id), ({}, {}))
+        FileTree._discard_streamed(base_path, streamed)
+
     NativeHandler.register_callback('file_tree_output_handler', file_tree_output_handler)
-        
+    NativeHandler.register_partial_callback('file_tree_output_handler', file_tree_partial_handler,
+                                            file_tree_partial_abort)
+
+    def get_session_path(step_data: StepData) -> str:
+        return os.path.abspath(FileTree.app_config.conf.working_folder) + '/' + step_data.session_id
+
+    # Tree keys are file and folder names, and can't lead out of the tree
+    def check_name(name: str):
+        if os.path.isabs(name) or '..' in name.replace('\\', '/').split('/'):
+            raise Exception('Path traversal detected, aborting')
+
+    # The real path of `path` in `base_path`, which symlinks can't lead out of either
+    def resolve_path(base_path: str, path: str) -> str:
+        root = os.path.realpath(base_path)
+        target = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, target]) != root:
+            raise Exception('Path traversal detected, aborting')
+        return target
+
     def write_tree(tree: dict[str, str|dict], base_path: str):
         if not os.path.exists(base_path):
             os.makedirs(base_path)
         for name, contents_or_subfolder in tree.items():
-            if '../' in name:
-                raise Exception('Path traversal detected, aborting')
+            FileTree.check_name(name)
             if isinstance(contents_or_subfolder, str):
                 with open(base_path + '/' + name, "w") as f:
                     f.write(contents_or_subfolder)
@@ -35,6 +123,152 @@ class FileTree:
                 path = base_path + '/' + name if name != '.' else base_path
                 FileTree.write_tree(contents_or_subfolder, path)
             else:
-                FileTree.logger("Unknown type found in file tree: {}".format(contents_or_subfolder))
-                
-                    
\ No newline at end of file
+                FileTree.logger.warning("Unknown type found in file tree: {}".format(contents_or_subfolder))
+
+    # Flatten a file tree into relative file paths and their contents; '.'
+    # folders map onto their parent
+    def flatten_tree(tree: dict[str, str|dict], base_path: str = '',
+                     files: dict[str, str] = None) -> dict[str, str]:
+        files = {} if files is None else files
+        for name, contents_or_subfolder in tree.items():
+            FileTree.check_name(name)
+            if name == '.':
+                path = base_path
+            else:
+                path = base_path + '/' + name if base_path else name
+            if isinstance(contents_or_subfolder, str):
+                files[path] = contents_or_subfolder
+            elif isinstance(contents_or_subfolder, dict):
+                FileTree.flatten_tree(contents_or_subfolder, path, files)
+            else:
+                FileTree.logger.warning("Unknown type found in file tree: {}".format(contents_or_subfolder))
+        return files
+
+    # Write only the files that are new or changed since the last write to
+    # `base_path`, in parallel batches, and delete files that dropped out of
+    # the tree. Content hashes of the last write are kept in a manifest, so
+    # unchanged files keep their timestamps (and Docker's build cache). Files
+    # in `streamed`, already written as the tree streamed in, are skipped if
+    # their hash matches. An empty tree is taken for a reply without one, and
+    # writes nothing
+    # A `partial` tree only adds files: files it lacks are kept, and files it
+    # has that already exist aren't overwritten
+    def write_tree_incremental(tree: dict[str, str|dict], base_path: str,
+                               streamed: dict[str, str] = None, partial: bool = False) -> FileTreeChangeset:
+        streamed = streamed if streamed is not None else {}
+        files = FileTree.flatten_tree(tree)
+        if len(files) == 0:
+            FileTree.logger.warning('Not writing an empty file tree to {}'.format(base_path))
+            FileTree._discard_streamed(base_path, streamed)
+            return FileTreeChangeset()
+        manifest_path = base_path + FileTree.MANIFEST_SUFFIX
+        manifest = FileTree._read_manifest(manifest_path)
+        hashes: dict[str, str] = {}
+        changeset = FileTreeChangeset()
+        to_write: list[tuple[str, str]] = []
+        for path, contents in files.items():
+            hashes[path] = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+            if path not in manifest:
+                changeset.added.append(path)
+            elif manifest[path] != hashes[path] or not os.path.isfile(base_path + '/' + path):
+                # Files streamed in full were written already
+                if partial and streamed.get(path, None) != hashes[path]:
+                    changeset.skipped.append(path)
+                    hashes[path] = manifest[path]
+                    continue
+                changeset.modified.append(path)
+            else:
+                changeset.unchanged.append(path)
+                continue
+            if streamed.get(path, None) != hashes[path]:
+                to_write.append((path, contents))
+        if partial:
+            changeset.skipped += [path for path in manifest if path not in files]
+            hashes = manifest | hashes
+        else:
+            changeset.removed = [path for path in manifest if path not in files]
+
+        for folder in {os.path.dirname(base_path + '/' + path) for path, _ in to_write} | {base_path}:
+            os.makedirs(folder, exist_ok=True)
+        batches = [to_write[i:i + FileTree.WRITE_BATCH_SIZE]
+                   for i in range(0, len(to_write), FileTree.WRITE_BATCH_SIZE)]
+        if len(batches) == 1:
+            FileTree._write_batch(base_path, batches[0])
+        elif len(batches) > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=FileTree.WRITE_WORKERS) as executor:
+                for future in [executor.submit(FileTree._write_batch, base_path, batch) for batch in batches]:
+                    future.result()
+        for path in changeset.removed:
+            FileTree._remove_file(base_path, path)
+        # Streamed files the final tree doesn't have were never published
+        for path in streamed:
+            if path not in files and path not in manifest:
+                FileTree._remove_file(base_path, path)
+
+        FileTree._write_manifest(manifest_path, hashes)
+        return changeset
+
+    # Undo the files of a streamed tree that was never written: remove the
+    # new ones, and mark the overwritten ones so the next write rewrites them
+    def _discard_streamed(base_path: str, streamed: dict[str, str]):
+        if len(streamed) == 0:
+            return
+        manifest_path = base_path + FileTree.MANIFEST_SUFFIX
+        manifest = FileTree._read_manifest(manifest_path)
+        overwritten = False
+        for path, digest in streamed.items():
+            if path not in manifest:
+                FileTree._remove_file(base_path, path)
+            elif manifest[path] != digest:
+                manifest[path] = ''
+                overwritten = True
+        if overwritten:
+            FileTree._write_manifest(manifest_path, manifest)
+
+    def _write_manifest(manifest_path: str, manifest: dict[str, str]):
+        with open(manifest_path + '.tmp', 'wb') as f:
+            f.write(json.dumps(manifest))
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _read_manifest(manifest_path: str) -> dict[str, str]:
+        try:
+            with open(manifest_path, 'rb') as f:
+                manifest = json.loads(f.read())
+            return manifest if isinstance(manifest, dict) else {}
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def _write_batch(base_path: str, batch: list[tuple[str, str]]):
+        for path, contents in batch:
+            with open(FileTree.resolve_path(base_path, path), "w") as f:
+                f.write(contents)
+
+    # Remove a file that is no longer part of the tree, along with any folders
+    # that it leaves empty
+    def _remove_file(base_path: str, path: str):
+        try:
+            os.remove(base_path + '/' + path)
+        except FileNotFoundError:
+            pass
+        folder = os.path.dirname(path)
+        while folder:
+            try:
+                os.rmdir(base_path + '/' + folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    # Build an uncompressed tar archive of a file tree in memory, so it can be
+    # handed to Docker as a build context without a round trip through disk.
+    # Entries get fixed metadata, so identical trees produce identical archives
+    def tar_tree(tree: dict[str, str|dict]) -> io.BytesIO:
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for path, contents in FileTree.flatten_tree(tree).items():
+                data = contents.encode('utf-8')
+                info = tarfile.TarInfo(path)
+                info.size = len(data)
+                info.mode = 0o644
+                tar.addfile(info, io.BytesIO(data))
+        archive.seek(0)
+        return archive
@@ -1,4 +1,3 @@
-
 from abc import abstractmethod
 
 # A generic socket interface to be plugged into any graph node that
@@ -6,9 +5,31 @@ from abc import abstractmethod
 # a TCP socket and websocket
 class GenericSocket:
     @abstractmethod
-    def send(message: str | bytes | bytearray | memoryview) -> None:
+    def send(self, message: str | bytes | bytearray | memoryview) -> None:
         raise Exception("If using sockets for I/O, you need to provide an implementation of GenericSocket to AutomataDependencies")
-    
+
     @abstractmethod
-    def recv() -> str:
+    def recv(self) -> str:
         raise Exception("If using sockets for I/O, you need to provide an implementation of GenericSocket to AutomataDependencies")
+
+# A non-blocking socket interface. Steps waiting on an AsyncGenericSocket are
+# parked on the background event loop rather than holding a worker thread, so
+# many sessions can wait on human input at once. The synchronous methods are
+# bridged onto the loop for callers that can't await
+class AsyncGenericSocket(GenericSocket):
+    @abstractmethod
+    async def asend(self, message: str | bytes | bytearray | memoryview) -> None:
+        raise Exception("Async sockets must implement asend")
+
+    @abstractmethod
+    async def arecv(self) -> str:
+        raise Exception("Async sockets must implement arecv")
+
+    # Fire and forget; messages are written in the order they were sent
+    def send(self, message: str | bytes | bytearray | memoryview) -> None:
+        from event_loop import BackgroundEventLoop
+        BackgroundEventLoop.get_instance().run(self.asend(message))
+
+    def recv(self) -> str:
+        from event_loop import BackgroundEventLoop
+        return BackgroundEventLoop.get_instance().run_sync(self.arecv())
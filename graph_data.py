@@ -1,46 +1,193 @@
 from __future__ import annotations
 from abc import abstractmethod
-from dataclasses import dataclass, field
 from datetime import datetime
 from collections import OrderedDict
-import inspect
+from typing import Iterator
+import dataclasses
+import sys
+import time
+import orjson as json
 
-@dataclass(kw_only=True)
+# Wall clock time at a known monotonic time, to date monotonic timestamps
+WALL_ANCHOR_NS = time.time_ns()
+MONOTONIC_ANCHOR_NS = time.monotonic_ns()
+
+class PackedPayload:
+    """A large payload held as its JSON encoding, which takes a fraction of
+    the memory of the objects it decodes to. Stores decode it when a step is
+    fetched"""
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    # Immutable, so copies can share it
+    def __deepcopy__(self, memo) -> PackedPayload:
+        return self
+
+    def unpack(self):
+        return json.loads(self.data)
+
+    # Pack `value` if it encodes to at least `min_bytes` bytes of JSON that
+    # decode back to an equal value; anything else is returned as is
+    @staticmethod
+    def pack(value, min_bytes: int):
+        if min_bytes <= 0 or not isinstance(value, (dict, list)):
+            return value
+        try:
+            # Without a default, values JSON can't round trip raise
+            data = json.dumps(value, option=json.OPT_PASSTHROUGH_DATETIME | json.OPT_PASSTHROUGH_DATACLASS)
+        except TypeError:
+            return value
+        if len(data) < min_bytes:
+            return value
+        # orjson leaves its output buffer over-allocated; keep an exact copy
+        return PackedPayload(bytes(memoryview(data)))
+
+    @staticmethod
+    def unpack_value(value):
+        return value.unpack() if isinstance(value, PackedPayload) else value
+
+# Slotted, with IDs interned and the iteration tree a tuple, so the many
+# records of long sessions share what they can. Times are monotonic
+# nanoseconds; `start` and `end` date them on the wall clock
+@dataclasses.dataclass(kw_only=True, slots=True)
 class StepData:
     input_data: dict = None
     failure_data: dict = None
     output_data: dict = None
+    # Facts about the output for downstream handlers, e.g. the changeset of a
+    # written file tree; kept out of output_data so prompts never render them
+    metadata: dict = None
     text: str = ""
-    start: datetime = None
-    end: datetime = None
+    start_ns: int = None
+    end_ns: int = None
     automata_id: str = ""
     session_id: str = None
     parent_id: str = None
-    iteration_tree: list[int] = field(default_factory=list)
+    iteration_tree: tuple[int, ...] = ()
     # Success is false if a step fails
     success: bool = True
+
+    def __post_init__(self) -> None:
+        self.automata_id = StepData.intern(self.automata_id)
+        self.session_id = StepData.intern(self.session_id)
+        self.parent_id = StepData.intern(self.parent_id)
+        if not isinstance(self.iteration_tree, tuple):
+            self.iteration_tree = tuple(self.iteration_tree)
+
+    @property
+    def start(self) -> datetime:
+        return StepData.to_datetime(self.start_ns)
+
+    @start.setter
+    def start(self, value: datetime) -> None:
+        self.start_ns = StepData.from_datetime(value)
+
+    @property
+    def end(self) -> datetime:
+        return StepData.to_datetime(self.end_ns)
+
+    @end.setter
+    def end(self, value: datetime) -> None:
+        self.end_ns = StepData.from_datetime(value)
+
+    @staticmethod
+    def now_ns() -> int:
+        return time.monotonic_ns()
+
+    @staticmethod
+    def to_datetime(monotonic_ns: int) -> datetime:
+        if monotonic_ns is None:
+            return None
+        return datetime.fromtimestamp((WALL_ANCHOR_NS + monotonic_ns - MONOTONIC_ANCHOR_NS) / 1e9)
+
+    @staticmethod
+    def from_datetime(value: datetime) -> int:
+        if value is None:
+            return None
+        return MONOTONIC_ANCHOR_NS + int(value.timestamp() * 1e9) - WALL_ANCHOR_NS
+
+    # Monotonic clocks differ between processes, so timestamps crossing a
+    # process boundary travel as wall clock time
+    @staticmethod
+    def to_wall_ns(monotonic_ns: int) -> int:
+        if monotonic_ns is None:
+            return None
+        return WALL_ANCHOR_NS + monotonic_ns - MONOTONIC_ANCHOR_NS
+
+    @staticmethod
+    def from_wall_ns(wall_ns: int) -> int:
+        if wall_ns is None:
+            return None
+        return MONOTONIC_ANCHOR_NS + wall_ns - WALL_ANCHOR_NS
+
+    @staticmethod
+    def intern(value: str) -> str:
+        return sys.intern(value) if type(value) is str else value
+    
+    # Fields as a dict, dated on the wall clock rather than monotonic
+    def to_dict(self) -> dict:
+        return {'input_data': self.input_data, 'failure_data': self.failure_data, 'output_data': self.output_data,
+                'metadata': self.metadata, 'text': self.text, 'start': self.start, 'end': self.end, 'automata_id': self.automata_id,
+                'session_id': self.session_id, 'parent_id': self.parent_id, 'iteration_tree': self.iteration_tree,
+                'success': self.success}
     
     @classmethod
     def from_dict(cls, args):
+        args = dict(args)
+        # Records from before timestamps were monotonic
+        for name in ('start', 'end'):
+            value = args.pop(name, None)
+            if isinstance(value, str):
+                value = datetime.fromisoformat(value)
+            if value is not None and args.get(name + '_ns', None) is None:
+                args[name + '_ns'] = cls.from_datetime(value)
+        names = {field.name for field in dataclasses.fields(cls)}
         return cls(**{
             k: v for k, v in args.items() 
-            if k in inspect.signature(cls).parameters
+            if k in names
         })
 
+# `start` and `end` are still accepted as datetimes when constructing, as they
+# were before times were monotonic
+_step_data_init = StepData.__init__
+def _init_step_data(self, *, start: datetime = None, end: datetime = None, **fields) -> None:
+    _step_data_init(self, **fields)
+    if start is not None:
+        self.start = start
+    if end is not None:
+        self.end = end
+StepData.__init__ = _init_step_data
+
 class GraphData:
     
     @abstractmethod
     def fetch_all_data(self) -> list[StepData]:
         pass
+    # Iterate stored records without copying them, for readers such as export
+    # that only serialize them; large payloads may still be packed. Stores
+    # that can stream their records should override this
+    def iter_data(self) -> Iterator[StepData]:
+        yield from self.fetch_all_data()
+    # Keyed by "<automata id>::<iteration tree>"
     @abstractmethod
     def fetch_all_data_dict(self) -> OrderedDict[str, StepData]:
         pass
     @abstractmethod
-    def fetch_datas(self, query_dict: dict[str, list[int]]) -> list[StepData]:
+    def fetch_datas(self, query_dict: dict[str, tuple[int, ...]]) -> list[StepData]:
         pass
     @abstractmethod
-    def fetch_data(self, id: str, iteration_tree: list[int]) -> StepData:
+    def fetch_data(self, id: str, iteration_tree: tuple[int, ...]) -> StepData:
         pass
+    # Read-only access to a stored step, for callers that only need a slice of
+    # it (e.g. input projection) and will copy that slice themselves. Stores that
+    # can hand out references without copying should override this
+    def fetch_data_view(self, id: str, iteration_tree: tuple[int, ...]) -> StepData:
+        return self.fetch_data(id, iteration_tree)
     @abstractmethod
     def fetch_last_data_by_id(self, id: str) -> StepData:
         pass
@@ -53,6 +200,9 @@ class GraphData:
     @abstractmethod
     def put_data(self, step_data: StepData) -> None:
         pass
+    # The MemoryAccount stored data is charged to, if the store keeps one
+    def get_memory_account(self):
+        return None
     
     
     @staticmethod
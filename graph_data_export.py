@@ -0,0 +1,126 @@
+from __future__ import annotations
+import io
+from typing import BinaryIO, Iterable
+import orjson as json
+from graph_data import GraphData, PackedPayload, StepData
+
+class StepDataFilter:
+    """Selects step records by node ID and by iteration: records whose
+    iteration tree starts with `iteration_tree`, e.g. (0, 2) for the third
+    pass of a loop and everything nested in it"""
+    def __init__(self, ids: Iterable[str] = None, iteration_tree: Iterable[int] = None):
+        self.ids = frozenset(ids) if ids else None
+        self.iteration_tree = tuple(iteration_tree) if iteration_tree is not None else None
+
+    def matches(self, automata_id: str, iteration_tree: Iterable[int]) -> bool:
+        if self.ids is not None and automata_id not in self.ids:
+            return False
+        if self.iteration_tree is not None:
+            iteration_tree = tuple(iteration_tree)
+            return iteration_tree[:len(self.iteration_tree)] == self.iteration_tree
+        return True
+
+class GraphDataExport:
+    """Streams session graph data as NDJSON, one step record per line, to and
+    from files, sockets or any binary stream. Records are encoded and decoded
+    one at a time, so memory use doesn't grow with the session. Streams are
+    optionally gzip compressed; targets ending in .gz are compressed, and
+    compressed input is detected on import"""
+    GZIP_SUFFIX = '.gz'
+    GZIP_MAGIC = b'\x1f\x8b'
+    # Encoded lines are written in batches of about this many bytes
+    BATCH_BYTES = 64 * 1024
+    COMPRESS_LEVEL = 6
+
+    # A binary stream for `target`: a file path, or tcp://host:port to
+    # connect to a listening socket
+    @staticmethod
+    def open_target(target: str, mode: str) -> BinaryIO:
+        if target.startswith('tcp://'):
+            import socket
+            host, _, port = target[len('tcp://'):].rpartition(':')
+            connection = socket.create_connection((host, int(port)))
+            # The file keeps the socket open until it's closed itself
+            stream = connection.makefile(mode)
+            connection.close()
+            return stream
+        return open(target, mode)
+
+    # Encode a stored record; packed payloads are written as they are stored,
+    # without decoding them
+    @staticmethod
+    def encode(step_data: StepData) -> bytes:
+        record = step_data.to_dict()
+        for key in ('input_data', 'output_data'):
+            if isinstance(record[key], PackedPayload):
+                record[key] = json.Fragment(record[key].data)
+        return json.dumps(record, default=str, option=json.OPT_NON_STR_KEYS | json.OPT_APPEND_NEWLINE)
+
+    # Write the matching records of `graph_data` to `stream`, returning how many
+    @staticmethod
+    def export_stream(graph_data: GraphData, stream: BinaryIO, step_filter: StepDataFilter = None,
+                      compress: bool = False) -> int:
+        output = stream
+        if compress:
+            import gzip
+            output = gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=GraphDataExport.COMPRESS_LEVEL)
+        count = 0
+        batch = bytearray()
+        try:
+            for step_data in graph_data.iter_data():
+                if step_filter is not None and not step_filter.matches(step_data.automata_id, step_data.iteration_tree):
+                    continue
+                batch += GraphDataExport.encode(step_data)
+                count += 1
+                if len(batch) >= GraphDataExport.BATCH_BYTES:
+                    output.write(batch)
+                    batch.clear()
+            output.write(batch)
+        finally:
+            if output is not stream:
+                output.close()
+        stream.flush()
+        return count
+
+    @staticmethod
+    def export_to(graph_data: GraphData, target: str, step_filter: StepDataFilter = None,
+                  compress: bool = None) -> int:
+        if compress is None:
+            compress = target.endswith(GraphDataExport.GZIP_SUFFIX)
+        with GraphDataExport.open_target(target, 'wb') as stream:
+            return GraphDataExport.export_stream(graph_data, stream, step_filter, compress)
+
+    # Yield the matching records read from `stream`, decompressing it if needed
+    @staticmethod
+    def read_stream(stream: BinaryIO, step_filter: StepDataFilter = None) -> Iterable[StepData]:
+        if not hasattr(stream, 'peek'):
+            stream = io.BufferedReader(stream)
+        lines = stream
+        if stream.peek(len(GraphDataExport.GZIP_MAGIC))[:len(GraphDataExport.GZIP_MAGIC)] == GraphDataExport.GZIP_MAGIC:
+            import gzip
+            lines = gzip.GzipFile(fileobj=stream, mode='rb')
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise Exception('Line {} of the graph data stream is not valid JSON: {}'.format(number, e))
+            if step_filter is not None and not step_filter.matches(record.get('automata_id', ''),
+                                                                   record.get('iteration_tree', ())):
+                continue
+            yield StepData.from_dict(record)
+
+    # Store the matching records read from `stream` in `graph_data`, returning how many
+    @staticmethod
+    def import_stream(graph_data: GraphData, stream: BinaryIO, step_filter: StepDataFilter = None) -> int:
+        count = 0
+        for step_data in GraphDataExport.read_stream(stream, step_filter):
+            graph_data.put_data(step_data)
+            count += 1
+        return count
+
+    @staticmethod
+    def import_from(graph_data: GraphData, target: str, step_filter: StepDataFilter = None) -> int:
+        with GraphDataExport.open_target(target, 'rb') as stream:
+            return GraphDataExport.import_stream(graph_data, stream, step_filter)
@@ -1,9 +1,26 @@
 
 
 from abc import abstractmethod
+import importlib
+import threading
+from typing import Iterable
 from graph_data import StepData
 
 class Handler:
+    # Handler backends are imported on demand, keyed on the handler prefixes
+    # referenced by the loaded graph, so graphs without scripting steps never
+    # pay for importing the JavaScript or Python sandboxes
+    HANDLER_MODULES: dict[str, str] = {
+        'native::': 'native_handler',
+        'js::': 'js_handler',
+        'py::': 'py_handler',
+    }
+    # Per-thread context bound by the automata invoking a handler, for handlers
+    # that need more than their arguments (e.g. the step's socket)
+    CONTEXT = threading.local()
+    # Automata config fields that reference handlers
+    HANDLER_FIELDS: tuple[str] = ('input_handler', 'output_handler', 
+                                  'system_prompt_handler', 'user_prompt_handler')
     
     @staticmethod
     @abstractmethod
@@ -21,13 +38,67 @@ class Handler:
                        config: dict, input: str) -> None:
         pass
     
+    @staticmethod
+    def bind_context(socket = None, graph_data = None, automata_config = None, partial_outputs = None) -> None:
+        Handler.CONTEXT.socket = socket
+        Handler.CONTEXT.graph_data = graph_data
+        Handler.CONTEXT.automata_config = automata_config
+        Handler.CONTEXT.partial_outputs = partial_outputs
+    
+    # The socket of the step being handled on this thread, or None if the step
+    # isn't socket-enabled
+    @staticmethod
+    def get_socket():
+        return getattr(Handler.CONTEXT, 'socket', None)
+    
+    # The config of the step being handled on this thread, for handlers with
+    # per-node settings (e.g. the output schema)
+    @staticmethod
+    def get_automata_config():
+        return getattr(Handler.CONTEXT, 'automata_config', None)
+    
+    # The run's PartialOutputBus, to read upstream output while it streams in
+    @staticmethod
+    def get_partial_outputs():
+        return getattr(Handler.CONTEXT, 'partial_outputs', None)
+    
+    @staticmethod
+    def register_handler_module(prefix: str, module: str) -> None:
+        Handler.HANDLER_MODULES[prefix] = module
+    
+    @staticmethod
+    def get_handler_refs(automata_configs: list) -> set[str]:
+        return {getattr(automata_config, field) for automata_config in automata_configs 
+                for field in Handler.HANDLER_FIELDS if getattr(automata_config, field, None)}
+    
+    # Import the backend module for each handler prefix in use; the native 
+    # handler is always loaded as it provides the default handlers
+    @staticmethod
+    def load_handlers(handler_refs: Iterable[str]) -> None:
+        modules = {Handler.HANDLER_MODULES['native::']}
+        for handler_ref in handler_refs:
+            for prefix, module in Handler.HANDLER_MODULES.items():
+                if handler_ref.startswith(prefix):
+                    modules.add(module)
+        for module in modules:
+            importlib.import_module(module)
+        from native_handler import NativeHandler
+        NativeHandler.load_callbacks(handler_refs)
+    
     @staticmethod
     def format_handler(prefix: str, handler: str) -> str:
         return handler.removeprefix(prefix)
         
       
     from graph_data import GraphData
-    GRAPH_DATA: GraphData
+    GRAPH_DATA: GraphData = None
     @staticmethod
     def set_graph_data(graph_data: GraphData):
-        Handler.GRAPH_DATA = graph_data
\ No newline at end of file
+        Handler.GRAPH_DATA = graph_data
+    
+    # The graph data of the run being handled on this thread, falling back to
+    # the process-wide graph data set with set_graph_data
+    @staticmethod
+    def get_graph_data() -> GraphData:
+        graph_data = getattr(Handler.CONTEXT, 'graph_data', None)
+        return graph_data if graph_data is not None else Handler.GRAPH_DATA
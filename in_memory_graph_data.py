@@ -1,25 +1,50 @@
 
 import copy
-from automata.automata import GraphData
+import dataclasses
+import threading
+from typing import Iterator
+from graph_data import GraphData, PackedPayload
 from graph_data import StepData
 from collections import OrderedDict
+from memory_accounting import MemoryAccount, MemoryAccounting
 
 class InMemoryGraphData(GraphData):
-    data_store: list[StepData] = []
-    data_store_dict: OrderedDict[str, StepData] = {}
+    # Input and output data encoding to at least this many bytes of JSON are
+    # stored packed, and decoded when fetched
+    PACK_BYTES = 64 * 1024
     
-    def __init__(self) -> None:
-        self.data_store = InMemoryGraphData.data_store
-        self.data_store_dict = InMemoryGraphData.data_store_dict
+    # Each instance holds one run's data, so concurrent runs stay isolated.
+    # With a memory account, stored data is sized and charged to it, and
+    # put_data raises a MemoryBudgetException rather than exceed its cap.
+    # `pack_bytes` of 0 or less stores every payload unpacked
+    def __init__(self, memory_account: MemoryAccount = None, pack_bytes: int = None) -> None:
+        self.memory_account = memory_account
+        self.pack_bytes = pack_bytes if pack_bytes is not None else InMemoryGraphData.PACK_BYTES
+        self.data_store: list[StepData] = []
+        self.data_store_dict: OrderedDict[tuple[str, tuple[int, ...]], StepData] = OrderedDict()
+        self.lock = threading.Lock()
         GraphData.register_graph_data(self)
         
     def fetch_all_data(self) -> list[StepData]:
-        return copy.deepcopy(self.data_store)
+        with self.lock:
+            records = list(self.data_store)
+        return [self._unpack(record, True) for record in records]
     
     def fetch_all_data_dict(self) -> dict[str, StepData]:
-        return copy.deepcopy(self.data_store_dict)
+        with self.lock:
+            records = list(self.data_store_dict.values())
+        return OrderedDict((self._format_key(record.automata_id, record.iteration_tree), self._unpack(record, True))
+                           for record in records)
         
-    def fetch_datas(self, query_dict: dict[str, dict[str, list[int]]]) -> list[StepData]:
+    # The store is append only, so records can be read by index without holding
+    # the lock or copying the list; records stored meanwhile are included
+    def iter_data(self) -> Iterator[StepData]:
+        index = 0
+        while index < len(self.data_store):
+            yield self.data_store[index]
+            index += 1
+    
+    def fetch_datas(self, query_dict: dict[str, tuple[int, ...]]) -> list[StepData]:
         step_datas: list[StepData] = []
         for id, iteration_tree in query_dict.items():
             step_data = self.fetch_data(id, iteration_tree)
@@ -28,8 +53,11 @@ class InMemoryGraphData(GraphData):
         return step_datas
 
     # Lots of more efficient ways to do this, this is fine for now
-    def fetch_data(self, id: str, iteration_tree: list[int]) -> StepData:
-        return copy.deepcopy(self.data_store_dict.get(self._format_id(id, iteration_tree), None))
+    def fetch_data(self, id: str, iteration_tree: tuple[int, ...]) -> StepData:
+        return self._unpack(self.data_store_dict.get(self._format_id(id, iteration_tree), None), True)
+    
+    def fetch_data_view(self, id: str, iteration_tree: tuple[int, ...]) -> StepData:
+        return self._unpack(self.data_store_dict.get(self._format_id(id, iteration_tree), None), False)
     
     def fetch_last_data_by_id(self, id: str) -> StepData:
         items = self.fetch_all_data_by_id(id)
@@ -43,15 +71,59 @@ class InMemoryGraphData(GraphData):
         return None
     def fetch_all_data_by_id(self, id: str) -> StepData:
         output: list[StepData] = []
-        for item in self.data_store:
+        with self.lock:
+            items = list(self.data_store)
+        for item in items:
             if item.automata_id == id:
-                output.append(item)
-        output.sort(key=lambda sd: sd.start)
+                output.append(self._unpack(item, False))
+        # Steps that never started sort last
+        output.sort(key=lambda sd: (sd.start_ns is None, sd.start_ns or 0))
         return output
     
+    def get_memory_account(self) -> MemoryAccount | None:
+        return self.memory_account
+    
     def put_data(self, step_data: StepData) -> None:
-        self.data_store.append(step_data)
-        self.data_store_dict[self._format_id(step_data.automata_id, step_data.iteration_tree)] = step_data
+        record = self._pack(step_data)
+        # Packed payloads are sized by their encoding, without encoding them again
+        size = MemoryAccounting.estimate_size(record) if self.memory_account is not None else 0
+        with self.lock:
+            if self.memory_account is not None:
+                self.memory_account.reserve(record.automata_id, size)
+            self.data_store.append(record)
+            self.data_store_dict[self._format_id(record.automata_id, record.iteration_tree)] = record
     
-    def _format_id(self, id: str, iteration_tree: list[int]) -> str:
-        return "{}::{}".format(id, iteration_tree)
\ No newline at end of file
+    # The record stored for a step, with its large payloads packed. The caller's
+    # step data is left as is
+    def _pack(self, step_data: StepData) -> StepData:
+        input_data = PackedPayload.pack(step_data.input_data, self.pack_bytes)
+        output_data = PackedPayload.pack(step_data.output_data, self.pack_bytes)
+        if input_data is step_data.input_data and output_data is step_data.output_data:
+            return step_data
+        return dataclasses.replace(step_data, input_data=input_data, output_data=output_data)
+    
+    # A stored record with its payloads decoded, copied unless it's a view
+    def _unpack(self, record: StepData, copied: bool) -> StepData:
+        if record is None:
+            return None
+        if not isinstance(record.input_data, PackedPayload) and not isinstance(record.output_data, PackedPayload):
+            return copy.deepcopy(record) if copied else record
+        # Decoding makes fresh payloads, so only the rest needs copying
+        unpacked = dataclasses.replace(record, input_data=None, output_data=None)
+        if copied:
+            unpacked = copy.deepcopy(unpacked)
+        for field in ('input_data', 'output_data'):
+            value = getattr(record, field)
+            if isinstance(value, PackedPayload):
+                value = value.unpack()
+            elif copied:
+                value = copy.deepcopy(value)
+            setattr(unpacked, field, value)
+        return unpacked
+    
+    def _format_id(self, id: str, iteration_tree: tuple[int, ...]) -> tuple[str, tuple[int, ...]]:
+        return (id, tuple(iteration_tree))
+
+    # The key of a step in fetch_all_data_dict; the store's own keys are tuples
+    def _format_key(self, id: str, iteration_tree: tuple[int, ...]) -> str:
+        return "{}::{}".format(id, list(iteration_tree))
\ No newline at end of file
@@ -25,8 +25,8 @@ class JSHandler(Handler):
          {handler};
          JSON.stringify({handler_ref}({input_step_datas}, {all_graph_data}, {input}, {config}));
                      """.format(handler_ref = self.handler_ref,
-                                input_step_datas=json.dumps(input_step_datas),
-                                all_graph_data=Handler.GRAPH_DATA.fetch_all_data(),
+                                input_step_datas=json.dumps([data.to_dict() for data in input_step_datas]),
+                                all_graph_data=Handler.get_graph_data().fetch_all_data(),
                                 input=json.dumps(input),
                               config=json.dumps(config), 
                               handler=handler)
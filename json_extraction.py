@@ -0,0 +1,450 @@
+import re
+import threading
+import orjson as json
+
+class JsonExtractionException(Exception):
+    pass
+
+class JsonExtractor:
+    """Finds and parses the JSON payload in model output. Stages are tried
+    cheapest first, and the one that succeeded is reported:
+
+        direct  the whole text is JSON
+        fence   a Markdown code fence holds JSON
+        scan    a balanced {...} or [...] span, e.g. after some preamble
+        repair  near-JSON made parseable: trailing commas, Python literals,
+                and output cut off mid-value closed off
+    """
+    FENCE_PATTERN = re.compile(r'```[a-zA-Z0-9_-]*[ \t]*\r?\n(.*?)```', re.DOTALL)
+    # Bounds the work spent on text with many stray brackets
+    MAX_SCAN_CANDIDATES = 16
+    LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+    METRICS: dict[str, int] = {'direct': 0, 'fence': 0, 'scan': 0, 'repair': 0, 'failed': 0, 'schema_failed': 0}
+    FAILURES_BY_ID: dict[str, int] = {}
+    METRICS_LOCK = threading.Lock()
+
+    @staticmethod
+    def extract(text: str, repair: bool = True) -> tuple[object, str]:
+        try:
+            return json.loads(text), 'direct'
+        except json.JSONDecodeError:
+            pass
+        for match in JsonExtractor.FENCE_PATTERN.finditer(text):
+            try:
+                return json.loads(match.group(1)), 'fence'
+            except json.JSONDecodeError:
+                pass
+        value = JsonExtractor.scan(text)
+        if value is not None:
+            return value, 'scan'
+        if repair:
+            start = JsonExtractor._find_start(text, 0)
+            if start >= 0:
+                try:
+                    return json.loads(JsonExtractor.repair(text[start:])), 'repair'
+                except json.JSONDecodeError:
+                    pass
+        raise JsonExtractionException('No JSON object or array found in output')
+
+    @staticmethod
+    def _find_start(text: str, position: int) -> int:
+        starts = [index for index in (text.find('{', position), text.find('[', position)) if index >= 0]
+        return min(starts) if len(starts) > 0 else -1
+
+    # Parse the first balanced object or array span that is valid JSON
+    @staticmethod
+    def scan(text: str) -> object | None:
+        start = JsonExtractor._find_start(text, 0)
+        candidates = 0
+        while start >= 0 and candidates < JsonExtractor.MAX_SCAN_CANDIDATES:
+            candidates += 1
+            end = JsonExtractor._find_end(text, start)
+            if end > start:
+                try:
+                    return json.loads(text[start:end])
+                except json.JSONDecodeError:
+                    pass
+            start = JsonExtractor._find_start(text, start + 1)
+        return None
+
+    # Index just past the bracket closing the one at `start`, or -1
+    @staticmethod
+    def _find_end(text: str, start: int) -> int:
+        depth = 0
+        in_string = False
+        escaped = False
+        for index in range(start, len(text)):
+            char = text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{' or char == '[':
+                depth += 1
+            elif char == '}' or char == ']':
+                depth -= 1
+                if depth == 0:
+                    return index + 1
+        return -1
+
+    @staticmethod
+    def repair(text: str) -> str:
+        output: list[str] = []
+        stack: list[str] = []
+        in_string = False
+        escaped = False
+        index = 0
+        while index < len(text):
+            char = text[index]
+            if in_string:
+                output.append(char)
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+                output.append(char)
+            elif char == '{' or char == '[':
+                stack.append('}' if char == '{' else ']')
+                output.append(char)
+            elif char == '}' or char == ']':
+                JsonExtractor._strip_trailing_comma(output)
+                if len(stack) > 0:
+                    output.append(stack.pop())
+                if len(stack) == 0:
+                    break
+            elif char.isalpha():
+                end = index
+                while end < len(text) and (text[end].isalnum() or text[end] == '_'):
+                    end += 1
+                word = text[index:end]
+                output.append(JsonExtractor.LITERALS.get(word, word))
+                index = end
+                continue
+            elif char == '`':
+                # The closing fence of a block cut off before its end
+                break
+            else:
+                output.append(char)
+            index += 1
+        if in_string:
+            if escaped:
+                output.pop()
+            output.append('"')
+        # Drop a dangling key or separator left by truncated output
+        JsonExtractor._strip_trailing_comma(output)
+        tail = ''.join(output[-200:]).rstrip()
+        if tail.endswith(':'):
+            output.append(' null')
+        for closing in reversed(stack):
+            JsonExtractor._strip_trailing_comma(output)
+            output.append(closing)
+        return ''.join(output)
+
+    @staticmethod
+    def _strip_trailing_comma(output: list[str]) -> None:
+        index = len(output) - 1
+        while index >= 0 and output[index].isspace():
+            index -= 1
+        if index >= 0 and output[index] == ',':
+            del output[index:]
+
+    @staticmethod
+    def record(stage: str, id: str = None) -> None:
+        with JsonExtractor.METRICS_LOCK:
+            JsonExtractor.METRICS[stage] = JsonExtractor.METRICS.get(stage, 0) + 1
+            if id is not None and stage in ('failed', 'schema_failed'):
+                JsonExtractor.FAILURES_BY_ID[id] = JsonExtractor.FAILURES_BY_ID.get(id, 0) + 1
+
+    @staticmethod
+    def get_metrics() -> dict:
+        with JsonExtractor.METRICS_LOCK:
+            return {**JsonExtractor.METRICS, 'failures_by_id': dict(JsonExtractor.FAILURES_BY_ID)}
+
+class JsonSchemaValidator:
+    """Validates values against a small subset of JSON Schema: type,
+    properties, required, additionalProperties (boolean), items, enum,
+    minItems/maxItems and minLength/maxLength"""
+    TYPES = {
+        'object': lambda value: isinstance(value, dict),
+        'array': lambda value: isinstance(value, list),
+        'string': lambda value: isinstance(value, str),
+        'number': lambda value: isinstance(value, (int, float)) and not isinstance(value, bool),
+        'integer': lambda value: isinstance(value, int) and not isinstance(value, bool),
+        'boolean': lambda value: isinstance(value, bool),
+        'null': lambda value: value is None,
+    }
+    # Caps the report for badly wrong output
+    MAX_ERRORS = 20
+
+    @staticmethod
+    def check_schema(schema: dict, path: str = '$') -> list[str]:
+        if not isinstance(schema, dict):
+            return ['{}: schema must be an object'.format(path)]
+        errors = []
+        types = schema.get('type', None)
+        for type in ([types] if isinstance(types, str) else types or []):
+            if type not in JsonSchemaValidator.TYPES:
+                errors.append('{}: unknown type {}'.format(path, type))
+        for name, subschema in (schema.get('properties', None) or {}).items():
+            errors += JsonSchemaValidator.check_schema(subschema, '{}.{}'.format(path, name))
+        if 'items' in schema:
+            errors += JsonSchemaValidator.check_schema(schema['items'], path + '[]')
+        return errors
+
+    @staticmethod
+    def validate(value, schema: dict, path: str = '$', errors: list[str] = None) -> list[str]:
+        errors = [] if errors is None else errors
+        if len(errors) >= JsonSchemaValidator.MAX_ERRORS:
+            return errors
+        types = schema.get('type', None)
+        if types is not None:
+            types = [types] if isinstance(types, str) else types
+            if not any(JsonSchemaValidator.TYPES[type](value) for type in types):
+                errors.append('{}: expected {}, got {}'.format(path, ' or '.join(types), JsonSchemaValidator._type_name(value)))
+                return errors
+        if 'enum' in schema and value not in schema['enum']:
+            errors.append('{}: {} is not one of {}'.format(path, json.dumps(value).decode('utf-8')[:50], schema['enum']))
+        if isinstance(value, dict):
+            properties = schema.get('properties', None) or {}
+            for name in schema.get('required', None) or []:
+                if name not in value:
+                    errors.append('{}: missing required property {}'.format(path, name))
+            for name, item in value.items():
+                if name in properties:
+                    JsonSchemaValidator.validate(item, properties[name], '{}.{}'.format(path, name), errors)
+                elif schema.get('additionalProperties', True) == False:
+                    errors.append('{}: unexpected property {}'.format(path, name))
+        elif isinstance(value, list):
+            if len(value) < schema.get('minItems', 0):
+                errors.append('{}: expected at least {} items'.format(path, schema['minItems']))
+            if 'maxItems' in schema and len(value) > schema['maxItems']:
+                errors.append('{}: expected at most {} items'.format(path, schema['maxItems']))
+            if 'items' in schema:
+                for index, item in enumerate(value):
+                    JsonSchemaValidator.validate(item, schema['items'], '{}[{}]'.format(path, index), errors)
+        elif isinstance(value, str):
+            if len(value) < schema.get('minLength', 0):
+                errors.append('{}: expected at least {} characters'.format(path, schema['minLength']))
+            if 'maxLength' in schema and len(value) > schema['maxLength']:
+                errors.append('{}: expected at most {} characters'.format(path, schema['maxLength']))
+        return errors
+
+    @staticmethod
+    def _type_name(value) -> str:
+        for name, check in JsonSchemaValidator.TYPES.items():
+            if check(value):
+                return name
+        return type(value).__name__
+
+class IncrementalJsonParser:
+    """Parses a JSON document fed in arbitrary chunks, e.g. tokens streamed
+    from a model, calling `on_value(path, value)` as each value completes:
+    leaf values, then their containers, ending with the document itself at
+    path (). Paths are tuples of object keys and array indices. Text before
+    the first { or [ (preamble, a code fence) and after the document is
+    skipped, and trailing commas are tolerated. Parsing stops at the first
+    malformed token, leaving the complete response to JsonExtractor.
+
+    Completed values are handed out as built; containers keep filling in as
+    parsing goes on, so consumers must not modify them"""
+    WHITESPACE = re.compile(r'[ \t\r\n]*')
+    STRING_STOP = re.compile(r'["\\]')
+    SCALAR = re.compile(r'-?[0-9][0-9eE+.\-]*|true|false|null')
+    LITERALS = ('true', 'false', 'null', '-')
+
+    def __init__(self, on_value=None):
+        self.on_value = on_value
+        self.buffer = ''
+        self.position = 0
+        # Chunks held back while a string is still open, joined once it closes
+        self.chunks: list[str] = []
+        # Whether the held back text ends in an unfinished escape
+        self.escaped = False
+        # Open containers, as [container, path, state, pending key]
+        self.stack: list[list] = []
+        # Where the scan of a string split across chunks resumes
+        self.string_scan = 0
+        self.value = None
+        self.done = False
+        self.failed = False
+
+    def feed(self, chunk: str) -> None:
+        if self.done or self.failed:
+            return
+        if self.string_scan > 0 and not self._closes_string(chunk):
+            self.chunks.append(chunk)
+            return
+        self._compact(chunk)
+        self._parse(False)
+
+    # Parse whatever is left, returning the document or None if incomplete
+    def finish(self):
+        if not self.done and not self.failed:
+            self._compact('')
+            self._parse(True)
+        return self.value if self.done else None
+
+    # Drop the parsed text, keeping the unfinished token, and append the
+    # held back chunks
+    def _compact(self, chunk: str) -> None:
+        self.buffer = self.buffer[self.position:] + ''.join(self.chunks) + chunk
+        self.chunks = []
+        self.string_scan -= self.position
+        self.position = 0
+
+    # Whether a chunk arriving inside an unfinished string can end it; only
+    # the chunk is scanned, so a long string isn't copied for every chunk
+    def _closes_string(self, chunk: str) -> bool:
+        if len(self.chunks) == 0:
+            # The scan stops short of the end at a trailing backslash
+            self.escaped = self.string_scan < len(self.buffer)
+        index = 0
+        if self.escaped:
+            if len(chunk) == 0:
+                return False
+            index = 1
+        while True:
+            match = self.STRING_STOP.search(chunk, index)
+            if match is None:
+                self.escaped = False
+                return False
+            if match.group(0) == '"':
+                return True
+            if match.start() + 1 >= len(chunk):
+                self.escaped = True
+                return False
+            index = match.start() + 2
+
+    def _parse(self, final: bool) -> None:
+        buffer = self.buffer
+        while not self.done and not self.failed:
+            if len(self.stack) == 0:
+                start = JsonExtractor._find_start(buffer, self.position)
+                if start < 0:
+                    self.position = len(buffer)
+                    return
+                self.position = start + 1
+                self._open(buffer[start], ())
+                continue
+            self.position = self.WHITESPACE.match(buffer, self.position).end()
+            if self.position >= len(buffer):
+                return
+            frame = self.stack[-1]
+            char = buffer[self.position]
+            state = frame[2]
+            if char == '}' or char == ']':
+                is_object = isinstance(frame[0], dict)
+                if (char == '}') != is_object or state == 'colon' or (is_object and state == 'value'):
+                    self.failed = True
+                    return
+                self.position += 1
+                self.stack.pop()
+                self._complete(frame[0], frame[1])
+            elif char == ',':
+                if state != 'next':
+                    self.failed = True
+                    return
+                self.position += 1
+                frame[2] = 'key' if isinstance(frame[0], dict) else 'value'
+            elif char == ':':
+                if state != 'colon':
+                    self.failed = True
+                    return
+                self.position += 1
+                frame[2] = 'value'
+            elif state == 'key':
+                if char != '"':
+                    self.failed = True
+                    return
+                key = self._read_string(buffer)
+                if key is None:
+                    return
+                frame[3] = key
+                frame[2] = 'colon'
+            elif state != 'value':
+                self.failed = True
+                return
+            elif char == '{' or char == '[':
+                self.position += 1
+                self._open(char, frame[1] + (self._get_key(frame),))
+            elif char == '"':
+                value = self._read_string(buffer)
+                if value is None:
+                    return
+                self._add(frame, value)
+            else:
+                match = self.SCALAR.match(buffer, self.position)
+                if match is None:
+                    # A literal split across chunks
+                    rest = buffer[self.position:]
+                    if not final and any(literal.startswith(rest) for literal in self.LITERALS):
+                        return
+                    self.failed = True
+                    return
+                if match.end() == len(buffer) and not final:
+                    return
+                try:
+                    value = json.loads(match.group(0))
+                except json.JSONDecodeError:
+                    self.failed = True
+                    return
+                self.position = match.end()
+                self._add(frame, value)
+
+    def _open(self, char: str, path: tuple) -> None:
+        self.stack.append([{} if char == '{' else [], path, 'key' if char == '{' else 'value', None])
+
+    def _get_key(self, frame: list):
+        return frame[3] if isinstance(frame[0], dict) else len(frame[0])
+
+    def _add(self, frame: list, value) -> None:
+        key = self._get_key(frame)
+        if isinstance(frame[0], dict):
+            frame[0][key] = value
+        else:
+            frame[0].append(value)
+        frame[2] = 'next'
+        if self.on_value is not None:
+            self.on_value(frame[1] + (key,), value)
+
+    def _complete(self, container, path: tuple) -> None:
+        if len(self.stack) == 0:
+            self.value = container
+            self.done = True
+            if self.on_value is not None:
+                self.on_value(path, container)
+        else:
+            self._add(self.stack[-1], container)
+
+    # Decode the string starting at the current position, or return None
+    # (keeping the position) if its closing quote hasn't arrived yet
+    def _read_string(self, buffer: str):
+        index = max(self.position + 1, self.string_scan)
+        while True:
+            match = self.STRING_STOP.search(buffer, index)
+            if match is None or match.start() + 1 >= len(buffer) and match.group(0) == '\\':
+                self.string_scan = match.start() if match is not None else len(buffer)
+                return None
+            if match.group(0) == '\\':
+                index = match.start() + 2
+                continue
+            end = match.end()
+            break
+        try:
+            value = json.loads(buffer[self.position:end])
+        except json.JSONDecodeError:
+            self.failed = True
+            return None
+        self.position = end
+        self.string_scan = 0
+        return value
@@ -0,0 +1,112 @@
+import threading
+import weakref
+import orjson as json
+from graph_data import PackedPayload, StepData
+
+class MemoryBudgetException(Exception):
+    pass
+
+class MemoryAccount:
+    """Bytes of step data held by one session, against an optional cap. Sizes
+    are estimates, the length of the data serialized as JSON"""
+    def __init__(self, name: str, max_bytes: int = 0):
+        self.name = name
+        # 0 or less for no cap
+        self.max_bytes = max_bytes
+        self.peak = 0
+        self.by_node: dict[str, int] = {}
+        self.breaches = 0
+        self.lock = threading.Lock()
+        # Shared with the finalizer, which can't hold a reference to the account
+        self.usage = [0]
+        self.release_all = weakref.finalize(self, MemoryAccounting.release, self.usage)
+        MemoryAccounting.register(self)
+
+    def get_current(self) -> int:
+        return self.usage[0]
+
+    def reserve(self, automata_id: str, size: int) -> None:
+        with self.lock:
+            if self.max_bytes > 0 and self.usage[0] + size > self.max_bytes:
+                self.breaches += 1
+                raise MemoryBudgetException('Step {} needs {} bytes, over the session budget of {} bytes ({} in use)'.format(
+                    automata_id, size, self.max_bytes, self.usage[0]))
+            self.usage[0] += size
+            self.peak = max(self.peak, self.usage[0])
+            self.by_node[automata_id] = self.by_node.get(automata_id, 0) + size
+        MemoryAccounting.add(size)
+
+    # Record a breach that was caught elsewhere, e.g. of a node budget
+    def record_breach(self) -> None:
+        with self.lock:
+            self.breaches += 1
+
+    # Release everything, once the session's data is dropped
+    def close(self) -> None:
+        self.release_all()
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            largest = sorted(self.by_node.items(), key=lambda item: item[1], reverse=True)[:MemoryAccounting.TOP_N]
+            return {'current_bytes': self.usage[0], 'peak_bytes': self.peak, 'max_bytes': self.max_bytes,
+                    'breaches': self.breaches, 'largest_nodes': dict(largest)}
+
+class MemoryAccounting:
+    """Process-wide totals over all live memory accounts"""
+    LOCK = threading.Lock()
+    ACCOUNTS: weakref.WeakSet[MemoryAccount] = weakref.WeakSet()
+    CURRENT = 0
+    PEAK = 0
+    TOP_N = 10
+
+    @staticmethod
+    def register(account: MemoryAccount) -> None:
+        with MemoryAccounting.LOCK:
+            MemoryAccounting.ACCOUNTS.add(account)
+
+    @staticmethod
+    def add(size: int) -> None:
+        with MemoryAccounting.LOCK:
+            MemoryAccounting.CURRENT += size
+            MemoryAccounting.PEAK = max(MemoryAccounting.PEAK, MemoryAccounting.CURRENT)
+
+    @staticmethod
+    def release(usage: list[int]) -> None:
+        with MemoryAccounting.LOCK:
+            MemoryAccounting.CURRENT -= usage[0]
+            usage[0] = 0
+
+    # Estimated bytes a value takes up, serialized as JSON; values that can't
+    # be serialized fall back to the length of their string form
+    @staticmethod
+    def estimate_value_size(value) -> int:
+        if value is None:
+            return 0
+        # Budgets are in bytes, so strings count their UTF-8 encoding
+        if isinstance(value, str):
+            return len(value.encode('utf-8'))
+        if isinstance(value, PackedPayload):
+            return len(value)
+        try:
+            return len(json.dumps(value, default=str, option=json.OPT_NON_STR_KEYS))
+        except (TypeError, json.JSONEncodeError):
+            return len(str(value).encode('utf-8'))
+
+    @staticmethod
+    def estimate_size(step_data: StepData) -> int:
+        return MemoryAccounting.estimate_value_size(step_data.input_data) + \
+            MemoryAccounting.estimate_value_size(step_data.output_data) + \
+            MemoryAccounting.estimate_value_size(step_data.failure_data) + \
+            MemoryAccounting.estimate_value_size(step_data.metadata) + \
+            MemoryAccounting.estimate_value_size(step_data.text)
+
+    @staticmethod
+    def get_stats() -> dict:
+        with MemoryAccounting.LOCK:
+            accounts = list(MemoryAccounting.ACCOUNTS)
+            stats = {'current_bytes': MemoryAccounting.CURRENT, 'peak_bytes': MemoryAccounting.PEAK}
+        accounts = [account for account in accounts if account.release_all.alive]
+        largest = sorted(accounts, key=lambda account: account.get_current(), reverse=True)[:MemoryAccounting.TOP_N]
+        stats['sessions'] = len(accounts)
+        stats['largest_sessions'] = {account.name: account.get_current() for account in largest}
+        return stats
@@ -1,11 +1,11 @@
 import copy
+import importlib
 import orjson as json
-from typing import Callable
+from typing import Callable, Iterable
 from graph_data import GraphData, StepData
 from collections import defaultdict
-from deepmerge import always_merger
 from handler import Handler
-from jinja2 import Template
+from json_extraction import JsonExtractionException, JsonExtractor, JsonSchemaValidator
 
 class NativeHandler(Handler):
     # TODO - native handler's shouldn't need a prefix, just the name they are registered with
@@ -20,8 +20,30 @@ class NativeHandler(Handler):
     INPUT_TEXT_KEY = 'input_text'
     GRAPH_DATA_KEY = 'graph_data'
     STEP_ENABLEMENT_GRAPH_KEY = 'step_enablement_graph'
+    # The element, and its index or key, in the input data of each element of a map step
+    ITEM_KEY = 'item'
+    ITEM_KEY_KEY = 'item_key'
+    # The group of values being merged, in the input data of a reduce step's merges
+    ITEMS_KEY = 'items'
+    DEFAULT_REDUCE_HANDLER: str = 'default_reduce_handler'
+    # Set in a step's metadata when its output had to be repaired to parse, so
+    # it may be missing whatever a truncated response cut off
+    REPAIRED_KEY = 'repaired'
+    # Length of the output kept in failure data when it can't be used
+    FAILURE_OUTPUT_CHARS = 500
     
     CALLBACKS: dict[str, Callable[[str, list[StepData], list[StepData], StepData, dict, str], None]] = {}
+    # Optional companions to output handlers, called with each value of a
+    # streamed response as it completes, keyed on the output handler's name
+    PARTIAL_CALLBACKS: dict[str, Callable[[list[StepData], StepData, dict, tuple, object], None]] = {}
+    # Their optional clean ups, for a stream that ends before its output handler runs
+    PARTIAL_ABORTS: dict[str, Callable[[list[StepData], StepData, dict], None]] = {}
+    # Modules that register native callbacks when imported, loaded on demand
+    # when a graph references one of their callbacks
+    CALLBACK_MODULES: dict[str, str] = {
+        'file_tree_output_handler': 'files_util',
+        'docker_build_output_handler': 'docker_executor',
+    }
     
    
     def __init__(self,):
@@ -30,15 +52,54 @@ class NativeHandler(Handler):
    
     def _struct_to_json(struct: dict|list|str|bool|object|int|float):
         return json.dumps(struct, option=json.OPT_INDENT_2).decode("utf-8")
+    
+    # Templates are compiled once per distinct source, jinja2 is only imported
+    # once a prompt is rendered
+    TEMPLATES: dict = {}
+    TEMPLATE_ENVIRONMENT = None
+    
+    @staticmethod
+    def get_template_environment():
+        if NativeHandler.TEMPLATE_ENVIRONMENT is None:
+            from jinja2 import Environment
+            NativeHandler.TEMPLATE_ENVIRONMENT = Environment()
+        return NativeHandler.TEMPLATE_ENVIRONMENT
+    
+    @staticmethod
+    def get_template(source: str):
+        template = NativeHandler.TEMPLATES.get(source, None)
+        if template is None:
+            template = NativeHandler.get_template_environment().from_string(source)
+            NativeHandler.TEMPLATES[source] = template
+        return template
+    
+    # Compile a template to a code object that can be cached and later restored
+    # with `load_compiled_template` without re-parsing the template source
+    @staticmethod
+    def compile_template(source: str):
+        return NativeHandler.get_template_environment().compile(source)
+    
+    @staticmethod
+    def load_compiled_template(source: str, code) -> None:
+        environment = NativeHandler.get_template_environment()
+        NativeHandler.TEMPLATES[source] = environment.template_class.from_code(
+            environment, code, environment.make_globals(None))
+    
+    # Prompt templates always have the input text available, prepended if the
+    # template doesn't place it explicitly
+    @staticmethod
+    def normalize_prompt_template(input: str) -> str:
+        if not '{{' + NativeHandler.INPUT_TEXT_KEY + '}}' in input:
+            input = '{{' + NativeHandler.INPUT_TEXT_KEY + '}}\n' + input 
+        return input
    
    
     def register_default_handlers(self):
         def default_user_prompt_handler(input_step_datas: list[StepData], 
                              step_data: StepData, config: dict, input: str):
             try:
-                if not '{{' + NativeHandler.INPUT_TEXT_KEY + '}}' in input:
-                    input = '{{' + NativeHandler.INPUT_TEXT_KEY + '}}\n' + input 
-                t = Template(input)
+                input = NativeHandler.normalize_prompt_template(input)
+                t = NativeHandler.get_template(input)
                 step_data.text = t.render(step_data.input_data)
             except Exception as e:
                 step_data.text = input
@@ -51,7 +112,7 @@ class NativeHandler(Handler):
                     NativeHandler.INPUT_TEXT_KEY: step_data.text,
                     NativeHandler.DATA_KEY: {},
                     NativeHandler.DATAS_KEY: {},
-                    NativeHandler.GRAPH_DATA_KEY: NativeHandler.GRAPH_DATA
+                    NativeHandler.GRAPH_DATA_KEY: NativeHandler.get_graph_data()
                 }
                 if len(input_step_datas) > 0:
                     # For steps with a single parent input (most), make output data from last
@@ -65,25 +126,56 @@ class NativeHandler(Handler):
             except Exception as e:
                 pass
             
+        # Find the JSON in the output, tolerating fences, preamble and (unless the
+        # node disables repair) malformed or truncated JSON; if the node has an
+        # output schema, output that doesn't conform fails the step
         def default_output_handler(input_step_datas: list[StepData], 
                              step_data: StepData, config: dict, input: str):
+            automata_config = NativeHandler.get_automata_config()
+            output_schema = getattr(automata_config, 'output_schema', None)
+            if not input:
+                step_data.output_data = {}
+                return
             try:
-                out_data = json.loads(input)
-                if not isinstance(out_data, dict):
-                    out_data = {
-                        NativeHandler.DATA_KEY: out_data
-                    }
-                step_data.output_data = out_data
-            except Exception as e:
+                out_data, stage = JsonExtractor.extract(input, getattr(automata_config, 'repair_json', True) != False)
+            except JsonExtractionException as e:
+                JsonExtractor.record('failed', step_data.automata_id)
                 step_data.output_data = {}
+                step_data.failure_data = {'stage': 'parse', 'errors': [str(e)],
+                                          'output': input[:NativeHandler.FAILURE_OUTPUT_CHARS]}
+                if output_schema is not None:
+                    step_data.success = False
+                return
+            JsonExtractor.record(stage)
+            if stage == 'repair':
+                step_data.metadata = (step_data.metadata or {}) | {NativeHandler.REPAIRED_KEY: True}
+            if output_schema is not None:
+                errors = JsonSchemaValidator.validate(out_data, output_schema)
+                if len(errors) > 0:
+                    JsonExtractor.record('schema_failed', step_data.automata_id)
+                    step_data.failure_data = {'stage': 'schema', 'errors': errors,
+                                              'output': input[:NativeHandler.FAILURE_OUTPUT_CHARS]}
+                    step_data.success = False
+            if not isinstance(out_data, dict):
+                out_data = {
+                    NativeHandler.DATA_KEY: out_data
+                }
+            step_data.output_data = out_data
         
         
+        # Merge the values of a reduce step's group into one
+        def default_reduce_handler(input_step_datas: list[StepData], 
+                             step_data: StepData, config: dict, input: str):
+            merged = None
+            for value in step_data.input_data.get(NativeHandler.ITEMS_KEY, []):
+                merged = value if merged is None else NativeHandler.merge_values(merged, value)
+            step_data.output_data = merged if isinstance(merged, dict) else {NativeHandler.DATA_KEY: merged}
+        
         def default_system_prompt_handler(input_step_datas: list[StepData], 
                              step_data: StepData, config: dict, input: str):
             try:
-                if not '{{' + NativeHandler.INPUT_TEXT_KEY + '}}' in input:
-                    input = '{{' + NativeHandler.INPUT_TEXT_KEY + '}}\n' + input 
-                t = Template(input)
+                input = NativeHandler.normalize_prompt_template(input)
+                t = NativeHandler.get_template(input)
                 step_data.text = t.render(step_data.input_data)
             except Exception as e:
                 step_data.text = input
@@ -92,6 +184,22 @@ class NativeHandler(Handler):
         self.register_callback(self.DEFAULT_OUTPUT_HANDLER, default_output_handler)
         self.register_callback(self.DEFAULT_SYSTEM_PROMPT_HANDLER, default_system_prompt_handler)
         self.register_callback(self.DEFAULT_USER_PROMPT_HANDLER, default_user_prompt_handler)
+        self.register_callback(self.DEFAULT_REDUCE_HANDLER, default_reduce_handler)
+    
+    # Objects are merged key by key, lists and strings are concatenated, and
+    # otherwise the later value wins. Neither value is modified
+    @staticmethod
+    def merge_values(first, second):
+        if isinstance(first, dict) and isinstance(second, dict):
+            merged = dict(first)
+            for key, value in second.items():
+                merged[key] = NativeHandler.merge_values(merged[key], value) if key in merged else value
+            return merged
+        if isinstance(first, list) and isinstance(second, list):
+            return first + second
+        if isinstance(first, str) and isinstance(second, str):
+            return first + '\n' + second
+        return second
         
     @staticmethod
     def get_handler_prefix():
@@ -105,6 +213,34 @@ class NativeHandler(Handler):
     def register_callback(name: str, callback: Callable[[str, list[StepData], StepData, dict, str], None]):
         NativeHandler.CALLBACKS[name] = callback
     
+    @staticmethod
+    def register_partial_callback(name: str, callback: Callable[[list[StepData], StepData, dict, tuple, object], None],
+                                  abort: Callable[[list[StepData], StepData, dict], None] = None):
+        NativeHandler.PARTIAL_CALLBACKS[name] = callback
+        if abort is not None:
+            NativeHandler.PARTIAL_ABORTS[name] = abort
+    
+    @staticmethod
+    def get_partial_callback(handler: str) -> Callable[[list[StepData], StepData, dict, tuple, object], None] | None:
+        return NativeHandler.PARTIAL_CALLBACKS.get(NativeHandler.format_handler(NativeHandler.HANDLER_PREFIX, handler), None)
+    
+    # Called when a stream the partial callback saw part of ends early, e.g. on
+    # an error or an output budget breach, since the output handler won't run
+    @staticmethod
+    def get_partial_abort(handler: str) -> Callable[[list[StepData], StepData, dict], None] | None:
+        return NativeHandler.PARTIAL_ABORTS.get(NativeHandler.format_handler(NativeHandler.HANDLER_PREFIX, handler), None)
+    
+    @staticmethod
+    def register_callback_module(name: str, module: str):
+        NativeHandler.CALLBACK_MODULES[name] = module
+    
+    @staticmethod
+    def load_callbacks(handler_refs: Iterable[str]) -> None:
+        for handler_ref in handler_refs:
+            name = NativeHandler.format_handler(NativeHandler.HANDLER_PREFIX, handler_ref)
+            if name not in NativeHandler.CALLBACKS and name in NativeHandler.CALLBACK_MODULES:
+                importlib.import_module(NativeHandler.CALLBACK_MODULES[name])
+    
     def invoke_handler(self, handler: str, input_step_datas: list[StepData], 
                        step_data: StepData, 
                        config: dict, input: str = "") -> None:
@@ -7,6 +7,8 @@ from handler import Handler
 class PyHandler(Handler):
     HANDLER_PREFIX: str = 'py::'
     HANDLER_REF = 'handler'
+    # Restricted byte code per inline handler source, compiled once
+    COMPILED: dict = {}
    
     @staticmethod
     def get_handler_prefix():
@@ -16,18 +18,26 @@ class PyHandler(Handler):
     def set_handler_ref(handler_ref: str):
         PyHandler.handler_ref = handler_ref
     
+    @staticmethod
+    def get_byte_code(handler: str):
+        byte_code = PyHandler.COMPILED.get(handler, None)
+        if byte_code is None:
+            byte_code = compile_restricted(handler, '<inline handler>', 'exec')
+            PyHandler.COMPILED[handler] = byte_code
+        return byte_code
+    
     def invoke_handler(self, handler: str, input_step_datas: list[StepData], 
                        step_data: StepData, 
                        config: dict, input: str = "") -> None:
         handler = self.format_handler(self.HANDLER_PREFIX, handler)
         locals = {
-            'input_step_datas': json.loads(json.dumps(input_step_datas)),
-            'step_data': json.loads(json.dumps(step_data)),
+            'input_step_datas': json.loads(json.dumps([data.to_dict() for data in input_step_datas])),
+            'step_data': json.loads(json.dumps(step_data.to_dict())),
             'config': json.loads(json.dumps(config)),
             'input': input,
-            'graph_data': Handler.GRAPH_DATA
+            'graph_data': Handler.get_graph_data()
         }
-        byte_code = compile_restricted(handler, '<inline handler>', 'exec')
+        byte_code = PyHandler.get_byte_code(handler)
         exec(byte_code, locals=locals)
         try:
             step_data.output_data = locals['step_data']['output_data']
@@ -1,7 +1,42 @@
+import asyncio
+import hashlib
 from abc import abstractmethod
+from typing import Iterator
 
 class Sapient:
     
+    # The configured provider stack: the routed model endpoints, recorded to or
+    # replayed from a cassette if enabled, with identical in-flight calls merged
+    @staticmethod
+    def from_config(config) -> 'Sapient':
+        from sapient_cassette import SapientCassette
+        from sapient_single_flight import SapientSingleFlight
+        def get_provider() -> Sapient:
+            from sapient_router import SapientRouter
+            return SapientRouter.from_config(config)
+        return SapientSingleFlight.wrap(config, SapientCassette.from_config(config, get_provider))
+    
+    # Identifies a call by its model, system message and input
+    @staticmethod
+    def get_request_key(system_message: str, step_input: str, model: str = None) -> str:
+        digest = hashlib.sha256()
+        for part in (model or '', system_message or '', step_input or ''):
+            encoded = part.encode('utf-8')
+            digest.update(len(encoded).to_bytes(8, 'little'))
+            digest.update(encoded)
+        return digest.hexdigest()
+    
     @abstractmethod
     def invoke_llm(system_message: str, step_input: str, model: str = None) -> str:
-        pass
\ No newline at end of file
+        pass
+    
+    # Awaitable model call. Providers with a native async client should
+    # override this, so a cancelled call stops the request rather than just
+    # abandoning the thread it runs on
+    async def ainvoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        return await asyncio.to_thread(self.invoke_llm, system_message, step_input, model)
+    
+    # Yield the response in chunks as it is generated. Providers that can
+    # stream should override this; by default the whole response is one chunk
+    def stream_llm(self, system_message: str, step_input: str, model: str = None) -> Iterator[str]:
+        yield self.invoke_llm(system_message, step_input, model)
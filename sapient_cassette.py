@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Iterator
+import orjson as json
+from config import Config
+from sapient import Sapient
+
+class SapientCassette(Sapient):
+    """Records model calls to a cassette, or replays them from one. A cassette
+    is a JSON lines file with one entry per call: the request, the response
+    (or error), the observed latency and, for streamed calls, when each chunk
+    arrived. Entries are appended as calls complete, so worker processes can
+    record to the same file.
+
+    Replay answers each request with the responses recorded for it, in order,
+    repeating the last one once they run out, after the recorded latency
+    divided by `speed` (0 answers at once). Requests that were never recorded
+    fail"""
+    OFF = 'off'
+    RECORD = 'record'
+    REPLAY = 'replay'
+
+    def __init__(self, path: str, sapient: Sapient = None, speed: float = 1.0):
+        self.path = path
+        # The provider calls are recorded from; None to replay
+        self.sapient = sapient
+        self.speed = speed
+        self.entries: dict[str, list[dict]] = {}
+        self.positions: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        if sapient is None:
+            self._load()
+
+    # Wrap the provider from `get_provider` for recording, or replace it for
+    # replay, per --cassette-mode
+    @staticmethod
+    def from_config(config: Config, get_provider: Callable[[], Sapient]) -> Sapient:
+        conf = config.get_conf()
+        if conf.cassette_mode == SapientCassette.OFF:
+            return get_provider()
+        if not conf.cassette_path:
+            raise Exception('A cassette path (--cassette-path) is required to {} model calls'.format(conf.cassette_mode))
+        path = config.normalize_and_resolve_path(conf.cassette_path)
+        if conf.cassette_mode == SapientCassette.RECORD:
+            return SapientCassette(path, get_provider())
+        return SapientCassette(path, speed=conf.cassette_speed)
+
+    def _load(self) -> None:
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                self.entries.setdefault(entry['key'], []).append(entry)
+
+    def _next_entry(self, key: str, model: str) -> dict:
+        with self.lock:
+            entries = self.entries.get(key, None)
+            if entries is None:
+                self.misses += 1
+                raise Exception('Cassette {} has no recorded response for this call to model {}'.format(self.path, model))
+            self.hits += 1
+            position = self.positions.get(key, 0)
+            self.positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+    def _get_delay(self, seconds: float) -> float:
+        return seconds / self.speed if self.speed > 0 else 0.0
+
+    def _replay(self, entry: dict) -> str:
+        if entry.get('error', None) is not None:
+            raise Exception(entry['error'])
+        return entry['response']
+
+    def _record(self, key: str, system_message: str, step_input: str, model: str, latency: float,
+                response: str = None, error: BaseException = None, chunks: list[list] = None) -> None:
+        entry = {'key': key, 'recorded': datetime.now(), 'model': model, 'system_message': system_message,
+                 'input': step_input, 'response': response, 'error': str(error) if error is not None else None,
+                 'latency': latency}
+        if chunks is not None:
+            entry['chunks'] = chunks
+        line = json.dumps(entry) + b'\n'
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                f.write(line)
+            self.recorded += 1
+
+    def invoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        key = Sapient.get_request_key(system_message, step_input, model)
+        if self.sapient is None:
+            entry = self._next_entry(key, model)
+            time.sleep(self._get_delay(entry['latency']))
+            return self._replay(entry)
+        started = time.monotonic()
+        try:
+            response = self.sapient.invoke_llm(system_message, step_input, model)
+        except Exception as e:
+            self._record(key, system_message, step_input, model, time.monotonic() - started, error=e)
+            raise
+        self._record(key, system_message, step_input, model, time.monotonic() - started, response)
+        return response
+
+    async def ainvoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        key = Sapient.get_request_key(system_message, step_input, model)
+        if self.sapient is None:
+            entry = self._next_entry(key, model)
+            await asyncio.sleep(self._get_delay(entry['latency']))
+            return self._replay(entry)
+        started = time.monotonic()
+        try:
+            response = await self.sapient.ainvoke_llm(system_message, step_input, model)
+        except Exception as e:
+            self._record(key, system_message, step_input, model, time.monotonic() - started, error=e)
+            raise
+        self._record(key, system_message, step_input, model, time.monotonic() - started, response)
+        return response
+
+    # Streamed calls record the offset of each chunk, and replay them at those
+    # offsets; calls recorded unstreamed replay as a single chunk
+    def stream_llm(self, system_message: str, step_input: str, model: str = None) -> Iterator[str]:
+        key = Sapient.get_request_key(system_message, step_input, model)
+        if self.sapient is None:
+            entry = self._next_entry(key, model)
+            chunks = entry.get('chunks', None) or [[entry['latency'], entry['response'] or '']]
+            started = time.monotonic()
+            for offset, chunk in chunks:
+                delay = self._get_delay(offset) - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                yield chunk
+            self._replay(entry)
+            return
+        started = time.monotonic()
+        chunks: list[list] = []
+        try:
+            for chunk in self.sapient.stream_llm(system_message, step_input, model):
+                chunks.append([time.monotonic() - started, chunk])
+                yield chunk
+        except Exception as e:
+            self._record(key, system_message, step_input, model, time.monotonic() - started,
+                         ''.join(chunk for _, chunk in chunks), e, chunks)
+            raise
+        self._record(key, system_message, step_input, model, time.monotonic() - started,
+                     ''.join(chunk for _, chunk in chunks), chunks=chunks)
+
+    def get_stats(self) -> dict:
+        stats = self.sapient.get_stats() if hasattr(self.sapient, 'get_stats') else {}
+        with self.lock:
+            stats['cassette'] = {'mode': self.RECORD if self.sapient is not None else self.REPLAY,
+                                 'hits': self.hits, 'misses': self.misses, 'recorded': self.recorded}
+        return stats
@@ -1,30 +1,62 @@
-from langchain_openai import ChatOpenAI
-
+import threading
+from typing import Iterator
 from config import Config
 from sapient import Sapient
 
 class SapientLangchainOpanAI(Sapient):
-    def __init__(self, config: Config):
+    # Endpoint settings default to the CLI options, and can be given per
+    # instance to talk to several endpoints
+    def __init__(self, config: Config, base_url: str = None, api_key: str = None, model_name: str = None):
         self.config = config
         self.conf = config.get_conf()
         self.logger = config.logger
+        self.base_url = base_url if base_url is not None else self.conf.base_url
+        self.api_key = api_key if api_key is not None else self.conf.api_key
+        self.model_name = model_name if model_name is not None else self.conf.model_name
+        # Clients are reused across calls, so connections are pooled
+        self.llms: dict = {}
+        self.lock = threading.Lock()
+
+    def get_llm(self, model: str = None):
+        model = model if model != None else self.model_name
+        with self.lock:
+            llm = self.llms.get(model, None)
+            if llm is not None:
+                return llm
+            llm_config = {
+                "model": model
+            }
+            if self.base_url != "":
+                llm_config["base_url"] = self.base_url
+            if self.api_key != "":
+                llm_config["api_key"] = self.api_key
+
+            llm_config = self.config.merge_override_params_key("llm_config", llm_config)
+            # LangChain is imported on the first model call, not at startup
+            from langchain_openai import ChatOpenAI
+            llm = ChatOpenAI(**llm_config)
+            self.llms[model] = llm
+            return llm
 
     # TODO tool calling, for now depend on prompts
     def invoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
-        model = model if model != None else self.conf.model_name
-        llm_config = {
-            "model": model
-        }
-        if self.conf.base_url != "":
-            llm_config["base_url"] = self.conf.base_url
-        if self.conf.api_key != "":
-            llm_config["api_key"] = self.conf.api_key
-        
-        llm_config = self.config.merge_override_params_key("llm_config", llm_config)
-        llm = ChatOpenAI(**llm_config)
-        response = llm.invoke([
+        response = self.get_llm(model).invoke([
             ("system", system_message),
             ("human", step_input),
         ])
         content = str(response.content)
-        return content
\ No newline at end of file
+        return content
+
+    async def ainvoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        response = await self.get_llm(model).ainvoke([
+            ("system", system_message),
+            ("human", step_input),
+        ])
+        return str(response.content)
+
+    def stream_llm(self, system_message: str, step_input: str, model: str = None) -> Iterator[str]:
+        for chunk in self.get_llm(model).stream([
+            ("system", system_message),
+            ("human", step_input),
+        ]):
+            yield str(chunk.content)
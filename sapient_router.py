@@ -0,0 +1,240 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Iterator
+import orjson as json
+from config import Config
+from event_loop import BackgroundEventLoop
+from sapient import Sapient
+
+class ModelEndpoint:
+    """One upstream model provider and its observed health"""
+    def __init__(self, name: str, sapient: Sapient, model: str = None, error_window: int = 20):
+        self.name = name
+        self.sapient = sapient
+        # If set, the only model this endpoint serves
+        self.model = model
+        self.latency: float = None
+        self.outcomes: deque[bool] = deque(maxlen=error_window)
+        self.consecutive_errors = 0
+        self.in_flight = 0
+        self.unhealthy_until = 0.0
+
+    def serves(self, model: str) -> bool:
+        return model is None or self.model is None or self.model == model
+
+    def get_model(self, model: str) -> str:
+        return model if model is not None else self.model
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.unhealthy_until
+
+    def get_error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if len(self.outcomes) > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {'name': self.name, 'model': self.model, 'latency': self.latency,
+                'error_rate': self.get_error_rate(), 'in_flight': self.in_flight,
+                'healthy': self.is_healthy(time.monotonic())}
+
+class SapientRouter(Sapient):
+    """Routes model calls across several endpoints. Each call goes to the
+    healthy endpoint with the fewest calls in flight; if it hasn't answered
+    after the configured percentile of recent latencies, a hedged duplicate is
+    sent to another endpoint, the first answer wins and the other call is
+    cancelled. Failed calls fail over to endpoints not yet tried.
+
+    Endpoints are skipped for a cooldown when they keep failing, or when their
+    average latency is far above the fastest endpoint's"""
+    # Weight of the newest sample in an endpoint's latency average
+    ALPHA = 0.3
+    MAX_CONSECUTIVE_ERRORS = 3
+    MIN_ERROR_SAMPLES = 5
+    MAX_ERROR_RATE = 0.5
+    SLOW_FACTOR = 3.0
+    LATENCY_WINDOW = 500
+    # Hedging only starts once the percentile is meaningful
+    MIN_HEDGE_SAMPLES = 20
+
+    def __init__(self, config: Config, endpoints: list[ModelEndpoint], hedge_percentile: float = None,
+                 hedge_min_delay: float = None, cooldown: float = None):
+        if len(endpoints) == 0:
+            raise Exception('At least one model endpoint is required')
+        conf = config.get_conf()
+        self.config = config
+        self.logger = config.logger
+        self.endpoints = endpoints
+        self.hedge_percentile = hedge_percentile if hedge_percentile is not None else conf.hedge_percentile
+        self.hedge_min_delay = hedge_min_delay if hedge_min_delay is not None else conf.hedge_min_delay
+        self.cooldown = cooldown if cooldown is not None else conf.endpoint_cooldown
+        # Recent successful call latencies per requested model
+        self.latencies: dict[str, deque[float]] = {}
+        self.rotation = itertools.count()
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    # A router over --model-endpoints, or the single default endpoint if only
+    # hedging is enabled; otherwise the plain default provider
+    @staticmethod
+    def from_config(config: Config) -> Sapient:
+        from sapient_langchain_openai import SapientLangchainOpanAI
+        conf = config.get_conf()
+        if not conf.model_endpoints and conf.hedge_percentile <= 0:
+            return SapientLangchainOpanAI(config)
+        endpoint_configs = json.loads(conf.model_endpoints) if conf.model_endpoints else [{}]
+        if not isinstance(endpoint_configs, list):
+            raise Exception('--model-endpoints must be a JSON list of endpoint objects')
+        endpoints = []
+        for i, endpoint_config in enumerate(endpoint_configs):
+            sapient = SapientLangchainOpanAI(config, base_url=endpoint_config.get('base_url', None),
+                                             api_key=endpoint_config.get('api_key', None),
+                                             model_name=endpoint_config.get('model', None))
+            endpoints.append(ModelEndpoint(endpoint_config.get('name', 'endpoint-{}'.format(i)), sapient,
+                                           endpoint_config.get('model', None)))
+        return SapientRouter(config, endpoints)
+
+    def invoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        return BackgroundEventLoop.get_instance().run_sync(self.ainvoke_llm(system_message, step_input, model))
+
+    async def ainvoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        attempts: dict[asyncio.Task, ModelEndpoint] = {}
+        tried: set[str] = set()
+        errors: list[str] = []
+        hedge_delay = self.get_hedge_delay(model)
+        hedge_task: asyncio.Task = None
+        def launch(endpoint: ModelEndpoint) -> asyncio.Task:
+            tried.add(endpoint.name)
+            task = asyncio.ensure_future(self._call(endpoint, system_message, step_input, model))
+            attempts[task] = endpoint
+            return task
+        launch(self._select(model, tried))
+        try:
+            while len(attempts) > 0:
+                done, _ = await asyncio.wait(attempts.keys(), timeout=None if hedge_task is not None else hedge_delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if len(done) == 0:
+                    self.hedges += 1
+                    endpoint = self._select(model, tried, allow_tried=True)
+                    self.logger.debug('Model call slower than {:.2f} s, hedging on {}'.format(hedge_delay, endpoint.name))
+                    hedge_task = launch(endpoint)
+                    continue
+                for task in done:
+                    endpoint = attempts.pop(task)
+                    if task.exception() is None:
+                        if task is hedge_task:
+                            self.hedge_wins += 1
+                        return task.result()
+                    errors.append('{}: {}'.format(endpoint.name, task.exception()))
+                if len(attempts) == 0:
+                    endpoint = self._select(model, tried)
+                    if endpoint.name not in tried:
+                        self.logger.warning('Model call failed, failing over to {}'.format(endpoint.name))
+                        launch(endpoint)
+            raise Exception('Model call failed on all endpoints: {}'.format('; '.join(errors)))
+        finally:
+            # The losing (or abandoned) calls are cancelled, closing their requests
+            for task in attempts.keys():
+                task.cancel()
+
+    # Streamed calls aren't hedged, but fail over to another endpoint if they
+    # fail before the first chunk arrives
+    def stream_llm(self, system_message: str, step_input: str, model: str = None) -> Iterator[str]:
+        tried: set[str] = set()
+        errors: list[str] = []
+        while True:
+            endpoint = self._select(model, tried)
+            if endpoint.name in tried:
+                raise Exception('Model call failed on all endpoints: {}'.format('; '.join(errors)))
+            tried.add(endpoint.name)
+            endpoint.in_flight += 1
+            started = time.monotonic()
+            streamed = False
+            try:
+                for chunk in endpoint.sapient.stream_llm(system_message, step_input, endpoint.get_model(model)):
+                    streamed = True
+                    yield chunk
+            except Exception as e:
+                self._record(endpoint, model, None)
+                if streamed:
+                    raise
+                errors.append('{}: {}'.format(endpoint.name, e))
+                self.logger.warning('Streamed model call failed, failing over from {}'.format(endpoint.name))
+                continue
+            finally:
+                endpoint.in_flight -= 1
+            self._record(endpoint, model, time.monotonic() - started)
+            return
+
+    # Delay after which a call is hedged, or None if hedging is off or there
+    # aren't enough samples yet
+    def get_hedge_delay(self, model: str = None) -> float | None:
+        if self.hedge_percentile <= 0:
+            return None
+        latencies = self.latencies.get(model, None)
+        if latencies is None or len(latencies) < self.MIN_HEDGE_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100.0))
+        return max(self.hedge_min_delay, ordered[index])
+
+    # Pick the healthy, untried endpoint with the fewest calls in flight, then
+    # the lowest latency; rotation spreads ties
+    def _select(self, model: str, tried: set[str], allow_tried: bool = False) -> ModelEndpoint:
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.serves(model)] or self.endpoints
+        offset = next(self.rotation) % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        for pool in ([e for e in candidates if e.is_healthy(now) and e.name not in tried],
+                     [e for e in candidates if e.name not in tried],
+                     [e for e in candidates if e.is_healthy(now)] if allow_tried else [],
+                     candidates):
+            if len(pool) > 0:
+                return min(pool, key=lambda endpoint: (endpoint.in_flight, endpoint.latency or 0.0))
+
+    async def _call(self, endpoint: ModelEndpoint, system_message: str, step_input: str, model: str) -> str:
+        endpoint.in_flight += 1
+        started = time.monotonic()
+        try:
+            result = await endpoint.sapient.ainvoke_llm(system_message, step_input, endpoint.get_model(model))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._record(endpoint, model, None)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        self._record(endpoint, model, time.monotonic() - started)
+        return result
+
+    def _record(self, endpoint: ModelEndpoint, model: str, latency: float | None) -> None:
+        if latency is None:
+            endpoint.outcomes.append(False)
+            endpoint.consecutive_errors += 1
+        else:
+            endpoint.outcomes.append(True)
+            endpoint.consecutive_errors = 0
+            endpoint.latency = latency if endpoint.latency is None else \
+                endpoint.latency + self.ALPHA * (latency - endpoint.latency)
+            self.latencies.setdefault(model, deque(maxlen=self.LATENCY_WINDOW)).append(latency)
+        reason = self._get_unhealthy_reason(endpoint)
+        if reason is not None:
+            endpoint.unhealthy_until = time.monotonic() + self.cooldown
+            self.logger.warning('Model endpoint {} marked unhealthy for {:.0f} s: {}'.format(
+                endpoint.name, self.cooldown, reason))
+
+    def _get_unhealthy_reason(self, endpoint: ModelEndpoint) -> str | None:
+        if endpoint.consecutive_errors >= self.MAX_CONSECUTIVE_ERRORS:
+            return '{} consecutive errors'.format(endpoint.consecutive_errors)
+        if len(endpoint.outcomes) >= self.MIN_ERROR_SAMPLES and endpoint.get_error_rate() > self.MAX_ERROR_RATE:
+            return 'error rate {:.0%}'.format(endpoint.get_error_rate())
+        latencies = [e.latency for e in self.endpoints if e is not endpoint and e.latency is not None]
+        if endpoint.latency is not None and len(latencies) > 0 and \
+            endpoint.latency > self.SLOW_FACTOR * min(latencies):
+            return 'average latency {:.2f} s, over {:.0f}x the fastest endpoint'.format(
+                endpoint.latency, self.SLOW_FACTOR)
+        return None
+
+    def get_stats(self) -> dict:
+        return {'endpoints': [endpoint.to_dict() for endpoint in self.endpoints],
+                'hedges': self.hedges, 'hedge_wins': self.hedge_wins}
@@ -0,0 +1,84 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import Iterator
+from config import Config
+from sapient import Sapient
+
+class SapientSingleFlight(Sapient):
+    """Merges identical model calls that are in flight at the same time into
+    one upstream call, whose answer (or error) is handed to every caller.
+    Calls are identical when their model, system message and input match;
+    nothing is cached once the upstream call returns"""
+    def __init__(self, sapient: Sapient):
+        self.sapient = sapient
+        self.in_flight: dict[str, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.merged = 0
+
+    # Wrap a provider unless single-flight is disabled
+    @staticmethod
+    def wrap(config: Config, sapient: Sapient) -> Sapient:
+        if sapient is None or config.get_conf().disable_single_flight:
+            return sapient
+        return SapientSingleFlight(sapient)
+
+    # Returns the shared future for the call, and whether this caller leads it
+    def _join(self, key: str) -> tuple[concurrent.futures.Future, bool]:
+        with self.lock:
+            self.calls += 1
+            future = self.in_flight.get(key, None)
+            if future is not None:
+                self.merged += 1
+                return future, False
+            future = concurrent.futures.Future()
+            self.in_flight[key] = future
+            return future, True
+
+    def _complete(self, key: str, future: concurrent.futures.Future, result: str = None,
+                  exception: BaseException = None) -> None:
+        with self.lock:
+            self.in_flight.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def invoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        key = Sapient.get_request_key(system_message, step_input, model)
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = self.sapient.invoke_llm(system_message, step_input, model)
+        except BaseException as e:
+            self._complete(key, future, exception=e)
+            raise
+        self._complete(key, future, result)
+        return result
+
+    async def ainvoke_llm(self, system_message: str, step_input: str, model: str = None) -> str:
+        key = Sapient.get_request_key(system_message, step_input, model)
+        future, leader = self._join(key)
+        if leader:
+            # The upstream call runs as its own task, so cancelling the leading
+            # caller doesn't cancel it for the callers merged into it
+            task = asyncio.ensure_future(self.sapient.ainvoke_llm(system_message, step_input, model))
+            def on_done(task: asyncio.Task):
+                if task.cancelled():
+                    self._complete(key, future, exception=concurrent.futures.CancelledError())
+                else:
+                    self._complete(key, future, task.result() if task.exception() is None else None, task.exception())
+            task.add_done_callback(on_done)
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    # Streams are consumed as they arrive, so they aren't merged
+    def stream_llm(self, system_message: str, step_input: str, model: str = None) -> Iterator[str]:
+        return self.sapient.stream_llm(system_message, step_input, model)
+
+    def get_stats(self) -> dict:
+        stats = self.sapient.get_stats() if hasattr(self.sapient, 'get_stats') else {}
+        with self.lock:
+            stats['single_flight'] = {'calls': self.calls, 'merged': self.merged, 'in_flight': len(self.in_flight)}
+        return stats
@@ -0,0 +1,117 @@
+import threading
+import time
+import unittest
+from automata.fair_share_executor import FairShareExecutor
+
+class ConcurrencyProbe:
+    """Counts the calls running at once, overall and at their peak"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def __call__(self, value, seconds: float = 0.02):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(seconds)
+        with self.lock:
+            self.running -= 1
+        return value
+
+class TestFairShareExecutor(unittest.TestCase):
+    TIMEOUT = 10
+
+    def test_session_quota(self):
+        executor = FairShareExecutor(4)
+        session = executor.session('session', 2)
+        probe = ConcurrencyProbe()
+        futures = [session.submit(probe, i) for i in range(8)]
+        self.assertEqual([future.result(self.TIMEOUT) for future in futures], list(range(8)))
+        self.assertEqual(probe.peak, 2)
+
+    def test_subgroup_quota_within_parent(self):
+        executor = FairShareExecutor(4)
+        session = executor.session('session', 3)
+        probe = ConcurrencyProbe()
+        narrow = session.group('narrow', 1)
+        # No quota of its own, so capped by the session's
+        wide = session.group('wide')
+        futures = [narrow.submit(probe, i) for i in range(4)] + [wide.submit(probe, i) for i in range(8)]
+        for future in futures:
+            future.result(self.TIMEOUT)
+        self.assertLessEqual(probe.peak, 3)
+        self.assertEqual(executor.root.running, 0)
+        self.assertEqual(executor.root.pending, 0)
+
+    def test_sessions_share_threads(self):
+        executor = FairShareExecutor(2)
+        # Hold both threads until both sessions have queued their tasks
+        release = threading.Event()
+        blocker = executor.session('blocker', 0)
+        blocked = [blocker.submit(release.wait, self.TIMEOUT) for _ in range(2)]
+        probes = [ConcurrencyProbe(), ConcurrencyProbe()]
+        sessions = [executor.session('session {}'.format(i), 0) for i in range(2)]
+        futures = [session.submit(probe, i) for session, probe in zip(sessions, probes) for i in range(4)]
+        release.set()
+        for future in blocked + futures:
+            future.result(self.TIMEOUT)
+        self.assertLessEqual(len(executor.threads), 2)
+        # Each session gets a thread rather than one taking both
+        self.assertEqual([probe.peak for probe in probes], [1, 1])
+
+    def test_nested_join(self):
+        executor = FairShareExecutor(2)
+        session = executor.session('session', 1)
+        probe = ConcurrencyProbe()
+        def subgraph(n: int) -> list:
+            group = executor.get_current_group().group('subgraph')
+            return list(group.map(probe, range(n)))
+        # The outer task holds the session's only slot until it waits
+        self.assertEqual(session.submit(subgraph, 5).result(self.TIMEOUT), list(range(5)))
+        self.assertEqual(probe.peak, 1)
+
+    def test_nested_join_on_one_thread(self):
+        executor = FairShareExecutor(1)
+        session = executor.session('session', 1)
+        def subgraph(depth: int) -> int:
+            if depth == 0:
+                return 1
+            group = executor.get_current_group().group('depth {}'.format(depth))
+            futures = [group.submit(subgraph, depth - 1) for _ in range(2)]
+            group.wait(futures)
+            return sum(future.result() for future in futures)
+        self.assertEqual(session.submit(subgraph, 3).result(self.TIMEOUT), 8)
+        self.assertEqual(len(executor.threads), 1)
+
+    def test_failures_reach_the_future(self):
+        executor = FairShareExecutor(1)
+        session = executor.session('session', 1)
+        def fail():
+            raise ValueError('failed')
+        with self.assertRaises(ValueError):
+            session.submit(fail).result(self.TIMEOUT)
+        self.assertEqual(session.submit(len, 'ok').result(self.TIMEOUT), 2)
+
+    def test_current_group(self):
+        executor = FairShareExecutor(1)
+        session = executor.session('session', 1)
+        self.assertIsNone(executor.get_current_group())
+        self.assertIs(session.submit(executor.get_current_group).result(self.TIMEOUT), session)
+
+    # Two tasks queued while one thread is idle get a thread each, so the
+    # first can wait on the second
+    def test_thread_for_each_queued_task(self):
+        executor = FairShareExecutor(2)
+        session = executor.session('session', 0)
+        session.submit(len, '').result(self.TIMEOUT)
+        ready = threading.Event()
+        # Queue both before the idle thread can take either
+        with executor.condition:
+            waiting = session.submit(ready.wait, self.TIMEOUT)
+            session.submit(ready.set)
+        self.assertTrue(waiting.result(self.TIMEOUT))
+        self.assertEqual(len(executor.threads), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from files_util import FileTree
+from graph_data import StepData
+from native_handler import NativeHandler
+
+class TestFileTreeOutputHandler(unittest.TestCase):
+
+    def setUp(self):
+        NativeHandler()
+        self.folder = tempfile.TemporaryDirectory()
+        self.base_path = os.path.join(self.folder.name, 'session')
+        patcher = mock.patch.object(FileTree, 'get_session_path', return_value=self.base_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.folder.cleanup)
+
+    def handle(self, reply: str) -> StepData:
+        step_data = StepData(automata_id='generate', session_id='session')
+        FileTree.file_tree_output_handler([], step_data, {}, reply)
+        return step_data
+
+    def read(self, path: str) -> str:
+        with open(os.path.join(self.base_path, path)) as f:
+            return f.read()
+
+    def test_incremental_write(self):
+        self.handle('{"src": {"a.js": "console.log(1)", "b.js": "const x = 1"}, "c.js": "c"}')
+        step_data = self.handle('{"src": {"a.js": "console.log(2)", "b.js": "const x = 1"}}')
+        self.assertEqual(step_data.metadata[FileTree.CHANGESET_KEY],
+                         {'added': [], 'modified': ['src/a.js'], 'removed': ['c.js'], 'unchanged': ['src/b.js'], 'skipped': []})
+        self.assertEqual(self.read('src/a.js'), 'console.log(2)')
+        self.assertFalse(os.path.exists(os.path.join(self.base_path, 'c.js')))
+
+    def test_truncated_reply_keeps_project(self):
+        self.handle('{"src": {"a.js": "console.log(1)", "b.js": "const x = 1", "c.js": "c"}, "README.md": "readme"}')
+        # Cut off in the middle of b.js, then repaired by closing the string and objects
+        step_data = self.handle('{"src": {"a.js": "console.log(1)", "b.js": "const x = ')
+        self.assertTrue(step_data.success)
+        self.assertTrue(step_data.metadata[NativeHandler.REPAIRED_KEY])
+        changeset = step_data.metadata[FileTree.CHANGESET_KEY]
+        self.assertEqual(changeset['removed'], [])
+        self.assertEqual(sorted(changeset['skipped']), ['README.md', 'src/b.js', 'src/c.js'])
+        self.assertEqual(self.read('src/b.js'), 'const x = 1')
+        self.assertEqual(self.read('src/c.js'), 'c')
+        self.assertEqual(self.read('README.md'), 'readme')
+        # The files kept are still tracked, and a complete reply updates them
+        step_data = self.handle('{"src": {"a.js": "console.log(1)", "b.js": "const x = 2"}}')
+        changeset = step_data.metadata[FileTree.CHANGESET_KEY]
+        self.assertEqual(changeset['modified'], ['src/b.js'])
+        self.assertEqual(sorted(changeset['removed']), ['README.md', 'src/c.js'])
+
+    def test_truncated_reply_adds_new_files(self):
+        self.handle('{"a.js": "a"}')
+        step_data = self.handle('{"a.js": "changed", "new.js": "new", "b.js": "cut')
+        changeset = step_data.metadata[FileTree.CHANGESET_KEY]
+        self.assertEqual(sorted(changeset['added']), ['b.js', 'new.js'])
+        self.assertEqual(changeset['skipped'], ['a.js'])
+        self.assertEqual(self.read('a.js'), 'a')
+
+    def test_unparsable_reply_keeps_project(self):
+        self.handle('{"a.js": "a"}')
+        step_data = self.handle('sorry, I cannot do that')
+        self.assertEqual(self.read('a.js'), 'a')
+        changeset = step_data.metadata[FileTree.CHANGESET_KEY]
+        self.assertEqual(changeset['removed'], [])
+        self.assertEqual(changeset['modified'], [])
+
+    def test_path_traversal(self):
+        for tree in ('{"..": {"x": "y"}}', '{"a/../../x": "y"}', '{"/etc/x": "y"}'):
+            with self.subTest(tree=tree):
+                with self.assertRaisesRegex(Exception, 'Path traversal'):
+                    self.handle(tree)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import os
+import tempfile
+import unittest
+from graph_data import PackedPayload, StepData
+from graph_data_export import GraphDataExport, StepDataFilter
+from in_memory_graph_data import InMemoryGraphData
+
+def make_graph_data(pack_bytes: int = 0) -> InMemoryGraphData:
+    graph_data = InMemoryGraphData(pack_bytes=pack_bytes)
+    for i in range(12):
+        start_ns = StepData.now_ns()
+        graph_data.put_data(StepData(automata_id='step {}'.format(i % 3), iteration_tree=(0, i // 3), session_id='session',
+                                     parent_id='loop' if i % 2 else None, text='text é {}'.format(i),
+                                     input_data={'i': i, 'nested': {'values': list(range(i))}},
+                                     output_data={'rows': ['row {}'.format(n) for n in range(50)]} if i == 5 else {'n': i},
+                                     failure_data={'errors': ['bad']} if i == 7 else None, success=i != 7,
+                                     metadata={'changeset': {'added': ['a.py']}} if i == 4 else None,
+                                     start_ns=start_ns, end_ns=start_ns + 1000000))
+    return graph_data
+
+class TestGraphDataExport(unittest.TestCase):
+
+    def assert_same_steps(self, expected: list[StepData], actual: list[StepData]):
+        self.assertEqual(len(actual), len(expected))
+        for a, b in zip(expected, actual):
+            self.assertEqual(b.to_dict(), a.to_dict())
+            self.assertEqual(tuple(b.iteration_tree), tuple(a.iteration_tree))
+
+    def round_trip(self, graph_data: InMemoryGraphData, compress: bool, step_filter: StepDataFilter = None) -> InMemoryGraphData:
+        stream = io.BytesIO()
+        exported = GraphDataExport.export_stream(graph_data, stream, step_filter, compress)
+        stream.seek(0)
+        imported = InMemoryGraphData(pack_bytes=0)
+        self.assertEqual(GraphDataExport.import_stream(imported, stream), exported)
+        return imported
+
+    def test_round_trip(self):
+        graph_data = make_graph_data()
+        self.assert_same_steps(graph_data.fetch_all_data(), self.round_trip(graph_data, False).fetch_all_data())
+
+    def test_round_trip_compressed(self):
+        graph_data = make_graph_data()
+        stream = io.BytesIO()
+        GraphDataExport.export_stream(graph_data, stream, compress=True)
+        self.assertTrue(stream.getvalue().startswith(GraphDataExport.GZIP_MAGIC))
+        self.assert_same_steps(graph_data.fetch_all_data(), self.round_trip(graph_data, True).fetch_all_data())
+
+    def test_round_trip_packed_payloads(self):
+        graph_data = make_graph_data(pack_bytes=100)
+        self.assertTrue(any(isinstance(record.output_data, PackedPayload) for record in graph_data.data_store))
+        imported = self.round_trip(graph_data, False)
+        self.assert_same_steps(graph_data.fetch_all_data(), imported.fetch_all_data())
+        self.assertEqual(imported.fetch_data('step 2', (0, 1)).output_data['rows'][49], 'row 49')
+
+    def test_one_record_per_line(self):
+        stream = io.BytesIO()
+        self.assertEqual(GraphDataExport.export_stream(make_graph_data(), stream), 12)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 12)
+        self.assertTrue(all(line.startswith(b'{') for line in lines))
+
+    def test_filter(self):
+        graph_data = make_graph_data()
+        step_filter = StepDataFilter(ids=['step 1'], iteration_tree=[0, 2])
+        expected = [step_data for step_data in graph_data.fetch_all_data()
+                    if step_data.automata_id == 'step 1' and tuple(step_data.iteration_tree[:2]) == (0, 2)]
+        self.assert_same_steps(expected, self.round_trip(graph_data, False, step_filter).fetch_all_data())
+        # Filtering on import selects the same records
+        stream = io.BytesIO()
+        GraphDataExport.export_stream(graph_data, stream)
+        stream.seek(0)
+        imported = InMemoryGraphData(pack_bytes=0)
+        self.assertEqual(GraphDataExport.import_stream(imported, stream, step_filter), len(expected))
+        self.assert_same_steps(expected, imported.fetch_all_data())
+
+    def test_files(self):
+        graph_data = make_graph_data()
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('steps.ndjson', 'steps.ndjson.gz'):
+                with self.subTest(name=name):
+                    path = os.path.join(folder, name)
+                    self.assertEqual(GraphDataExport.export_to(graph_data, path), 12)
+                    imported = InMemoryGraphData(pack_bytes=0)
+                    self.assertEqual(GraphDataExport.import_from(imported, path), 12)
+                    self.assert_same_steps(graph_data.fetch_all_data(), imported.fetch_all_data())
+
+    def test_invalid_line(self):
+        stream = io.BytesIO(GraphDataExport.encode(StepData(automata_id='a')) + b'{not json\n')
+        with self.assertRaisesRegex(Exception, 'Line 2'):
+            GraphDataExport.import_stream(InMemoryGraphData(pack_bytes=0), stream)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import copy
+import unittest
+import orjson as json
+from json_extraction import IncrementalJsonParser
+
+DOCUMENT = ('{"text": "a \\"quoted\\" \\\\ back\\/slash\\nline \\u00e9 \\ud83d\\ude00 {not: [json]}", '
+            '"flags": [true, false, null], "numbers": [0, -12, 3.25, -1.5e-3, 2E+2], '
+            '"nested": {"empty": {}, "none": [], "key with \\"escapes\\"": "v"}}')
+
+def parse(chunks: list[str]) -> tuple[object, list[tuple]]:
+    events = []
+    parser = IncrementalJsonParser(lambda path, value: events.append((path, copy.deepcopy(value))))
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.finish(), events
+
+class TestIncrementalJsonParser(unittest.TestCase):
+
+    def test_whole_document(self):
+        value, events = parse([DOCUMENT])
+        self.assertEqual(value, json.loads(DOCUMENT))
+        self.assertEqual(events[-1], ((), json.loads(DOCUMENT)))
+        self.assertIn((('flags', 2), None), events)
+        self.assertIn((('nested', 'key with "escapes"'), 'v'), events)
+
+    # Every split into two chunks, so boundaries fall inside strings, escapes,
+    # \u sequences, literals and numbers
+    def test_every_split(self):
+        expected = parse([DOCUMENT])
+        for split in range(1, len(DOCUMENT)):
+            with self.subTest(split=split, at=DOCUMENT[split - 5:split + 5]):
+                self.assertEqual(parse([DOCUMENT[:split], DOCUMENT[split:]]), expected)
+
+    def test_one_character_chunks(self):
+        self.assertEqual(parse(list(DOCUMENT)), parse([DOCUMENT]))
+
+    def test_literal_split_at_end_of_chunk(self):
+        for literal, expected in (('true', True), ('false', False), ('null', None), ('-42', -42)):
+            for split in range(1, len(literal)):
+                with self.subTest(literal=literal, split=split):
+                    value, events = parse(['{"k": ' + literal[:split], literal[split:] + '}'])
+                    self.assertEqual(value, {'k': expected})
+                    self.assertEqual(events[0], (('k',), expected))
+
+    def test_values_complete_before_the_document(self):
+        events = []
+        parser = IncrementalJsonParser(lambda path, value: events.append(path))
+        parser.feed('{"a": "done", "b": "still goi')
+        self.assertEqual(events, [('a',)])
+        parser.feed('ng"}')
+        self.assertEqual(events, [('a',), ('b',), ()])
+
+    def test_preamble_fence_and_trailing_comma(self):
+        text = 'Here you go:\n```json\n{"a": [1, 2,],}\n```\nAnything else?'
+        for split in range(1, len(text)):
+            with self.subTest(split=split):
+                self.assertEqual(parse([text[:split], text[split:]])[0], {'a': [1, 2]})
+
+    def test_malformed_literal_fails(self):
+        parser = IncrementalJsonParser()
+        parser.feed('{"a": tru')
+        parser.feed('x}')
+        self.assertIsNone(parser.finish())
+        self.assertTrue(parser.failed)
+
+    def test_incomplete_document(self):
+        parser = IncrementalJsonParser()
+        parser.feed('{"a": "unterminated')
+        self.assertIsNone(parser.finish())
+
+    # A long string with escapes, fed in chunks that end on backslashes and
+    # quotes, is held back until it closes
+    def test_long_string_in_small_chunks(self):
+        document = json.dumps({'file': 'x = "1"\n\\' * 1000, 'next': [1]}).decode()
+        for size in (1, 2, 3, 7):
+            with self.subTest(size=size):
+                chunks = [document[i:i + size] for i in range(0, len(document), size)]
+                self.assertEqual(parse(chunks), parse([document]))
+
+if __name__ == '__main__':
+    unittest.main()